@@ -19,59 +19,59 @@ logger = logging.getLogger()
 
 def generate_scaffolds(contigs_file, links_file, out_scaffolds):
 
-    contigs_fasta = fp.read_sequence_dict(contigs_file)
-    scaffolds_fasta = {}
-    used_contigs = set()
-
-    connections = {}
-    with open(links_file, "r") as f:
-        for line in f:
-            line = line.strip()
-            if not line: continue
-            ctg_1, sign_1, ctg_2, sign_2 = line.split("\t")
-            if ctg_1 in contigs_fasta and ctg_2 in contigs_fasta:
-                connections[sign_1 + ctg_1] = sign_2 + ctg_2
-                connections[rc(sign_2) + ctg_2] = rc(sign_1) + ctg_1
-
-    scaffolds_fasta = {}
-    scaffolds_seq = {}
-    for ctg in contigs_fasta:
-        if ctg in used_contigs: continue
-
-        used_contigs.add(ctg)
-        scf = ["-" + ctg]
-        #extending right
-        while (scf[-1] in connections and
-               unsigned(connections[scf[-1]]) not in used_contigs):
-            scf.append(connections[scf[-1]])
-            used_contigs.add(unsigned(scf[-1]))
-
-        for i, ctg in enumerate(scf):
-            scf[i] = rc(ctg[0]) + unsigned(ctg)
-        scf = scf[::-1]
-
-        #extending left
-        while (scf[-1] in connections and
-               unsigned(connections[scf[-1]]) not in used_contigs):
-            scf.append(connections[scf[-1]])
-            used_contigs.add(unsigned(scf[-1]))
-
-        #generating sequence interleaved by Ns
-        if len(scf) == 1:
-            scaffolds_fasta[unsigned(ctg)] = contigs_fasta[unsigned(ctg)]
-            scaffolds_seq[unsigned(ctg)] = scf
-        else:
-            scf_name = "scaffold_" + unsigned(scf[0]).strip("contig_")
-            scaffolds_seq[scf_name] = scf
-            scf_seq = []
-            for scf_ctg in scf:
-                if scf_ctg[0] == "+":
-                    scf_seq.append(contigs_fasta[unsigned(scf_ctg)])
-                else:
-                    scf_seq.append(fp.reverse_complement(
-                                    contigs_fasta[unsigned(scf_ctg)]))
-            gap = "N" * cfg.vals["scaffold_gap"]
-            scaffolds_fasta[scf_name] = gap.join(scf_seq)
+    with fp.IndexedFasta(contigs_file) as contigs_fasta:
+        scaffolds_fasta = {}
+        used_contigs = set()
+
+        connections = {}
+        with open(links_file, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line: continue
+                ctg_1, sign_1, ctg_2, sign_2 = line.split("\t")
+                if ctg_1 in contigs_fasta and ctg_2 in contigs_fasta:
+                    connections[sign_1 + ctg_1] = sign_2 + ctg_2
+                    connections[rc(sign_2) + ctg_2] = rc(sign_1) + ctg_1
+
+        scaffolds_fasta = {}
+        scaffolds_seq = {}
+        for ctg in contigs_fasta:
+            if ctg in used_contigs: continue
+
+            used_contigs.add(ctg)
+            scf = ["-" + ctg]
+            #extending right
+            while (scf[-1] in connections and
+                   unsigned(connections[scf[-1]]) not in used_contigs):
+                scf.append(connections[scf[-1]])
+                used_contigs.add(unsigned(scf[-1]))
+
+            for i, ctg in enumerate(scf):
+                scf[i] = rc(ctg[0]) + unsigned(ctg)
+            scf = scf[::-1]
+
+            #extending left
+            while (scf[-1] in connections and
+                   unsigned(connections[scf[-1]]) not in used_contigs):
+                scf.append(connections[scf[-1]])
+                used_contigs.add(unsigned(scf[-1]))
+
+            #generating sequence interleaved by Ns
+            if len(scf) == 1:
+                scaffolds_fasta[unsigned(ctg)] = contigs_fasta[unsigned(ctg)]
+                scaffolds_seq[unsigned(ctg)] = scf
+            else:
+                scf_name = "scaffold_" + unsigned(scf[0]).strip("contig_")
+                scaffolds_seq[scf_name] = scf
+                scf_seq = []
+                for scf_ctg in scf:
+                    if scf_ctg[0] == "+":
+                        scf_seq.append(contigs_fasta[unsigned(scf_ctg)])
+                    else:
+                        scf_seq.append(fp.reverse_complement(
+                                        contigs_fasta[unsigned(scf_ctg)]))
+                gap = "N" * cfg.vals["scaffold_gap"]
+                scaffolds_fasta[scf_name] = gap.join(scf_seq)
 
     fp.write_fasta_dict(scaffolds_fasta, out_scaffolds)
     return scaffolds_seq
@@ -9,6 +9,9 @@ Sets up some parameters for the run based on input
 from __future__ import absolute_import
 from __future__ import division
 import logging
+import os
+import json
+from collections import defaultdict
 
 import flye.utils.fasta_parser as fp
 import flye.config.py_cfg as cfg
@@ -17,18 +20,25 @@ from flye.six import iteritems
 
 logger = logging.getLogger()
 
+#read length statistics are cached in the output directory
+READS_STATS_FILE = "reads_stats.json"
+
 
 def setup_params(args):
     logger.info("Configuring run")
     parameters = {}
     parameters["pipeline_version"] = cfg.vals["pipeline_version"]
 
-    total_length = 0
-    read_lengths = []
+    stats_file = os.path.join(args.out_dir, READS_STATS_FILE)
+    stats_cache = _load_stats_cache(stats_file)
+    read_lengths = defaultdict(int)
     for read_file in args.reads:
-        for _, seq_len in iteritems(fp.read_sequence_lengths(read_file)):
-            total_length += seq_len
-            read_lengths.append(seq_len)
+        file_lengths = _get_length_histogram(read_file, args.threads,
+                                             stats_cache)
+        for seq_len, count in iteritems(file_lengths):
+            read_lengths[seq_len] += count
+    _save_stats_cache(stats_cache, stats_file)
+    total_length = sum(l * c for l, c in iteritems(read_lengths))
 
     _, reads_n50 = _calc_nx(read_lengths, total_length, 0.50)
     _, reads_n90 = _calc_nx(read_lengths, total_length, 0.90)
@@ -83,23 +93,77 @@ def setup_params(args):
     return parameters
 
 
-def _calc_nx(scaffolds_lengths, assembly_len, rate):
+def _get_length_histogram(read_file, num_proc, stats_cache):
+    """
+    Returns the dictionary {read length : number of reads}. The result
+    is taken from the cache if the file (path, size, mtime) did not change
+    """
+    file_path = os.path.abspath(read_file)
+    file_stat = os.stat(file_path)
+    cached = stats_cache.get(file_path)
+    if (cached and cached["size"] == file_stat.st_size and
+            cached["mtime"] == file_stat.st_mtime):
+        logger.debug("Using cached read length statistics for %s", read_file)
+        return {l : c for l, c in cached["lengths"]}
+
+    length_hist = defaultdict(int)
+    for _, seq_len in iteritems(fp.read_sequence_lengths(read_file, num_proc)):
+        length_hist[seq_len] += 1
+
+    stats_cache[file_path] = {"size": file_stat.st_size,
+                              "mtime": file_stat.st_mtime,
+                              "lengths": sorted(iteritems(length_hist))}
+    return length_hist
+
+
+def _load_stats_cache(stats_file):
+    if not os.path.exists(stats_file):
+        return {}
+    try:
+        with open(stats_file, "r") as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        logger.debug("Ignoring read statistics cache: %s", str(e))
+        return {}
+
+
+def _save_stats_cache(stats_cache, stats_file):
+    try:
+        with open(stats_file + ".tmp", "w") as f:
+            json.dump(stats_cache, f)
+        os.rename(stats_file + ".tmp", stats_file)
+    except (IOError, OSError) as e:
+        logger.debug("Can't save read statistics cache: %s", str(e))
+
+
+def _calc_nx(length_hist, assembly_len, rate):
+    """
+    Computes Nx and Lx given the dictionary {length : count}
+    """
     n50 = 0
     sum_len = 0
     l50 = 0
-    for l in sorted(scaffolds_lengths, reverse=True):
-        sum_len += l
-        l50 += 1
-        if sum_len > rate * assembly_len:
+    for l in sorted(length_hist, reverse=True):
+        count = length_hist[l]
+        if sum_len + l * count > rate * assembly_len:
+            #number of sequences of length l to exceed the threshold
+            num_seqs = int((rate * assembly_len - sum_len) // l) + 1
+            while num_seqs > 1 and sum_len + l * (num_seqs - 1) > rate * assembly_len:
+                num_seqs -= 1
+            while sum_len + l * num_seqs <= rate * assembly_len:
+                num_seqs += 1
+            l50 += num_seqs
             n50 = l
             break
+        sum_len += l * count
+        l50 += count
     return l50, n50
 
 
-def _get_downsample_threshold(read_lengths, target_len):
+def _get_downsample_threshold(length_hist, target_len):
     sum_len = 0
-    for l in sorted(read_lengths, reverse=True):
-        sum_len += l
+    for l in sorted(length_hist, reverse=True):
+        sum_len += l * length_hist[l]
         if sum_len > target_len:
             return l
 
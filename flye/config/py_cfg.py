@@ -44,6 +44,28 @@ vals = {
         "max_bubble_branches" : 50,
         "max_read_coverage" : 1000,
         "min_polish_aln_len" : 500,
+        #"text" or "binary" (length-prefixed frames, written in per-worker shards)
+        "bubbles_format" : "text",
+        #zlib level for binary bubbles, 0 = no compression
+        "bubbles_compression" : 0,
+        #pipe bubbles directly into the polishing binary (no bubbles file)
+        "bubbles_streaming" : False,
+        #after the first iteration, polish contigs in pipelined groups
+        #of this total length (each with its own reads), 0 = the whole
+        #assembly at once
+        "polish_group_size" : 0,
+        #target aligned bases per polishing chunk (chunk length is adjusted
+        #by the coverage from the previous iteration), 0 = fixed chunk size
+        "polish_chunk_aligned_bases" : 0,
+        #consensus pileup: "array" (integer arrays) or "dict"
+        #(per-position dicts), both give the same sequence
+        "consensus_profile" : "array",
+        #write per-stage time and memory usage of polishing
+        #into polishing_telemetry.jsonl in the work dir
+        "polish_telemetry" : False,
+        #write each polished contig as soon as all its chunks are composed
+        #(contigs are not sorted by name), only when bubbles are not streamed
+        "polish_streaming_compose" : False,
 
         #final coverage filtering
         "relative_minimum_coverage" : 5,
@@ -9,18 +9,31 @@ Runs Minimap2 and parses its output
 from __future__ import absolute_import
 from __future__ import division
 import os
-from collections import namedtuple
+import sys
+import binascii
+from bisect import bisect_left, insort
+from collections import namedtuple, defaultdict
 import subprocess
 import logging
 import datetime
 
 import flye.utils.fasta_parser as fp
-from flye.utils.utils import which
+from flye.utils.utils import which, check_call
 from flye.utils.sam_parser import AlignmentException
 from flye.six import iteritems
 from flye.six.moves import range
 
 
+#In Python2, everything is bytes (=str)
+#In Python3, we are doing IO in bytes, but everywhere else strngs = unicode
+if sys.version_info < (3, 0):
+    _STR = lambda x: x
+    _BYTES = lambda x: x
+else:
+    _STR = bytes.decode
+    _BYTES = str.encode
+
+
 logger = logging.getLogger()
 MINIMAP_BIN = "flye-minimap2"
 SAMTOOLS_BIN = "flye-samtools"
@@ -39,16 +52,18 @@ def check_binaries():
 
 def make_alignment(reference_file, reads_file, num_proc,
                    work_dir, platform, out_alignment, reference_mode,
-                   sam_output):
+                   sam_output, paf_base_level=False):
     """
-    Runs minimap2 and sorts its output
+    Runs minimap2 and sorts its output. If paf_base_level is set,
+    PAF output has base-level coordinates (same as in SAM output)
+    and no secondary alignments
     """
     minimap_ref_mode = {False: "ava", True: "map"}
     minimap_reads_mode = {"nano": "ont", "pacbio": "pb"}
     mode = minimap_ref_mode[reference_mode] + "-" + minimap_reads_mode[platform]
 
     _run_minimap(reference_file, reads_file, num_proc, mode,
-                 out_alignment, sam_output)
+                 out_alignment, sam_output, paf_base_level)
 
     #if sam_output:
     #    preprocess_sam(out_alignment, work_dir)
@@ -56,11 +71,10 @@ def make_alignment(reference_file, reads_file, num_proc,
 
 def get_contigs_info(contigs_file):
     contigs_info = {}
-    contigs_fasta = fp.read_sequence_dict(contigs_file)
-    for ctg_id, ctg_seq in iteritems(contigs_fasta):
+    contigs_lengths = fp.read_sequence_lengths(contigs_file)
+    for ctg_id, ctg_len in iteritems(contigs_lengths):
         contig_type = ctg_id.split("_")[0]
-        contigs_info[ctg_id] = ContigInfo(ctg_id, len(ctg_seq),
-                                          contig_type)
+        contigs_info[ctg_id] = ContigInfo(ctg_id, ctg_len, contig_type)
 
     return contigs_info
 
@@ -69,27 +83,55 @@ def shift_gaps(seq_trg, seq_qry):
     """
     Shifts all ambigious query gaps to the right
     """
-    lst_trg, lst_qry = list("$" + seq_trg + "$"), list("$" + seq_qry + "$")
-    is_gap = False
-    gap_start = 0
-    for i in range(len(lst_trg)):
-        if is_gap and lst_qry[i] != "-":
-            is_gap = False
-            swap_left = gap_start - 1
-            swap_right = i - 1
+    GAP = ord("-")
+    trg_bytes = bytearray(_BYTES(seq_trg))
+    qry_bytes = bytearray(_BYTES(seq_qry))
+    qry_len = len(qry_bytes)
+
+    #shifting a gap run only changes the query to the left of its end,
+    #so the next runs are searched in the same array
+    gap_start = qry_bytes.find(b"-")
+    while gap_start >= 0:
+        gap_end = gap_start + 1
+        while gap_end < qry_len and qry_bytes[gap_end] == GAP:
+            gap_end += 1
+
+        #the run moves left while the query base before it matches
+        #the target base at the end of the run
+        if gap_start and qry_bytes[gap_start - 1] == trg_bytes[gap_end - 1]:
+            gap_len = gap_end - gap_start
+            shift = 1
+            while (shift < gap_len and shift < gap_start and
+                   qry_bytes[gap_start - shift - 1] == trg_bytes[gap_end - shift - 1]):
+                shift += 1
+            qry_bytes[gap_start - shift : gap_end] = \
+                b"-" * gap_len + qry_bytes[gap_start - shift : gap_start]
+
+        gap_start = qry_bytes.find(b"-", gap_end)
+
+    return _STR(bytes(qry_bytes))
+
+
+def xor_bytes(bytes_1, bytes_2):
+    """
+    Bytewise XOR of two strings of equal length
+    """
+    xored = bytes_to_int(bytes_1) ^ bytes_to_int(bytes_2)
+    return int_to_bytes(xored, len(bytes_1))
+
 
-            while (swap_left > 0 and swap_right >= gap_start and
-                   lst_qry[swap_left] == lst_trg[swap_right]):
-                lst_qry[swap_left], lst_qry[swap_right] = \
-                            lst_qry[swap_right], lst_qry[swap_left]
-                swap_left -= 1
-                swap_right -= 1
+def bytes_to_int(bytes_str):
+    if sys.version_info < (3, 0):
+        return int(binascii.hexlify(bytes_str) or "0", 16)
+    return int.from_bytes(bytes_str, "big")
 
-        if not is_gap and lst_qry[i] == "-":
-            is_gap = True
-            gap_start = i
 
-    return "".join(lst_qry[1 : -1])
+def int_to_bytes(value, length):
+    if sys.version_info < (3, 0):
+        if length == 0:
+            return b""
+        return binascii.unhexlify("%0*x" % (length * 2, value))
+    return value.to_bytes(length, "big")
 
 
 def get_uniform_alignments(alignments, seq_len):
@@ -112,34 +154,64 @@ def get_uniform_alignments(alignments, seq_len):
     MIN_COV = 10
     COV_RATE = 1.25
 
-    #split contig into windows, get median read coverage over all windows and
-    #determine the quality threshold cutoffs for each window
-    wnd_primary_cov = [0 for _ in range(seq_len // WINDOW + 1)]
-    wnd_aln_quality = [[] for _ in range(seq_len // WINDOW + 1)]
-    wnd_qual_thresholds = [1.0 for _ in range(seq_len // WINDOW + 1)]
+    #split contig into windows, get median read coverage over all windows.
+    #Alignments cover windows [trg_start // WINDOW, trg_end // WINDOW),
+    #primary coverage is accumulated as a difference array
+    num_windows = seq_len // WINDOW + 1
+    cov_diff = [0 for _ in range(num_windows + 1)]
+    wnd_starts = defaultdict(list)
+    wnd_ends = defaultdict(list)
     for aln in alignments:
-        for i in range(aln.trg_start // WINDOW, aln.trg_end // WINDOW):
-            if not aln.is_secondary:
-                wnd_primary_cov[i] += 1
-            wnd_aln_quality[i].append(aln.err_rate)
-
-    #for each window, select top X alignmetns, where X is the median read coverage
+        first_wnd, last_wnd = aln.trg_start // WINDOW, aln.trg_end // WINDOW
+        if first_wnd >= last_wnd:
+            continue
+        if not aln.is_secondary:
+            cov_diff[first_wnd] += 1
+            cov_diff[last_wnd] -= 1
+        wnd_starts[first_wnd].append(aln.err_rate)
+        wnd_ends[last_wnd].append(aln.err_rate)
+
+    wnd_primary_cov = []
+    primary_cov = 0
+    for i in range(num_windows):
+        primary_cov += cov_diff[i]
+        wnd_primary_cov.append(primary_cov)
+
+    #for each window, select top X alignmetns, where X is the median read coverage.
+    #The quality threshold only changes where alignments start or end, so
+    #the windows are swept keeping the sorted error rates of the overlapping
+    #alignments, and thresholds are stored for the segments between the events
     cov_threshold = max(int(COV_RATE * _get_median(wnd_primary_cov)), MIN_COV)
-    for i in range(len(wnd_aln_quality)):
-        if len(wnd_aln_quality[i]) > cov_threshold:
-            wnd_qual_thresholds[i] = sorted(wnd_aln_quality[i])[cov_threshold]
+    seg_starts = sorted(set(wnd_starts) | set(wnd_ends) | set([0]))
+    seg_thresholds = []
+    active_quality = []
+    for seg_start in seg_starts:
+        for err_rate in wnd_ends.get(seg_start, []):
+            del active_quality[bisect_left(active_quality, err_rate)]
+        for err_rate in wnd_starts.get(seg_start, []):
+            insort(active_quality, err_rate)
+        if len(active_quality) > cov_threshold:
+            seg_thresholds.append(active_quality[cov_threshold])
+        else:
+            seg_thresholds.append(1.0)
+    seg_index = dict((wnd, i) for i, wnd in enumerate(seg_starts))
+    seg_starts.append(num_windows)
 
     #for each alignment, count in how many windows it passes the threshold
     filtered_alignments = []
     total_sequence = 0
     filtered_sequence = 0
     for aln in alignments:
+        first_wnd, last_wnd = aln.trg_start // WINDOW, aln.trg_end // WINDOW
         good_windows = 0
-        total_windows = aln.trg_end // WINDOW - aln.trg_start // WINDOW
+        total_windows = last_wnd - first_wnd
         total_sequence += aln.trg_end - aln.trg_start
-        for i in range(aln.trg_start // WINDOW, aln.trg_end // WINDOW):
-            if aln.err_rate <= wnd_qual_thresholds[i]:
-                good_windows += 1
+        if first_wnd < last_wnd:
+            seg = seg_index[first_wnd]
+            while seg_starts[seg] < last_wnd:
+                if aln.err_rate <= seg_thresholds[seg]:
+                    good_windows += seg_starts[seg + 1] - seg_starts[seg]
+                seg += 1
 
         if good_windows > total_windows // 2:
             filtered_alignments.append(aln)
@@ -153,15 +225,32 @@ def get_uniform_alignments(alignments, seq_len):
     return filtered_alignments
 
 
-def split_into_chunks(fasta_in, chunk_size):
+def split_into_chunks(fasta_in, chunk_size, coverage=None,
+                      chunk_aligned_bases=None):
+    """
+    Splits sequences into chunks named `orig_name$chunk_id`.
+    If coverage estimates (sequence name -> mean coverage) and the target
+    number of aligned bases per chunk are given, the chunk size of each
+    sequence is adjusted to match that target, but stays within
+    [chunk_size / 10, chunk_size * 5]. Sequences without coverage
+    estimates are split into chunks of chunk_size.
+    """
+    MIN_CHUNK = chunk_size // 10
+    MAX_CHUNK = chunk_size * 5
+
     out_dict = {}
     for header, seq in iteritems(fasta_in):
+        ctg_chunk_size = chunk_size
+        if coverage and chunk_aligned_bases and coverage.get(header):
+            ctg_chunk_size = chunk_aligned_bases // coverage[header]
+            ctg_chunk_size = min(max(ctg_chunk_size, MIN_CHUNK), MAX_CHUNK)
+
         #print len(seq)
-        for i in range(0, max(len(seq) // chunk_size, 1)):
+        for i in range(0, max(len(seq) // ctg_chunk_size, 1)):
             chunk_hdr = "{0}$chunk_{1}".format(header, i)
-            start = i * chunk_size
-            end = (i + 1) * chunk_size
-            if len(seq) - end < chunk_size:
+            start = i * ctg_chunk_size
+            end = (i + 1) * ctg_chunk_size
+            if len(seq) - end < ctg_chunk_size:
                 end = len(seq)
 
             #print(start, end)
@@ -199,7 +288,7 @@ def merge_chunks(fasta_in, fold_function=lambda l: "".join(l)):
 
 
 def _run_minimap(reference_file, reads_files, num_proc, mode, out_file,
-                 sam_output):
+                 sam_output, paf_base_level=False):
     #SAM_HEADER = "\'@PG|@HD|@SQ|@RG|@CO\'"
     work_dir = os.path.dirname(out_file)
     stderr_file = os.path.join(work_dir, "minimap.stderr")
@@ -228,7 +317,10 @@ def _run_minimap(reference_file, reads_files, num_proc, mode, out_file,
         cmdline.extend(["|", SAMTOOLS_BIN, "sort", "-T", tmp_prefix, "-O", "bam",
                         "-@", SORT_THREADS, "-l", "1", "-m", SORT_MEM])
     else:
-        pass    #paf output enabled by default
+        #paf output enabled by default
+        #c = base-level alignment, so coordinates are the same as in SAM
+        if paf_base_level:
+            cmdline.extend(["-c", "--secondary=no", "-I", "64G"])
 
         #cmdline.extend(["|", "grep", "-Ev", SAM_HEADER])    #removes headers
         #cmdline.extend(["|", "sort", "-k", "3,3", "-T", work_dir,
@@ -240,10 +332,10 @@ def _run_minimap(reference_file, reads_files, num_proc, mode, out_file,
         devnull = open(os.devnull, "wb")
         #env = os.environ.copy()
         #env["LC_ALL"] = "C"
-        subprocess.check_call(["/bin/bash", "-c",
-                              "set -o pipefail; " + " ".join(cmdline)],
-                              stderr=open(stderr_file, "w"),
-                              stdout=open(out_file, "w"))
+        check_call(["/bin/bash", "-c",
+                    "set -o pipefail; " + " ".join(cmdline)],
+                   stderr=open(stderr_file, "w"),
+                   stdout=open(out_file, "w"))
         os.remove(stderr_file)
 
     except (subprocess.CalledProcessError, OSError) as e:
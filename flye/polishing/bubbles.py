@@ -8,8 +8,14 @@ Separates alignment into small bubbles for further correction
 
 from __future__ import absolute_import
 from __future__ import division
+import sys
+import re
 import logging
-from bisect import bisect
+import struct
+import time
+import zlib
+from array import array
+from bisect import bisect, bisect_left
 from flye.six.moves import range
 
 import multiprocessing
@@ -18,24 +24,73 @@ import signal
 
 import flye.utils.fasta_parser as fp
 import flye.config.py_cfg as cfg
-from flye.polishing.alignment import shift_gaps, get_uniform_alignments
-from flye.utils.sam_parser import SynchronizedSamReader
+import flye.utils.telemetry as telemetry
+from flye.polishing.alignment import (shift_gaps, get_uniform_alignments,
+                                      xor_bytes, bytes_to_int, int_to_bytes)
+from flye.utils.sam_parser import make_alignment_reader
+from flye.utils.utils import PROCESS_START_LOCK
 from flye.six.moves import zip
 
 
+if sys.version_info < (3, 0):
+    from string import maketrans
+    _STR = lambda x: x
+    _BYTES = lambda x: x
+else:
+    maketrans = bytes.maketrans
+    _STR = bytes.decode
+    _BYTES = str.encode
+
+try:
+    from itertools import accumulate
+except ImportError:
+    def accumulate(iterable):
+        total = 0
+        for x in iterable:
+            total += x
+            yield total
+
+
 logger = logging.getLogger()
 
+#target gaps are replaced with zero bytes, so insertion columns never
+#match the query (even if the query also has a gap after shifting)
+_TRG_GAP_TO_ZERO = maketrans(b"-", b"\0")
+_NONZERO_RE = re.compile(b"[^\0]")
+_GAP_RUN_RE = re.compile(b"-+")
+#zero bytes to ones, everything else to zeros
+_ZERO_FLAGS = bytes(bytearray([1] + [0] * 255))
+
+#Binary bubbles: a sequence of self-contained frames, so per-worker
+#shards could be concatenated. Frame header: magic, flags,
+#stored payload size, raw payload size. Payload is a sequence of records:
+#name length, position, number of branches, consensus length, name,
+#consensus, then (length, sequence) for each branch. Little-endian.
+BUBBLES_MAGIC = b"FBUB"
+BUBBLES_FRAME_SIZE = 16 * 1024 * 1024
+_FRAME_HEADER = struct.Struct("<4sBII")
+_FRAME_ZLIB = 1
+_BUBBLE_HEADER = struct.Struct("<IiII")
+_BRANCH_HEADER = struct.Struct("<I")
+
 
 class ProfileInfo(object):
+    """
+    Alignment pileup over the contig: reference nucleotides
+    (zero byte if not covered) and per-position counters in integer arrays
+    """
     __slots__ = ("nucl", "num_inserts", "num_deletions",
                  "num_missmatch", "coverage")
 
-    def __init__(self):
-        self.nucl = ""
-        self.num_inserts = 0
-        self.num_deletions = 0
-        self.num_missmatch = 0
-        self.coverage = 0
+    def __init__(self, genome_len):
+        self.nucl = bytearray(genome_len)
+        self.num_inserts = array("i", [0]) * genome_len
+        self.num_deletions = array("i", [0]) * genome_len
+        self.num_missmatch = array("i", [0]) * genome_len
+        self.coverage = array("i", [0]) * genome_len
+
+    def __len__(self):
+        return len(self.nucl)
 
 
 class Bubble(object):
@@ -50,7 +105,7 @@ class Bubble(object):
 
 def _thread_worker(aln_reader, contigs_info, err_mode,
                    results_queue, error_queue, bubbles_file_handle,
-                   bubbles_file_lock):
+                   bubbles_file_lock, binary_output):
     """
     Will run in parallel
     """
@@ -61,6 +116,9 @@ def _thread_worker(aln_reader, contigs_info, err_mode,
                 break
 
             #logger.debug("Processing {0}".format(ctg_id))
+            chunk_start = time.time()
+            chunk_cpu_start = telemetry.cpu_times()[0]
+            num_alignments = len(ctg_aln)
             #get top unifom alignments
             ctg_aln = get_uniform_alignments(ctg_aln, contigs_info[ctg_id].length)
 
@@ -69,14 +127,25 @@ def _thread_worker(aln_reader, contigs_info, err_mode,
             partition, num_long_bubbles = _get_partition(profile, err_mode)
             ctg_bubbles = _get_bubble_seqs(ctg_aln, err_mode, profile, partition,
                                            contigs_info[ctg_id])
-            mean_cov = sum([len(b.branches) for b in ctg_bubbles]) // (len(ctg_bubbles) + 1)
-            ctg_bubbles, num_empty, num_long_branch = \
+            num_empty, num_long_branch, mean_cov = \
                                     _postprocess_bubbles(ctg_bubbles)
+            with bubbles_file_lock:
+                if binary_output:
+                    _output_bubbles_binary(ctg_bubbles, bubbles_file_handle,
+                                           cfg.vals["bubbles_compression"])
+                else:
+                    _output_bubbles(ctg_bubbles, bubbles_file_handle)
+            chunk_stats = {"contig": ctg_id,
+                           "alignments": num_alignments,
+                           "bubbles": len(ctg_bubbles),
+                           "wall_time": round(time.time() - chunk_start, 3),
+                           "cpu_time": round(telemetry.cpu_times()[0] -
+                                             chunk_cpu_start, 3),
+                           "worker_max_rss_so_far":
+                                telemetry.max_rss_so_far()[0]}
             results_queue.put((ctg_id, len(ctg_bubbles), num_long_bubbles,
                                num_empty, num_long_branch, aln_errors,
-                               mean_cov))
-            with bubbles_file_lock:
-                _output_bubbles(ctg_bubbles, bubbles_file_handle)
+                               mean_cov, chunk_stats))
 
             del profile
             del ctg_bubbles
@@ -88,75 +157,118 @@ def _thread_worker(aln_reader, contigs_info, err_mode,
 
 
 def make_bubbles(alignment_path, contigs_info, contigs_path,
-                 err_mode, num_proc, bubbles_out):
+                 err_mode, num_proc, bubbles_out, stage=None):
     """
-    The main function: takes an alignment and returns bubbles
+    The main function: takes an alignment and returns bubbles.
+    Binary bubbles are written into per-worker shards (bubbles_out.N),
+    the list of written files is returned along with the statistics
+    and the number of bubbles for each contig.
+    bubbles_out could also be an opened binary stream (e.g. a pipe to
+    the polishing binary) - then all workers write binary bubbles into it.
+    If telemetry stage is given, bubble counts are added to its record,
+    and a record is written for each contig chunk
     """
-    aln_reader = SynchronizedSamReader(alignment_path,
-                                       fp.read_sequence_dict(contigs_path),
-                                       cfg.vals["max_read_coverage"],
-                                       use_secondary=True)
-    manager = multiprocessing.Manager()
-    results_queue = manager.Queue()
-    error_queue = manager.Queue()
-
-    #making sure the main process catches SIGINT
-    orig_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    threads = []
-    bubbles_out_lock = multiprocessing.Lock()
-    bubbles_out_handle = open(bubbles_out, "w")
-    for _ in range(num_proc):
-        threads.append(multiprocessing.Process(target=_thread_worker,
-                                               args=(aln_reader, contigs_info,
-                                                     err_mode, results_queue,
-                                                     error_queue, bubbles_out_handle,
-                                                     bubbles_out_lock)))
-    signal.signal(signal.SIGINT, orig_sigint)
-
-    for t in threads:
-        t.start()
+    contigs_fasta = fp.IndexedFasta(contigs_path)
+    aln_reader = make_alignment_reader(alignment_path, contigs_fasta,
+                                      cfg.vals["max_read_coverage"],
+                                      use_secondary=True)
+    with PROCESS_START_LOCK:
+        manager = multiprocessing.Manager()
+    #the manager process inherits all open descriptors (e.g. the pipe
+    #to the polishing binary), so it is shut down even on errors
     try:
-        for t in threads:
-            t.join()
-            if t.exitcode == -9:
-                logger.error("Looks like the system ran out of memory")
-            if t.exitcode != 0:
-                raise Exception("One of the processes exited with code: {0}"
-                                .format(t.exitcode))
-    except KeyboardInterrupt:
-        for t in threads:
-            t.terminate()
-        raise
-
-    if not error_queue.empty():
-        raise error_queue.get()
-    aln_reader.close()
-
-    total_bubbles = 0
-    total_long_bubbles = 0
-    total_long_branches = 0
-    total_empty = 0
-    total_aln_errors = []
-    coverage_stats = {}
-
-    while not results_queue.empty():
-        (ctg_id, num_bubbles, num_long_bubbles,
-            num_empty, num_long_branch,
-            aln_errors, mean_coverage) = results_queue.get()
-        total_long_bubbles += num_long_bubbles
-        total_long_branches += num_long_branch
-        total_empty += num_empty
-        total_aln_errors.extend(aln_errors)
-        total_bubbles += num_bubbles
-        coverage_stats[ctg_id] = mean_coverage
-
-    mean_aln_error = sum(total_aln_errors) / (len(total_aln_errors) + 1)
-    logger.debug("Generated %d bubbles", total_bubbles)
-    logger.debug("Split %d long bubbles", total_long_bubbles)
-    logger.debug("Skipped %d empty bubbles", total_empty)
-    logger.debug("Skipped %d bubbles with long branches", total_long_branches)
-
-    return coverage_stats, mean_aln_error
+        results_queue = manager.Queue()
+        error_queue = manager.Queue()
+
+        #making sure the main process catches SIGINT
+        orig_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        threads = []
+        binary_output = cfg.vals["bubbles_format"] == "binary"
+        if hasattr(bubbles_out, "write"):
+            binary_output = True
+            bubbles_files = []
+            out_handles = [bubbles_out] * num_proc
+            out_locks = [multiprocessing.Lock()] * num_proc
+        elif binary_output:
+            bubbles_files = ["{0}.{1}".format(bubbles_out, i)
+                             for i in range(num_proc)]
+            out_handles = [open(f, "wb") for f in bubbles_files]
+            out_locks = [multiprocessing.Lock() for _ in range(num_proc)]
+        else:
+            bubbles_files = [bubbles_out]
+            out_handles = [open(bubbles_out, "w")] * num_proc
+            out_locks = [multiprocessing.Lock()] * num_proc
+        for out_handle, out_lock in zip(out_handles, out_locks):
+            threads.append(multiprocessing.Process(target=_thread_worker,
+                                                   args=(aln_reader, contigs_info,
+                                                         err_mode, results_queue,
+                                                         error_queue, out_handle,
+                                                         out_lock, binary_output)))
+        signal.signal(signal.SIGINT, orig_sigint)
+
+        with PROCESS_START_LOCK:
+            for t in threads:
+                t.start()
+        try:
+            for t in threads:
+                t.join()
+                if t.exitcode == -9:
+                    logger.error("Looks like the system ran out of memory")
+                if t.exitcode != 0:
+                    raise Exception("One of the processes exited with code: {0}"
+                                    .format(t.exitcode))
+        except (KeyboardInterrupt, Exception):
+            #remaining workers also hold the output handles
+            for t in threads:
+                t.terminate()
+            raise
+
+        if bubbles_files:
+            for out_handle in set(out_handles):
+                out_handle.close()
+        if not error_queue.empty():
+            raise error_queue.get()
+        aln_reader.log_utilization()
+        aln_reader.close()
+
+        total_bubbles = 0
+        total_long_bubbles = 0
+        total_long_branches = 0
+        total_empty = 0
+        total_aln_errors = []
+        coverage_stats = {}
+        contig_bubbles = {}
+
+        while not results_queue.empty():
+            (ctg_id, num_bubbles, num_long_bubbles,
+                num_empty, num_long_branch,
+                aln_errors, mean_coverage, chunk_stats) = results_queue.get()
+            if stage is not None:
+                stage.write_substage("bubbles_chunk", chunk_stats)
+            total_long_bubbles += num_long_bubbles
+            total_long_branches += num_long_branch
+            total_empty += num_empty
+            total_aln_errors.extend(aln_errors)
+            total_bubbles += num_bubbles
+            coverage_stats[ctg_id] = mean_coverage
+            contig_bubbles[ctg_id] = num_bubbles
+
+        mean_aln_error = sum(total_aln_errors) / (len(total_aln_errors) + 1)
+        logger.debug("Generated %d bubbles", total_bubbles)
+        logger.debug("Split %d long bubbles", total_long_bubbles)
+        logger.debug("Skipped %d empty bubbles", total_empty)
+        logger.debug("Skipped %d bubbles with long branches", total_long_branches)
+        if stage is not None:
+            stage.record.update({"bubbles": total_bubbles,
+                                 "long_bubbles": total_long_bubbles,
+                                 "empty_bubbles": total_empty,
+                                 "long_branches": total_long_branches,
+                                 "aln_error": round(mean_aln_error, 5)})
+
+        return coverage_stats, mean_aln_error, bubbles_files, contig_bubbles
+    finally:
+        manager.shutdown()
+        contigs_fasta.close()
 
 
 def _output_bubbles(bubbles, out_stream):
@@ -175,102 +287,189 @@ def _output_bubbles(bubbles, out_stream):
     out_stream.flush()
 
 
+def _output_bubbles_binary(bubbles, out_stream, compression):
+    """
+    Outputs list of bubbles as binary frames (see BUBBLES_MAGIC).
+    If compression > 0, payloads are compressed with zlib of that level
+    """
+    def write_frame(records):
+        payload = b"".join(records)
+        raw_size = len(payload)
+        flags = 0
+        if compression > 0:
+            payload = zlib.compress(payload, compression)
+            flags |= _FRAME_ZLIB
+        out_stream.write(_FRAME_HEADER.pack(BUBBLES_MAGIC, flags,
+                                            len(payload), raw_size))
+        out_stream.write(payload)
+
+    records = []
+    frame_size = 0
+    for bubble in bubbles:
+        contig_id = _BYTES(bubble.contig_id)
+        consensus = _BYTES(bubble.consensus)
+        records.append(_BUBBLE_HEADER.pack(len(contig_id), bubble.position,
+                                           len(bubble.branches),
+                                           len(consensus)))
+        records.append(contig_id)
+        records.append(consensus)
+        frame_size += _BUBBLE_HEADER.size + len(contig_id) + len(consensus)
+        for branch in bubble.branches:
+            branch = _BYTES(branch)
+            records.append(_BRANCH_HEADER.pack(len(branch)))
+            records.append(branch)
+            frame_size += _BRANCH_HEADER.size + len(branch)
+
+        if frame_size >= BUBBLES_FRAME_SIZE:
+            write_frame(records)
+            records = []
+            frame_size = 0
+
+    if records:
+        write_frame(records)
+    out_stream.flush()
+
+
 def _postprocess_bubbles(bubbles):
+    """
+    Filters bubbles and their branches in place. Returns the numbers of
+    empty bubbles and bubbles with long branches, and the mean number
+    of branches (before filtering)
+    """
     MAX_BUBBLE = cfg.vals["max_bubble_length"]
     MAX_BRANCHES = cfg.vals["max_bubble_branches"]
 
-    new_bubbles = []
+    num_bubbles = len(bubbles)
+    total_branches = 0
     long_branches = 0
     empty_bubbles = 0
+    num_kept = 0
     for bubble in bubbles:
-        if len(bubble.branches) == 0:
+        branches = bubble.branches
+        total_branches += len(branches)
+        if len(branches) == 0:
             #logger.debug("Empty bubble {0}".format(bubble.position))
             empty_bubbles += 1
             continue
 
-        new_branches = []
-        median_branch = (sorted(bubble.branches, key=len)[len(bubble.branches) // 2])
-        if len(median_branch) == 0:
+        median_branch = _get_median_branch(branches)
+        median_len = len(median_branch)
+        if median_len == 0:
             continue
 
         #Bubble is TOO BIIG, will not correct it (maybe at the next iteration)
-        if len(median_branch) > MAX_BUBBLE * 1.5:
-            new_branches = [median_branch]
+        if median_len > MAX_BUBBLE * 1.5:
+            branches[:] = [median_branch]
             long_branches += 1
 
         else:
-            for branch in bubble.branches:
-                incons_rate = abs(len(branch) - len(median_branch)) / len(median_branch)
-                if incons_rate < 0.5:
-                    if len(branch) == 0:
-                        branch = "A"
-                        #logger.debug("Zero branch")
-                    new_branches.append(branch)
-
-        if (abs(len(median_branch) - len(bubble.consensus)) > len(median_branch) // 2):
+            branches[:] = [b if b else "A" for b in branches
+                           if abs(len(b) - median_len) / median_len < 0.5]
+
+        if (abs(median_len - len(bubble.consensus)) > median_len // 2):
             bubble.consensus = median_branch
 
-        if len(new_branches) > MAX_BRANCHES:
-            new_branches = new_branches[:MAX_BRANCHES]
+        if len(branches) > MAX_BRANCHES:
+            del branches[MAX_BRANCHES:]
 
-        new_bubbles.append(Bubble(bubble.contig_id, bubble.position))
-        new_bubbles[-1].consensus = bubble.consensus
-        new_bubbles[-1].branches = new_branches
+        bubbles[num_kept] = bubble
+        num_kept += 1
 
-    return new_bubbles, empty_bubbles, long_branches
+    del bubbles[num_kept:]
+    mean_cov = total_branches // (num_bubbles + 1)
+    return empty_bubbles, long_branches, mean_cov
 
 
-def _is_solid_kmer(profile, position, err_mode):
+def _get_median_branch(branches):
+    """
+    Same as sorted(branches, key=len)[len(branches) // 2], but only
+    the branch lengths are sorted
+    """
+    lengths = sorted(map(len, branches))
+    median_len = lengths[len(branches) // 2]
+    #the branch with the same rank among the equal-length ones
+    rank = len(branches) // 2 - bisect_left(lengths, median_len)
+    for branch in branches:
+        if len(branch) == median_len:
+            if rank == 0:
+                return branch
+            rank -= 1
+
+
+def _get_solid_flags(profile, err_mode):
     """
-    Checks if the kmer at given position is solid
+    Flags solid kmers, greedily from left to right. The error rates are
+    computed once per position, and the scan jumps over positions
+    with high error rates
     """
     MISSMATCH_RATE = cfg.vals["err_modes"][err_mode]["solid_missmatch"]
     INS_RATE = cfg.vals["err_modes"][err_mode]["solid_indel"]
     SOLID_LEN = cfg.vals["solid_kmer_length"]
 
-    for i in range(position, position + SOLID_LEN):
-        if profile[i].coverage == 0:
-            return False
-        local_missmatch = (profile[i].num_missmatch +
-                           profile[i].num_deletions) / profile[i].coverage
-        local_ins = profile[i].num_inserts / profile[i].coverage
-        if local_missmatch > MISSMATCH_RATE or local_ins > INS_RATE:
-            return False
-    return True
+    prof_len = len(profile)
+    good_flags = bytearray([cov > 0 and (mm + dels) / cov <= MISSMATCH_RATE and
+                            ins / cov <= INS_RATE
+                            for cov, mm, dels, ins in
+                            zip(profile.coverage, profile.num_missmatch,
+                                profile.num_deletions, profile.num_inserts)])
 
+    solid_flags = bytearray(prof_len)
+    prof_pos = 0
+    while prof_pos < prof_len - SOLID_LEN:
+        bad_pos = good_flags.find(b"\0", prof_pos)
+        if bad_pos < 0:
+            bad_pos = prof_len
+        #consecutive solid kmers that fit before the next bad position
+        num_kmers = min((bad_pos - prof_pos) // SOLID_LEN,
+                        (prof_len - prof_pos - 1) // SOLID_LEN)
+        solid_end = prof_pos + num_kmers * SOLID_LEN
+        solid_flags[prof_pos : solid_end] = b"\1" * (solid_end - prof_pos)
+        prof_pos = bad_pos + 1
+
+    return solid_flags
 
-def _is_simple_kmer(profile, position):
+
+def _get_landmarks(profile, solid_flags):
     """
-    Checks if the kmer with center at the given position is simple
+    Flags the positions that start SIMPLE_LEN solid positions with
+    a simple kmer in the center (no homopolymers or dinucleotide repeats
+    around it). Masks are compared and combined for all positions at once
     """
     SIMPLE_LEN = cfg.vals["simple_kmer_length"]
-
-    extended_len = SIMPLE_LEN * 2
-    nucl_str = [p.nucl for p in profile[position - extended_len // 2 :
-                                        position + extended_len // 2]]
-
-    #single nucleotide homopolymers
-    for i in range(extended_len // 2 - SIMPLE_LEN // 2,
-                   extended_len // 2 + SIMPLE_LEN // 2 - 1):
-        if nucl_str[i] == nucl_str[i + 1]:
-            return False
-
-    #dinucleotide homopolymers
-    for shift in [0, 1]:
-        for i in range(SIMPLE_LEN - shift - 1):
-            pos = extended_len // 2 - SIMPLE_LEN + shift + i * 2
-            if (nucl_str[pos : pos + 2] == nucl_str[pos + 2 : pos + 4]):
-                return False
-
-    #trinucleotide homopolymers
-    #for shift in [0, 1, 2]:
-    #    for i in xrange(SIMPLE_LEN - shift - 1):
-    #        pos = shift + i * 3
-    #        if (nucl_str[pos : pos + 3] == nucl_str[pos + 3 : pos + 6]):
-    #            #logger.debug("tri" + "".join(nucl_str))
-    #            return False
-
-    return True
+    half_len = SIMPLE_LEN // 2
+
+    prof_len = len(profile)
+    nucl = bytes(profile.nucl)
+    #homopolymer: nucl[i] == nucl[i + 1],
+    #dinucleotide repeat: nucl[i : i + 2] == nucl[i + 2 : i + 4]
+    same_next = bytes_to_int(xor_bytes(nucl[:-1], nucl[1:])
+                              .translate(_ZERO_FLAGS) + b"\0")
+    same_second = bytes_to_int(xor_bytes(nucl[:-2], nucl[2:])
+                                .translate(_ZERO_FLAGS) + b"\0\0")
+    dinucl_repeat = same_second & (same_second << 8)
+    not_solid = bytes_to_int(bytes(solid_flags).translate(_ZERO_FLAGS))
+
+    #windows are relative to the landmark start position
+    bad_flags = (_window_any(not_solid, 0, SIMPLE_LEN - 1) |
+                 _window_any(same_next, 0, 2 * half_len - 2) |
+                 _window_any(dinucl_repeat, half_len - SIMPLE_LEN,
+                             half_len + SIMPLE_LEN - 4))
+    bad_flags &= (1 << (8 * prof_len)) - 1
+    return int_to_bytes(bad_flags, prof_len).translate(_ZERO_FLAGS)
+
+
+def _window_any(flags, first, last):
+    """
+    Given flags packed into integer (one byte per position),
+    flags position i if any of [i + first, i + last] is flagged
+    """
+    result = 0
+    for shift in range(first, last + 1):
+        if shift >= 0:
+            result |= flags << (8 * shift)
+        else:
+            result |= flags >> (-8 * shift)
+    return result
 
 
 def _compute_profile(alignment, platform, genome_len):
@@ -281,42 +480,79 @@ def _compute_profile(alignment, platform, genome_len):
     min_aln_len = cfg.vals["min_polish_aln_len"]
     aln_errors = []
     #filtered = 0
-    profile = [ProfileInfo() for _ in range(genome_len)]
+    profile = ProfileInfo(genome_len)
+    #coverage is accumulated as a difference array
+    cov_diff = [0 for _ in range(genome_len + 1)]
     for aln in alignment:
-        if aln.err_rate > max_aln_err or len(aln.qry_seq) < min_aln_len:
+        if aln.err_rate > max_aln_err:
             #filtered += 1
             continue
+        #gapped sequences are rebuilt on each access, so take them once
+        aln_qry, aln_trg = aln.qry_seq, aln.trg_seq
+        if len(aln_qry) < min_aln_len:
+            continue
 
         aln_errors.append(aln.err_rate)
 
-        qry_seq = shift_gaps(aln.trg_seq, aln.qry_seq)
-        trg_seq = shift_gaps(qry_seq, aln.trg_seq)
+        qry_seq = shift_gaps(aln_trg, aln_qry)
+        trg_seq = shift_gaps(qry_seq, aln_trg)
+        _add_to_profile(profile, cov_diff, aln.trg_start, trg_seq, qry_seq)
 
-        trg_pos = aln.trg_start
-        for trg_nuc, qry_nuc in zip(trg_seq, qry_seq):
-            if trg_nuc == "-":
-                trg_pos -= 1
-            if trg_pos >= genome_len:
-                trg_pos -= genome_len
-
-            prof_elem = profile[trg_pos]
-            if trg_nuc == "-":
-                prof_elem.num_inserts += 1
-            else:
-                prof_elem.nucl = trg_nuc
-                prof_elem.coverage += 1
-
-                if qry_nuc == "-":
-                    prof_elem.num_deletions += 1
-                elif trg_nuc != qry_nuc:
-                    prof_elem.num_missmatch += 1
-
-            trg_pos += 1
+    profile.coverage = array("i", accumulate(cov_diff[:-1]))
 
     #logger.debug("Filtered: {0} out of {1}".format(filtered, len(alignment)))
     return profile, aln_errors
 
 
+def _add_to_profile(profile, cov_diff, trg_start, trg_seq, qry_seq):
+    """
+    Adds a gap-shifted alignment to the profile. Each aligned contig
+    position is covered, so only the columns where the sequences differ
+    are visited individually
+    """
+    genome_len = len(profile)
+    trg_bytes = _BYTES(trg_seq)
+    trg_nucl = trg_bytes.replace(b"-", b"")
+
+    #the alignment could go over the end of a circular contig
+    trg_end = trg_start + len(trg_nucl)
+    segments = [(trg_start, min(trg_end, genome_len), 0)]
+    if trg_end > genome_len:
+        segments.append((0, trg_end - genome_len, genome_len - trg_start))
+    for seg_start, seg_end, seg_offset in segments:
+        profile.nucl[seg_start : seg_end] = \
+            trg_nucl[seg_offset : seg_offset + seg_end - seg_start]
+        cov_diff[seg_start] += 1
+        cov_diff[seg_end] -= 1
+
+    trg_masked = trg_bytes.translate(_TRG_GAP_TO_ZERO)
+    qry_bytes = _BYTES(qry_seq)
+    diff = xor_bytes(trg_masked, qry_bytes)
+
+    num_inserts = profile.num_inserts
+    num_deletions = profile.num_deletions
+    num_missmatch = profile.num_missmatch
+    inserts_before = 0
+    for match in _NONZERO_RE.finditer(diff):
+        col = match.start()
+        if trg_seq[col] == "-":
+            #inserted bases are attributed to the previous position
+            #(-1 if the alignment starts with an insertion)
+            inserts_before += 1
+            trg_pos = trg_start + col - inserts_before
+            if trg_pos >= genome_len:
+                trg_pos -= genome_len
+            num_inserts[trg_pos] += 1
+        else:
+            trg_pos = trg_start + col - inserts_before
+            if trg_pos >= genome_len:
+                trg_pos -= genome_len
+            if qry_seq[col] == "-":
+                num_deletions[trg_pos] += 1
+            else:
+                num_missmatch[trg_pos] += 1
+
+
 def _get_partition(profile, err_mode):
     """
     Partitions genome into sub-alignments at solid regions / simple kmers
@@ -326,35 +562,32 @@ def _get_partition(profile, err_mode):
     SIMPLE_LEN = cfg.vals["simple_kmer_length"]
     MAX_BUBBLE = cfg.vals["max_bubble_length"]
 
-    solid_flags = [False for _ in range(len(profile))]
-    prof_pos = 0
-    while prof_pos < len(profile) - SOLID_LEN:
-        if _is_solid_kmer(profile, prof_pos, err_mode):
-            for i in range(prof_pos, prof_pos + SOLID_LEN):
-                solid_flags[i] = True
-            prof_pos += SOLID_LEN
-        else:
-            prof_pos += 1
+    prof_len = len(profile)
+    solid_flags = _get_solid_flags(profile, err_mode)
+    landmarks = _get_landmarks(profile, solid_flags)
 
     partition = []
     prev_partition = SOLID_LEN
 
     long_bubbles = 0
     prof_pos = SOLID_LEN
-    while prof_pos < len(profile) - SOLID_LEN:
-        cur_partition = prof_pos + SIMPLE_LEN // 2
-        landmark = (all(solid_flags[prof_pos : prof_pos + SIMPLE_LEN]) and
-                    _is_simple_kmer(profile, cur_partition))
-
-        if prof_pos - prev_partition > MAX_BUBBLE:
+    while prof_pos < prof_len - SOLID_LEN:
+        #next landmark, unless the bubble gets too long before it
+        forced_pos = max(prof_pos, prev_partition + MAX_BUBBLE + 1)
+        landmark_pos = landmarks.find(b"\1", prof_pos,
+                                      min(forced_pos, prof_len - SOLID_LEN))
+        if landmark_pos >= 0:
+            prof_pos = landmark_pos
+        elif forced_pos < prof_len - SOLID_LEN:
+            prof_pos = forced_pos
             long_bubbles += 1
-
-        if landmark or prof_pos - prev_partition > MAX_BUBBLE:
-            partition.append(cur_partition)
-            prev_partition = cur_partition
-            prof_pos += SOLID_LEN
         else:
-            prof_pos += 1
+            break
+
+        cur_partition = prof_pos + SIMPLE_LEN // 2
+        partition.append(cur_partition)
+        prev_partition = cur_partition
+        prof_pos += SOLID_LEN
 
     #logger.debug("Partitioned into {0} segments".format(len(partition) + 1))
     #logger.debug("Long bubbles: {0}".format(long_bubbles))
@@ -362,6 +595,46 @@ def _get_partition(profile, err_mode):
     return partition, long_bubbles
 
 
+def _get_cut_columns(trg_bytes, trg_start, cut_positions, genome_len):
+    """
+    Returns (alignment column, contig position) for each non-gap target
+    column (except the first one) aligned to one of the sorted cut
+    positions. Columns are found from the non-gap index using the
+    cumulative lengths of the target gap runs, without visiting
+    the alignment columns
+    """
+    #non-gap index of the column following each gap run,
+    #and the total length of the gap runs up to it
+    run_nongap_before = []
+    run_gaps_total = [0]
+    for match in _GAP_RUN_RE.finditer(trg_bytes):
+        run_nongap_before.append(match.start() - run_gaps_total[-1])
+        run_gaps_total.append(run_gaps_total[-1] + match.end() - match.start())
+    trg_len = len(trg_bytes) - run_gaps_total[-1]
+
+    cut_columns = []
+    #the alignment could go over the end of a circular contig
+    lap_start = trg_start - trg_start % genome_len
+    while lap_start < trg_start + trg_len:
+        #the first column is only cut at the contig start
+        first_cut = bisect(cut_positions, trg_start - lap_start)
+        if lap_start == trg_start:
+            first_cut = 0
+        for cut_pos in cut_positions[first_cut:]:
+            nongap_idx = lap_start + cut_pos - trg_start
+            if nongap_idx >= trg_len:
+                break
+            col = (nongap_idx +
+                   run_gaps_total[bisect(run_nongap_before, nongap_idx)])
+            cut_columns.append((col, cut_pos))
+        lap_start += genome_len
+    return cut_columns
+
+
+def _ungapped_branch(qry_bytes):
+    return _STR(fp.to_acgt_bytes(qry_bytes.replace(b"-", b"")))
+
+
 def _get_bubble_seqs(alignment, platform, profile, partition, contig_info):
     """
     Given genome landmarks, forms bubble sequences
@@ -374,14 +647,15 @@ def _get_bubble_seqs(alignment, platform, profile, partition, contig_info):
     ext_partition = [0] + partition + [contig_info.length]
     for p_left, p_right in zip(ext_partition[:-1], ext_partition[1:]):
         bubbles.append(Bubble(contig_info.id, p_left))
-        consensus = [p.nucl for p in profile[p_left : p_right]]
-        bubbles[-1].consensus = "".join(consensus)
+        consensus = bytes(profile.nucl[p_left : p_right]).replace(b"\0", b"")
+        bubbles[-1].consensus = _STR(consensus)
 
+    #branches are cut at every partition boundary and at the contig start
+    cut_positions = sorted(set(partition) | set([0]))
     for aln in alignment:
         #if aln.err_rate > max_aln_err: continue
 
         bubble_id = bisect(partition, aln.trg_start % contig_info.length)
-        next_bubble_start = ext_partition[bubble_id + 1]
         chromosome_start = (bubble_id == 0 and
                             not contig_info.type == "circular")
         chromosome_end = (aln.trg_end > partition[-1] and not
@@ -389,27 +663,20 @@ def _get_bubble_seqs(alignment, platform, profile, partition, contig_info):
 
         branch_start = None
         first_segment = True
-        trg_pos = aln.trg_start
-        for i, trg_nuc in enumerate(aln.trg_seq):
-            if trg_nuc == "-":
-                continue
-            if trg_pos >= contig_info.length:
-                trg_pos -= contig_info.length
-
-            if trg_pos >= next_bubble_start or trg_pos == 0:
-                if not first_segment or chromosome_start:
-                    branch_seq = fp.to_acgt(aln.qry_seq[branch_start : i].replace("-", ""))
-                    bubbles[bubble_id].branches.append(branch_seq)
-
-                first_segment = False
-                bubble_id = bisect(partition, trg_pos)
-                next_bubble_start = ext_partition[bubble_id + 1]
-                branch_start = i
-
-            trg_pos += 1
+        qry_bytes = _BYTES(aln.qry_seq)
+        for col, trg_pos in _get_cut_columns(_BYTES(aln.trg_seq),
+                                             aln.trg_start, cut_positions,
+                                             contig_info.length):
+            if not first_segment or chromosome_start:
+                bubbles[bubble_id].branches.append(
+                        _ungapped_branch(qry_bytes[branch_start : col]))
+
+            first_segment = False
+            bubble_id = bisect(partition, trg_pos)
+            branch_start = col
 
         if chromosome_end:
-            branch_seq = fp.to_acgt(aln.qry_seq[branch_start:].replace("-", ""))
-            bubbles[-1].branches.append(branch_seq)
+            bubbles[-1].branches.append(
+                    _ungapped_branch(qry_bytes[branch_start:]))
 
     return bubbles
@@ -8,7 +8,10 @@ Quick and dirty alignment consensus
 
 from __future__ import absolute_import
 from __future__ import division
+import sys
+import re
 import logging
+from array import array
 from collections import defaultdict
 from flye.six.moves import range
 from flye.six import itervalues
@@ -17,14 +20,40 @@ import multiprocessing
 import signal
 import traceback
 
-from flye.polishing.alignment import shift_gaps, get_uniform_alignments
-from flye.utils.sam_parser import SynchronizedSamReader
+from flye.polishing.alignment import (shift_gaps, get_uniform_alignments,
+                                      xor_bytes)
+from flye.utils.sam_parser import make_alignment_reader
 import flye.config.py_cfg as cfg
 import flye.utils.fasta_parser as fp
 from flye.six.moves import zip
 
+if sys.version_info < (3, 0):
+    _STR = lambda x: x
+    _BYTES = lambda x: x
+else:
+    _STR = bytes.decode
+    _BYTES = str.encode
+
+try:
+    from itertools import accumulate
+except ImportError:
+    def accumulate(iterable):
+        total = 0
+        for x in iterable:
+            total += x
+            yield total
+
 logger = logging.getLogger()
 
+_GAP_RUN_RE = re.compile(b"-+")
+_NONZERO_RE = re.compile(b"[^\0]")
+#columns of the array profile: deletion, then nucleotides in sorted order,
+#so that the first maximum is the same as for the sorted dict keys
+_PROFILE_NUCL = "-ACGT"
+_NUCL_SLOT = [-1] * 256
+for _slot, _nucl in enumerate(_PROFILE_NUCL):
+    _NUCL_SLOT[ord(_nucl)] = _slot
+
 class Profile(object):
     __slots__ = ("insertions", "matches", "nucl")
 
@@ -33,6 +62,31 @@ class Profile(object):
         self.matches = defaultdict(int)
         self.nucl = "-"
 
+
+class ArrayProfile(object):
+    """
+    Compact alignment pileup over the contig. Matches to the reference
+    are only counted in coverage, other events are in (L x 5) integer
+    array of "-ACGT" counts. Aligned target gaps are attributed to the
+    previous position: gap-gap columns are counted separately,
+    insertions are stored in a table indexed by position
+    """
+    __slots__ = ("nucl", "coverage", "counts", "gap_gaps",
+                 "insertions", "other_nucl")
+
+    def __init__(self, genome_len):
+        self.nucl = bytearray(genome_len)
+        self.coverage = array("i", [0]) * genome_len
+        self.counts = array("i", [0]) * (genome_len * len(_PROFILE_NUCL))
+        self.gap_gaps = array("i", [0]) * genome_len
+        #position -> list of (read id, inserted sequence)
+        self.insertions = {}
+        #position -> counts of query symbols other than "-ACGT"
+        self.other_nucl = {}
+
+    def __len__(self):
+        return len(self.nucl)
+
 def _thread_worker(aln_reader, contigs_info, platform, results_queue,
                    error_queue):
     try:
@@ -41,9 +95,16 @@ def _thread_worker(aln_reader, contigs_info, platform, results_queue,
             if ctg_id is None:
                 break
 
-            profile, aln_errors = _contig_profile(ctg_aln, platform,
-                                                  contigs_info[ctg_id].length)
-            sequence = _flatten_profile(profile)
+            if cfg.vals["consensus_profile"] == "array":
+                profile, aln_errors = \
+                    _contig_array_profile(ctg_aln, platform,
+                                          contigs_info[ctg_id].length)
+                sequence = _flatten_array_profile(profile)
+            else:
+                profile, aln_errors = \
+                    _contig_profile(ctg_aln, platform,
+                                    contigs_info[ctg_id].length)
+                sequence = _flatten_profile(profile)
             results_queue.put((ctg_id, sequence, aln_errors))
 
     except Exception as e:
@@ -57,42 +118,46 @@ def get_consensus(alignment_path, contigs_path, contigs_info, num_proc,
     """
     Main function
     """
-    aln_reader = SynchronizedSamReader(alignment_path,
-                                       fp.read_sequence_dict(contigs_path),
-                                       max_coverage=cfg.vals["max_read_coverage"],
-                                       use_secondary=True)
-    manager = multiprocessing.Manager()
-    results_queue = manager.Queue()
-    error_queue = manager.Queue()
-
-    #making sure the main process catches SIGINT
-    orig_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    threads = []
-    for _ in range(num_proc):
-        threads.append(multiprocessing.Process(target=_thread_worker,
-                                               args=(aln_reader, contigs_info,
-                                                     platform, results_queue,
-                                                     error_queue)))
-    signal.signal(signal.SIGINT, orig_sigint)
-
-    for t in threads:
-        t.start()
+    contigs_fasta = fp.IndexedFasta(contigs_path)
     try:
-        for t in threads:
-            t.join()
-            if t.exitcode == -9:
-                logger.error("Looks like the system ran out of memory")
-            if t.exitcode != 0:
-                raise Exception("One of the processes exited with code: {0}"
-                                .format(t.exitcode))
-    except KeyboardInterrupt:
-        for t in threads:
-            t.terminate()
-        raise
+        aln_reader = make_alignment_reader(alignment_path, contigs_fasta,
+                                           cfg.vals["max_read_coverage"],
+                                           use_secondary=True)
+        manager = multiprocessing.Manager()
+        results_queue = manager.Queue()
+        error_queue = manager.Queue()
+
+        #making sure the main process catches SIGINT
+        orig_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        threads = []
+        for _ in range(num_proc):
+            threads.append(multiprocessing.Process(target=_thread_worker,
+                                                   args=(aln_reader, contigs_info,
+                                                         platform, results_queue,
+                                                         error_queue)))
+        signal.signal(signal.SIGINT, orig_sigint)
 
-    if not error_queue.empty():
-        raise error_queue.get()
-    aln_reader.close()
+        for t in threads:
+            t.start()
+        try:
+            for t in threads:
+                t.join()
+                if t.exitcode == -9:
+                    logger.error("Looks like the system ran out of memory")
+                if t.exitcode != 0:
+                    raise Exception("One of the processes exited with code: {0}"
+                                    .format(t.exitcode))
+        except KeyboardInterrupt:
+            for t in threads:
+                t.terminate()
+            raise
+
+        if not error_queue.empty():
+            raise error_queue.get()
+        aln_reader.log_utilization()
+        aln_reader.close()
+    finally:
+        contigs_fasta.close()
 
     out_fasta = {}
     total_aln_errors = []
@@ -125,8 +190,9 @@ def _contig_profile(alignment, platform, genome_len):
 
         #after gap shifting it is possible that
         #two gaps are aligned against each other
-        qry_seq = shift_gaps(aln.trg_seq, aln.qry_seq)
-        trg_seq = shift_gaps(qry_seq, aln.trg_seq)
+        aln_trg = aln.trg_seq
+        qry_seq = shift_gaps(aln_trg, aln.qry_seq)
+        trg_seq = shift_gaps(qry_seq, aln_trg)
 
         trg_pos = aln.trg_start
         for trg_nuc, qry_nuc in zip(trg_seq, qry_seq):
@@ -186,3 +252,151 @@ def _flatten_profile(profile):
             growing_seq.append(max_insert)
 
     return "".join(growing_seq)
+
+
+def _contig_array_profile(alignment, platform, genome_len):
+    """
+    Computes alignment profile, same as _contig_profile,
+    but stored in ArrayProfile
+    """
+    alignment = get_uniform_alignments(alignment, genome_len)
+
+    aln_errors = []
+    profile = ArrayProfile(genome_len)
+    cov_diff = [0 for _ in range(genome_len + 1)]
+    for aln in alignment:
+        aln_errors.append(aln.err_rate)
+
+        aln_trg = aln.trg_seq
+        qry_seq = shift_gaps(aln_trg, aln.qry_seq)
+        trg_seq = shift_gaps(qry_seq, aln_trg)
+        _add_to_array_profile(profile, cov_diff, aln.qry_id, aln.trg_start,
+                              _BYTES(trg_seq), _BYTES(qry_seq))
+
+    profile.coverage = array("i", accumulate(cov_diff[:-1]))
+    return profile, aln_errors
+
+
+def _add_to_array_profile(profile, cov_diff, qry_id, trg_start,
+                          trg_bytes, qry_bytes):
+    """
+    Adds a gap-shifted alignment to the profile. Target gap runs
+    are processed as a whole, and among the rest of the columns only
+    those where query differs from target are visited individually
+    """
+    genome_len = len(profile)
+    insertions = profile.insertions
+    gap_gaps = profile.gap_gaps
+
+    qry_parts = []
+    prev_end = 0
+    gaps_before = 0
+    for match in _GAP_RUN_RE.finditer(trg_bytes):
+        run_start, run_end = match.span()
+        qry_parts.append(qry_bytes[prev_end : run_start])
+        prev_end = run_end
+
+        trg_pos = (trg_start + run_start - gaps_before - 1) % genome_len
+        gaps_before += run_end - run_start
+        ins_seq = qry_bytes[run_start : run_end].replace(b"-", b"")
+        if len(ins_seq) < run_end - run_start:
+            gap_gaps[trg_pos] += run_end - run_start - len(ins_seq)
+        if ins_seq:
+            insertions.setdefault(trg_pos, []).append((qry_id, _STR(ins_seq)))
+    qry_parts.append(qry_bytes[prev_end:])
+
+    trg_nucl = trg_bytes.replace(b"-", b"")
+    qry_nucl = bytearray(b"".join(qry_parts))
+
+    #the alignment could go over the end of a circular contig
+    seg_start = trg_start % genome_len
+    seg_offset = 0
+    while seg_offset < len(trg_nucl):
+        seg_end = min(genome_len, seg_start + len(trg_nucl) - seg_offset)
+        profile.nucl[seg_start : seg_end] = \
+            trg_nucl[seg_offset : seg_offset + seg_end - seg_start]
+        cov_diff[seg_start] += 1
+        cov_diff[seg_end] -= 1
+        seg_offset += seg_end - seg_start
+        seg_start = 0
+
+    counts = profile.counts
+    num_slots = len(_PROFILE_NUCL)
+    for match in _NONZERO_RE.finditer(xor_bytes(trg_nucl, bytes(qry_nucl))):
+        for col in range(match.start(), match.end()):
+            trg_pos = (trg_start + col) % genome_len
+            slot = _NUCL_SLOT[qry_nucl[col]]
+            if slot >= 0:
+                counts[trg_pos * num_slots + slot] += 1
+            else:
+                other = profile.other_nucl.setdefault(trg_pos,
+                                                      defaultdict(int))
+                other[chr(qry_nucl[col])] += 1
+
+
+def _flatten_array_profile(profile):
+    """
+    Same as _flatten_profile, but for ArrayProfile
+    """
+    growing_seq = []
+    nucl = profile.nucl
+    coverage = profile.coverage
+    counts = profile.counts
+    gap_gaps = profile.gap_gaps
+    insertions = profile.insertions
+    other_nucl = profile.other_nucl
+    num_slots = len(_PROFILE_NUCL)
+    slots = range(num_slots)
+
+    for pos in range(len(profile)):
+        pos_counts = counts[pos * num_slots : (pos + 1) * num_slots]
+        explicit_num = sum(pos_counts)
+        del_num = pos_counts[0] + gap_gaps[pos]
+        pos_insertions = insertions.get(pos)
+        match_and_del_num = coverage[pos] + gap_gaps[pos]
+
+        pos_other = other_nucl.get(pos)
+        if pos_other:
+            explicit_num += sum(itervalues(pos_other))
+
+        #all aligned bases match the reference
+        if not explicit_num and not del_num and not pos_insertions:
+            if coverage[pos]:
+                growing_seq.append(chr(nucl[pos]))
+            continue
+
+        ref_slot = _NUCL_SLOT[nucl[pos]]
+        if ref_slot < 0 or pos_other:
+            pos_matches = defaultdict(int, pos_other or {})
+            for slot in slots:
+                if pos_counts[slot]:
+                    pos_matches[_PROFILE_NUCL[slot]] += pos_counts[slot]
+            if coverage[pos] > explicit_num:
+                pos_matches[chr(nucl[pos])] += coverage[pos] - explicit_num
+            pos_matches["-"] = del_num
+            match_and_del_num = sum(itervalues(pos_matches))
+            max_match = max(sorted(pos_matches), key=pos_matches.get)
+        else:
+            pos_counts[0] = del_num
+            pos_counts[ref_slot] += coverage[pos] - explicit_num
+            max_match = _PROFILE_NUCL[max(slots, key=pos_counts.__getitem__)]
+
+        is_deletion = max_match == "-" or del_num > match_and_del_num // 3
+
+        is_insertion = False
+        if pos_insertions:
+            read_inserts = defaultdict(str)
+            for read_id, ins_seq in pos_insertions:
+                read_inserts[read_id] += ins_seq
+            ins_group = defaultdict(int)
+            for ins_str in itervalues(read_inserts):
+                ins_group[ins_str] += 1
+            max_insert = max(sorted(ins_group), key=ins_group.get)
+            is_insertion = len(read_inserts) > match_and_del_num // 3
+
+        if not is_deletion:
+            growing_seq.append(max_match)
+        if is_insertion:
+            growing_seq.append(max_insert)
+
+    return "".join(growing_seq)
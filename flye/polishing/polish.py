@@ -11,20 +11,36 @@ from __future__ import division
 import logging
 import subprocess
 import os
+import sys
+import shutil
+import signal
+import threading
+import multiprocessing
 from collections import defaultdict
 
 from flye.polishing.alignment import (make_alignment, get_contigs_info,
                                       merge_chunks, split_into_chunks)
-from flye.utils.sam_parser import SynchronizedSamReader
+from flye.utils.sam_parser import read_paf, read_mapped_reads
 from flye.polishing.bubbles import make_bubbles
 import flye.utils.fasta_parser as fp
-from flye.utils.utils import which
+from flye.utils.utils import which, check_call, PROCESS_START_LOCK
 import flye.config.py_cfg as cfg
+from flye.utils.telemetry import Telemetry, files_size
 from flye.six import iteritems
-from flye.six.moves import range
+from flye.six.moves import range, map, queue
+
+
+if sys.version_info < (3, 0):
+    _STR = lambda x: x
+else:
+    _STR = bytes.decode
 
 
 POLISH_BIN = "flye-modules"
+#number of contig groups polished concurrently
+POLISH_PIPELINE_DEPTH = 2
+#how often (in seconds) the group processes are checked for failures
+GROUP_POLL_INTERVAL = 5
 
 logger = logging.getLogger()
 
@@ -63,81 +79,390 @@ def polish(contig_seqs, read_seqs, work_dir, num_iters, num_threads, error_mode,
     hopo_matrix = os.path.join(cfg.vals["pkg_root"],
                                cfg.vals["err_modes"][error_mode]["hopo_matrix"])
     stats_file = os.path.join(work_dir, "contigs_stats.txt")
+    telemetry_file = None
+    if cfg.vals["polish_telemetry"]:
+        telemetry_file = os.path.join(work_dir, "polishing_telemetry.jsonl")
+    #records of the failed stages are also flushed
+    with Telemetry(telemetry_file) as telemetry:
+        if cfg.vals["polish_group_size"] and num_iters > 1:
+            polished_file, contig_lengths, coverage_stats = \
+                _polish_pipelined(contig_seqs, read_seqs, work_dir, num_iters,
+                                  num_threads, error_mode, subs_matrix,
+                                  hopo_matrix, output_progress, telemetry)
+        else:
+            polished_file, contig_lengths, coverage_stats = \
+                _polish_iterations(contig_seqs, read_seqs, work_dir, num_iters,
+                                   num_threads, error_mode, subs_matrix,
+                                   hopo_matrix, output_progress, telemetry)
+
+    #merge information from chunks
+    contig_lengths = merge_chunks(contig_lengths, fold_function=sum)
+    coverage_stats = merge_chunks(coverage_stats,
+                                  fold_function=lambda l: sum(l) // len(l))
+
+    with open(stats_file, "w") as f:
+        f.write("#seq_name\tlength\tcoverage\n")
+        for ctg_id in contig_lengths:
+            f.write("{0}\t{1}\t{2}\n".format(ctg_id,
+                    contig_lengths[ctg_id], coverage_stats[ctg_id]))
+
+    if not output_progress:
+        logger.disabled = logger_state
 
+    return polished_file, stats_file
+
+
+def _polish_iterations(contig_seqs, read_seqs, work_dir, num_iters, num_threads,
+                       error_mode, subs_matrix, hopo_matrix, output_progress,
+                       telemetry, iterations=None, coverage_stats=None,
+                       keep_alignment=False):
+    """
+    Runs polishing iterations one after another. Returns the last polished
+    file along with chunk lengths and coverage. Only the given iterations
+    are run (all by default), coverage_stats are from the previous one
+    """
     prev_assembly = contig_seqs
     contig_lengths = None
-    coverage_stats = None
-    for i in range(num_iters):
+    if iterations is None:
+        iterations = range(num_iters)
+    for i in iterations:
         logger.info("Polishing genome (%d/%d)", i + 1, num_iters)
-
-        #split into 1Mb chunks to reduce RAM usage
-        #slightly vary chunk size between iterations
-        CHUNK_SIZE = 1000000 - (i % 2) * 100000
-        chunks_file = os.path.join(work_dir, "chunks_{0}.fasta".format(i + 1))
-        chunks = split_into_chunks(fp.read_sequence_dict(prev_assembly),
-                                       CHUNK_SIZE)
-        fp.write_fasta_dict(chunks, chunks_file)
-
-        ####
-        logger.info("Running minimap2")
-        alignment_file = os.path.join(work_dir, "minimap_{0}.bam".format(i + 1))
+        iter_telemetry = telemetry.with_fields(iteration=i + 1)
+        with iter_telemetry.stage("iteration") as iter_stage:
+            result = _polish_iteration(i, prev_assembly, read_seqs, work_dir,
+                                       num_threads, error_mode, subs_matrix,
+                                       hopo_matrix, output_progress,
+                                       coverage_stats, iter_telemetry,
+                                       keep_alignment)
+            if result is None:
+                logger.info("No reads were aligned during polishing")
+                polished_file = os.path.join(work_dir,
+                                             "polished_{0}.fasta".format(i + 1))
+                open(polished_file, "w")
+                return polished_file, {}, {}
+
+            prev_assembly, contig_lengths, coverage_stats = result
+            iter_stage.record["chunks"] = len(contig_lengths)
+            iter_stage.record["polished_length"] = sum(contig_lengths.values())
+
+    return prev_assembly, contig_lengths, coverage_stats
+
+
+def _polish_iteration(i, prev_assembly, read_seqs, work_dir, num_threads,
+                      error_mode, subs_matrix, hopo_matrix, output_progress,
+                      coverage_stats, telemetry, keep_alignment=False):
+    """
+    Runs a single polishing iteration. Returns the polished file along
+    with chunk lengths and coverage, or None if no reads were aligned.
+    If keep_alignment is set, the alignment file is not removed
+    """
+    #split into 1Mb chunks to reduce RAM usage
+    #slightly vary chunk size between iterations
+    CHUNK_SIZE = 1000000 - (i % 2) * 100000
+    #after the first iteration, chunks could be sized by the expected
+    #number of aligned bases, using the coverage from the previous one
+    contig_coverage = None
+    chunk_aligned_bases = None
+    if coverage_stats and cfg.vals["polish_chunk_aligned_bases"]:
+        contig_coverage = merge_chunks(coverage_stats,
+                                       fold_function=lambda l: sum(l) // len(l))
+        chunk_aligned_bases = (cfg.vals["polish_chunk_aligned_bases"] *
+                               CHUNK_SIZE // 1000000)
+    chunks_file = os.path.join(work_dir, "chunks_{0}.fasta".format(i + 1))
+    chunks = split_into_chunks(fp.read_sequence_dict_bytes(prev_assembly),
+                               CHUNK_SIZE, contig_coverage,
+                               chunk_aligned_bases)
+    fp.write_fasta_dict(chunks, chunks_file)
+
+    ####
+    logger.info("Running minimap2")
+    alignment_file = os.path.join(work_dir, "minimap_{0}.bam".format(i + 1))
+    with telemetry.stage("minimap2") as stage:
         make_alignment(chunks_file, read_seqs, num_threads,
                        work_dir, error_mode, alignment_file,
                        reference_mode=True, sam_output=True)
-
-        #####
+        stage.record["bytes_in"] = files_size([chunks_file] + list(read_seqs))
+        stage.record["bytes_out"] = files_size([alignment_file])
+
+    #####
+    contigs_info = get_contigs_info(chunks_file)
+    polished_file = os.path.join(work_dir, "polished_{0}.fasta".format(i + 1))
+    if cfg.vals["bubbles_streaming"]:
+        logger.info("Separating alignment into bubbles and correcting them")
+        with telemetry.stage("bubbles_streaming") as stage:
+            coverage_stats, mean_aln_error, polished_fasta, polished_lengths = \
+                _polish_streaming(alignment_file, contigs_info, chunks_file,
+                                  error_mode, num_threads, subs_matrix,
+                                  hopo_matrix, output_progress, stage)
+            stage.record["bytes_in"] = files_size([alignment_file])
+        logger.info("Alignment error rate: %f", mean_aln_error)
+        bubbles_files = []
+        consensus_out = None
+        no_bubbles = not polished_fasta
+    else:
         logger.info("Separating alignment into bubbles")
-        contigs_info = get_contigs_info(chunks_file)
+        bubbles_ext = "bin" if cfg.vals["bubbles_format"] == "binary" else "fasta"
         bubbles_file = os.path.join(work_dir,
-                                    "bubbles_{0}.fasta".format(i + 1))
-        coverage_stats, mean_aln_error = \
-            make_bubbles(alignment_file, contigs_info, chunks_file,
-                         error_mode, num_threads,
-                         bubbles_file)
-
+                                    "bubbles_{0}.{1}".format(i + 1, bubbles_ext))
+        with telemetry.stage("bubbles") as stage:
+            coverage_stats, mean_aln_error, bubbles_files, chunk_bubbles = \
+                make_bubbles(alignment_file, contigs_info, chunks_file,
+                             error_mode, num_threads,
+                             bubbles_file, stage)
+            stage.record["bytes_in"] = files_size([alignment_file])
+            stage.record["bytes_out"] = files_size(bubbles_files)
         logger.info("Alignment error rate: %f", mean_aln_error)
         consensus_out = os.path.join(work_dir, "consensus_{0}.fasta".format(i + 1))
-        polished_file = os.path.join(work_dir, "polished_{0}.fasta".format(i + 1))
-        if os.path.getsize(bubbles_file) == 0:
-            logger.info("No reads were aligned during polishing")
-            if not output_progress:
-                logger.disabled = logger_state
-            open(stats_file, "w").write("#seq_name\tlength\tcoverage\n")
-            open(polished_file, "w")
-            return polished_file, stats_file
-
-        #####
+        no_bubbles = sum(os.path.getsize(f) for f in bubbles_files) == 0
+
+    if no_bubbles:
+        return None
+
+    #####
+    if consensus_out is not None:
         logger.info("Correcting bubbles")
-        _run_polish_bin(bubbles_file, subs_matrix, hopo_matrix,
-                        consensus_out, num_threads, output_progress)
-        polished_fasta, polished_lengths = _compose_sequence(consensus_out)
-        merged_chunks = merge_chunks(polished_fasta)
-        fp.write_fasta_dict(merged_chunks, polished_file)
-
-        #Cleanup
-        os.remove(chunks_file)
-        os.remove(bubbles_file)
+        with telemetry.stage("polisher") as stage:
+            _run_polish_bin(bubbles_files, subs_matrix, hopo_matrix,
+                            consensus_out, num_threads, output_progress)
+            stage.record["bytes_in"] = files_size(bubbles_files)
+            stage.record["bytes_out"] = files_size([consensus_out])
+        polished_lengths = None
+        if cfg.vals["polish_streaming_compose"]:
+            with telemetry.stage("compose_and_write") as stage:
+                with open(consensus_out, "r") as f:
+                    polished_lengths = \
+                        _compose_and_write(f, chunk_bubbles, polished_file)
+                stage.record["bytes_in"] = files_size([consensus_out])
+                stage.record["bytes_out"] = files_size([polished_file])
+            polished_fasta = None
+            if polished_lengths is None:
+                logger.debug("Polishing output does not match bubbles, "
+                             "composing it in memory")
+        if polished_lengths is None:
+            with telemetry.stage("compose") as stage:
+                polished_fasta, polished_lengths = _compose_sequence(consensus_out)
+                stage.record["bytes_in"] = files_size([consensus_out])
+    if polished_fasta is not None:
+        with telemetry.stage("write_polished") as stage:
+            merged_chunks = merge_chunks(polished_fasta)
+            fp.write_fasta_dict(merged_chunks, polished_file)
+            stage.record["bytes_out"] = files_size([polished_file])
+
+    #Cleanup
+    os.remove(chunks_file)
+    for f in bubbles_files:
+        os.remove(f)
+    if consensus_out is not None:
         os.remove(consensus_out)
+    if not keep_alignment:
         os.remove(alignment_file)
 
-        contig_lengths = polished_lengths
-        prev_assembly = polished_file
+    return polished_file, polished_lengths, coverage_stats
 
-    #merge information from chunks
-    contig_lengths = merge_chunks(contig_lengths, fold_function=sum)
-    coverage_stats = merge_chunks(coverage_stats,
-                                  fold_function=lambda l: sum(l) // len(l))
 
-    with open(stats_file, "w") as f:
-        f.write("#seq_name\tlength\tcoverage\n")
-        for ctg_id in contig_lengths:
-            f.write("{0}\t{1}\t{2}\n".format(ctg_id,
-                    contig_lengths[ctg_id], coverage_stats[ctg_id]))
-
-    if not output_progress:
-        logger.disabled = logger_state
-
-    return prev_assembly, stats_file
+def _split_into_groups(fasta_in, group_size):
+    """
+    Splits contigs (in the input order) into groups of
+    at least group_size total length
+    """
+    groups = []
+    cur_group = {}
+    cur_length = 0
+    for header, seq in iteritems(fasta_in):
+        cur_group[header] = seq
+        cur_length += len(seq)
+        if cur_length >= group_size:
+            groups.append(cur_group)
+            cur_group = {}
+            cur_length = 0
+    if cur_group:
+        groups.append(cur_group)
+
+    return groups
+
+
+def _polish_pipelined(contig_seqs, read_seqs, work_dir, num_iters,
+                      num_threads, error_mode, subs_matrix, hopo_matrix,
+                      output_progress, telemetry):
+    """
+    The first iteration polishes the whole assembly, and its alignment
+    is used to split contigs and reads into groups. The remaining
+    iterations are run for each group independently (in its own directory
+    and process), several groups at a time, so alignment of one group
+    overlaps with bubbles correction of another
+    """
+    alignment_file = os.path.join(work_dir, "minimap_1.bam")
+    try:
+        first_result = _polish_iterations(contig_seqs, read_seqs, work_dir,
+                                          num_iters, num_threads, error_mode,
+                                          subs_matrix, hopo_matrix,
+                                          output_progress, telemetry,
+                                          iterations=range(1),
+                                          keep_alignment=True)
+        prev_assembly, _contig_lengths, coverage_stats = first_result
+        if not coverage_stats:
+            return first_result
+
+        contig_groups = _split_into_groups(fp.read_sequence_dict_bytes(prev_assembly),
+                                           cfg.vals["polish_group_size"])
+        if len(contig_groups) < 2:
+            os.remove(alignment_file)
+            return _polish_iterations(prev_assembly, read_seqs, work_dir,
+                                      num_iters, num_threads, error_mode,
+                                      subs_matrix, hopo_matrix,
+                                      output_progress, telemetry,
+                                      iterations=range(1, num_iters),
+                                      coverage_stats=coverage_stats)
+
+        group_dirs = [os.path.join(work_dir, "group_{0}".format(group_id))
+                      for group_id in range(len(contig_groups))]
+        for group_dir in group_dirs:
+            if not os.path.isdir(group_dir):
+                os.mkdir(group_dir)
+        with telemetry.stage("split_reads") as stage:
+            group_reads = _split_reads(alignment_file, contig_groups,
+                                       read_seqs, group_dirs)
+            stage.record["bytes_in"] = files_size(read_seqs)
+            stage.record["bytes_out"] = files_size(group_reads)
+    finally:
+        if os.path.exists(alignment_file):
+            os.remove(alignment_file)
+
+    logger.info("Polishing %d contig groups", len(contig_groups))
+    num_workers = min(POLISH_PIPELINE_DEPTH, len(contig_groups))
+    group_threads = max(1, num_threads // num_workers)
+    results_queue = multiprocessing.Queue()
+    pending = list(range(len(contig_groups)))
+    running = {}
+    group_results = {}
+    try:
+        while pending or running:
+            while pending and len(running) < num_workers:
+                group_id = pending.pop(0)
+                group_contigs = os.path.join(group_dirs[group_id],
+                                             "contigs.fasta")
+                fp.write_fasta_dict(contig_groups[group_id], group_contigs)
+                group_coverage = \
+                    dict((chunk, cov) for chunk, cov in iteritems(coverage_stats)
+                         if chunk.rsplit("$", 1)[0] in contig_groups[group_id])
+                running[group_id] = \
+                    multiprocessing.Process(target=_polish_group,
+                                            args=(group_id, group_contigs,
+                                                  group_reads[group_id],
+                                                  group_dirs[group_id],
+                                                  num_iters, group_threads,
+                                                  error_mode, subs_matrix,
+                                                  hopo_matrix, group_coverage,
+                                                  telemetry.filename,
+                                                  telemetry.fields,
+                                                  results_queue))
+                #not under PROCESS_START_LOCK, since the group process
+                #would inherit it locked
+                running[group_id].start()
+
+            try:
+                group_id, group_result = \
+                    results_queue.get(timeout=GROUP_POLL_INTERVAL)
+            except queue.Empty:
+                for proc in running.values():
+                    if proc.exitcode == -9:
+                        logger.error("Looks like the system ran out of memory")
+                    if proc.exitcode:
+                        raise PolishException("Polishing of a contig group "
+                                              "exited with code: {0}"
+                                              .format(proc.exitcode))
+                continue
+
+            running.pop(group_id).join()
+            group_results[group_id] = group_result
+            logger.info("Contig group %d/%d polished", group_id + 1,
+                        len(contig_groups))
+    finally:
+        for proc in running.values():
+            proc.terminate()
+            proc.join()
+
+    polished_file = os.path.join(work_dir,
+                                 "polished_{0}.fasta".format(num_iters))
+    contig_lengths = {}
+    coverage_stats = {}
+    with open(polished_file, "wb") as f_out:
+        for group_id in range(len(contig_groups)):
+            group_polished, group_lengths, group_coverage = \
+                group_results[group_id]
+            with open(group_polished, "rb") as f_in:
+                shutil.copyfileobj(f_in, f_out)
+            contig_lengths.update(group_lengths)
+            coverage_stats.update(group_coverage)
+            shutil.rmtree(group_dirs[group_id])
+
+    return polished_file, contig_lengths, coverage_stats
+
+
+def _polish_group(group_id, group_contigs, group_reads, group_dir, num_iters,
+                  num_threads, error_mode, subs_matrix, hopo_matrix,
+                  coverage_stats, telemetry_file, telemetry_fields,
+                  results_queue):
+    """
+    Will run in a separate process: polishes a contig group
+    starting from the second iteration
+    """
+    #terminated by the main process on errors, so stopping the children too
+    def interrupt(_signum, _frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, interrupt)
+
+    group_telemetry = Telemetry(telemetry_file,
+                                dict(telemetry_fields, group=group_id + 1))
+    with group_telemetry:
+        #progress of concurrent binaries would be interleaved
+        result = _polish_iterations(group_contigs, [group_reads], group_dir,
+                                    num_iters, num_threads, error_mode,
+                                    subs_matrix, hopo_matrix, False,
+                                    group_telemetry,
+                                    iterations=range(1, num_iters),
+                                    coverage_stats=coverage_stats)
+    results_queue.put((group_id, result))
+
+
+def _split_reads(alignment_file, contig_groups, read_seqs, group_dirs):
+    """
+    Writes the reads of each contig group into its directory, so that the
+    groups are not aligned with all reads (which would also force reads
+    onto repeat copies from the group). Reads are assigned using
+    the alignment of the previous iteration: a read goes to every group
+    it has an alignment to, including secondary ones
+    """
+    logger.info("Splitting reads between contig groups")
+    contig_to_group = {}
+    for group_id, group in enumerate(contig_groups):
+        for ctg_id in group:
+            contig_to_group[ctg_id] = group_id
+
+    #groups of each read as a bit mask
+    read_groups = defaultdict(int)
+    for read_name, chunk_name in read_mapped_reads(alignment_file):
+        group_id = contig_to_group.get(chunk_name.rsplit("$", 1)[0])
+        if group_id is not None:
+            read_groups[read_name] |= 1 << group_id
+
+    group_reads = [os.path.join(d, "reads.fasta") for d in group_dirs]
+    group_handles = [open(f, "wb") for f in group_reads]
+    try:
+        for reads_file in read_seqs:
+            for hdr, seq in fp.stream_sequence_bytes(reads_file):
+                groups_mask = read_groups.get(hdr, 0)
+                group_id = 0
+                while groups_mask:
+                    if groups_mask & 1:
+                        fp.write_fasta_record(group_handles[group_id], hdr, seq)
+                    groups_mask >>= 1
+                    group_id += 1
+    finally:
+        for handle in group_handles:
+            handle.close()
+
+    return group_reads
 
 
 def generate_polished_edges(edges_file, gfa_file, polished_contigs, work_dir,
@@ -148,63 +473,68 @@ def generate_polished_edges(edges_file, gfa_file, polished_contigs, work_dir,
     """
     logger.debug("Generating polished GFA")
 
-    alignment_file = os.path.join(work_dir, "edges_aln.bam")
-    polished_dict = fp.read_sequence_dict(polished_contigs)
+    #only coordinates are needed, so PAF output is enough
+    alignment_file = os.path.join(work_dir, "edges_aln.paf")
     make_alignment(polished_contigs, [edges_file], num_threads,
                    work_dir, error_mode, alignment_file,
-                   reference_mode=True, sam_output=True)
-    aln_reader = SynchronizedSamReader(alignment_file,
-                                       polished_dict,
-                                       cfg.vals["max_read_coverage"])
-    aln_by_edge = defaultdict(list)
-
-    #getting one best alignment for each contig
-    while not aln_reader.is_eof():
-        _, ctg_aln = aln_reader.get_chunk()
-        for aln in ctg_aln:
-            aln_by_edge[aln.qry_id].append(aln)
-    aln_reader.close()
+                   reference_mode=True, sam_output=False, paf_base_level=True)
+    hits_by_edge = defaultdict(list)
+    for hit in read_paf(alignment_file):
+        hits_by_edge[hit.query].append(hit)
 
     MIN_CONTAINMENT = 0.9
-    updated_seqs = 0
-    edges_dict = fp.read_sequence_dict(edges_file)
-    for edge in edges_dict:
-        if edge in aln_by_edge:
-            main_aln = aln_by_edge[edge][0]
-            map_start = main_aln.trg_start
-            map_end = main_aln.trg_end
-            for aln in aln_by_edge[edge]:
-                if aln.trg_id == main_aln.trg_id and aln.trg_sign == main_aln.trg_sign:
-                    map_start = min(map_start, aln.trg_start)
-                    map_end = max(map_end, aln.trg_end)
-
-            new_seq = polished_dict[main_aln.trg_id][map_start : map_end]
-            if main_aln.qry_sign == "-":
-                new_seq = fp.reverse_complement(new_seq)
-
-            #print edge, main_aln.qry_len, len(new_seq), main_aln.qry_start, main_aln.qry_end
-            if len(new_seq) / aln.qry_len > MIN_CONTAINMENT:
-                edges_dict[edge] = new_seq
-                updated_seqs += 1
-
-    #writes fasta file with polished egdes
-    #edges_polished = os.path.join(work_dir, "polished_edges.fasta")
-    #fp.write_fasta_dict(edges_dict, edges_polished)
-
-    #writes gfa file with polished edges
-    with open(os.path.join(work_dir, "polished_edges.gfa"), "w") as gfa_polished, \
+    #polished contigs are read on demand, so edges are grouped by contig
+    edges_by_contig = defaultdict(list)
+    for edge, edge_hits in iteritems(hits_by_edge):
+        #main alignment is the one with the most matching bases
+        #(then mapping quality and length), so on repeats the edge goes
+        #to the best copy; names are compared only to make it deterministic
+        main_hit = min(edge_hits, key=lambda h: (-h.matches, -h.mapq,
+                                                 h.query_start - h.query_end,
+                                                 h.target, h.target_start))
+        map_start = main_hit.target_start
+        map_end = main_hit.target_end
+        for hit in edge_hits:
+            if hit.target == main_hit.target and hit.strand == main_hit.strand:
+                map_start = min(map_start, hit.target_start)
+                map_end = max(map_end, hit.target_end)
+        edges_by_contig[main_hit.target].append((edge, map_start, map_end,
+                                                 main_hit.strand,
+                                                 main_hit.query_length))
+
+    polished_edges = {}
+    with fp.IndexedFasta(polished_contigs) as polished_dict:
+        for ctg_id in edges_by_contig:
+            ctg_seq = polished_dict[ctg_id]
+            for edge, map_start, map_end, qry_sign, qry_len in \
+                    edges_by_contig[ctg_id]:
+                new_seq = ctg_seq[map_start : map_end]
+                if qry_sign == "-":
+                    new_seq = fp.reverse_complement(new_seq)
+
+                if len(new_seq) / qry_len > MIN_CONTAINMENT:
+                    polished_edges[edge] = new_seq
+
+    #writes gfa file with polished edges, the rest of edges
+    #are read on demand
+    with fp.IndexedFasta(edges_file) as edges_dict, \
+         open(os.path.join(work_dir, "polished_edges.gfa"), "w") as gfa_polished, \
          open(gfa_file, "r") as gfa_in:
         for line in gfa_in:
             if line.startswith("S"):
-                seq_id = line.split()[1]
-                coverage_tag = line.split()[3]
+                tokens = line.split()
+                seq_id = tokens[1]
+                coverage_tag = tokens[3]
+                edge_seq = polished_edges.get(seq_id)
+                if edge_seq is None:
+                    edge_seq = edges_dict[seq_id]
                 gfa_polished.write("S\t{0}\t{1}\t{2}\n"
-                                    .format(seq_id, edges_dict[seq_id], coverage_tag))
+                                    .format(seq_id, edge_seq, coverage_tag))
             else:
                 gfa_polished.write(line)
 
-    logger.debug("%d sequences remained unpolished",
-                 len(edges_dict) - updated_seqs)
+        logger.debug("%d sequences remained unpolished",
+                     len(edges_dict) - len(polished_edges))
     os.remove(alignment_file)
 
 
@@ -245,7 +575,7 @@ def filter_by_coverage(args, stats_in, contigs_in, stats_out, contigs_out):
     filtered_num = 0
     filtered_seq = 0
     good_fasta = {}
-    for hdr, seq in fp.stream_sequence(contigs_in):
+    for hdr, seq in fp.stream_sequence_bytes(contigs_in):
         if ctg_stats[hdr][1] >= coverage_threshold:
             good_fasta[hdr] = seq
         else:
@@ -262,19 +592,29 @@ def filter_by_coverage(args, stats_in, contigs_in, stats_out, contigs_out):
                     ctg_stats[ctg_id][0], ctg_stats[ctg_id][1]))
 
 
+def _polish_bin_cmdline(bubbles_in, subs_matrix, hopo_matrix,
+                        consensus_out, num_threads, output_progress):
+    cmdline = [POLISH_BIN, "polisher"]
+    for bubbles_file in bubbles_in:
+        cmdline.extend(["--bubbles", bubbles_file])
+    cmdline.extend(["--subs-mat", subs_matrix,
+                    "--hopo-mat", hopo_matrix, "--out", consensus_out,
+                    "--threads", str(num_threads)])
+    if not output_progress:
+        cmdline.append("--quiet")
+    return cmdline
+
+
 def _run_polish_bin(bubbles_in, subs_matrix, hopo_matrix,
                     consensus_out, num_threads, output_progress):
     """
-    Invokes polishing binary
+    Invokes polishing binary. bubbles_in is a list of bubble files
+    (text or binary), which are processed one after another
     """
-    cmdline = [POLISH_BIN, "polisher", "--bubbles", bubbles_in, "--subs-mat", subs_matrix,
-               "--hopo-mat", hopo_matrix, "--out", consensus_out,
-               "--threads", str(num_threads)]
-    if not output_progress:
-        cmdline.append("--quiet")
-
+    cmdline = _polish_bin_cmdline(bubbles_in, subs_matrix, hopo_matrix,
+                                  consensus_out, num_threads, output_progress)
     try:
-        subprocess.check_call(cmdline)
+        check_call(cmdline)
     except subprocess.CalledProcessError as e:
         if e.returncode == -9:
             logger.error("Looks like the system ran out of memory")
@@ -283,24 +623,163 @@ def _run_polish_bin(bubbles_in, subs_matrix, hopo_matrix,
         raise PolishException(str(e))
 
 
+def _polish_streaming(alignment_file, contigs_info, chunks_file, error_mode,
+                      num_threads, subs_matrix, hopo_matrix, output_progress,
+                      stage=None):
+    """
+    Bubbles are piped into the polishing binary as soon as they are
+    generated, and its output is composed while being read, so
+    neither bubbles nor consensus are stored on disk
+    """
+    cmdline = _polish_bin_cmdline(["-"], subs_matrix, hopo_matrix, "-",
+                                  num_threads, output_progress)
+    try:
+        with PROCESS_START_LOCK:
+            polisher = subprocess.Popen(cmdline, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, close_fds=True)
+    except OSError as e:
+        raise PolishException(str(e))
+
+    #output is consumed concurrently, so the polisher never blocks on it
+    composed = []
+    def compose_output():
+        lines = iter(polisher.stdout.readline, b"")
+        composed.append(_compose_sequence_stream(map(_STR, lines)))
+    reader = threading.Thread(target=compose_output)
+    reader.start()
+
+    try:
+        coverage_stats, mean_aln_error, _bubbles_files, _contig_bubbles = \
+            make_bubbles(alignment_file, contigs_info, chunks_file,
+                         error_mode, num_threads, polisher.stdin, stage)
+    except (KeyboardInterrupt, Exception):
+        #if the polisher has failed, writing bubbles fails with broken pipe,
+        #so reporting the polisher error first (unless it was terminated here)
+        _stop_polisher(polisher, reader, terminate=True)
+        if polisher.returncode != -signal.SIGTERM:
+            _check_polisher_exit(polisher.returncode)
+        raise
+
+    _stop_polisher(polisher, reader, terminate=False)
+    _check_polisher_exit(polisher.returncode)
+    if not composed:
+        raise PolishException("Error reading polishing output")
+
+    polished_fasta, polished_lengths = composed[0]
+    return coverage_stats, mean_aln_error, polished_fasta, polished_lengths
+
+
+def _stop_polisher(polisher, reader, terminate):
+    """
+    Closes the polisher input and waits until its output is consumed
+    """
+    try:
+        polisher.stdin.close()
+    except (IOError, OSError):
+        pass
+    if terminate and polisher.poll() is None:
+        polisher.terminate()
+    reader.join()
+    polisher.stdout.close()
+    polisher.wait()
+
+
+def _check_polisher_exit(returncode):
+    if returncode != 0:
+        if returncode == -9:
+            logger.error("Looks like the system ran out of memory")
+        raise PolishException("Polishing binary exited with code {0}"
+                              .format(returncode))
+
+
 def _compose_sequence(consensus_file):
     """
     Concatenates bubbles consensuses into genome
     """
-    consensuses = defaultdict(list)
-    coverage = defaultdict(list)
     with open(consensus_file, "r") as f:
+        return _compose_sequence_stream(f)
+
+
+def _compose_and_write(consensus_lines, chunk_bubbles, out_file):
+    """
+    Streaming version of _compose_sequence followed by merge_chunks:
+    bubbles consensuses are buffered only until their chunk is complete
+    (chunk_bubbles gives the number of bubbles for each chunk), and each
+    contig is written as soon as all of its chunks are complete. Contigs
+    are written in the order of completion. Returns polished chunk lengths,
+    or None if the polisher output did not match the bubble counts
+    (the output file is then incomplete and should be composed again)
+    """
+    def contig_name(chunk_id):
+        return chunk_id.rsplit("$", 1)[0]
+
+    pending_bubbles = {}
+    pending_chunks = defaultdict(set)
+    for chunk_id, num_bubbles in iteritems(chunk_bubbles):
+        if num_bubbles > 0:
+            pending_bubbles[chunk_id] = num_bubbles
+            pending_chunks[contig_name(chunk_id)].add(chunk_id)
+
+    consensuses = defaultdict(list)
+    polished_chunks = defaultdict(dict)
+    polished_lengths = {}
+    written = set()
+
+    def finish_chunk(chunk_id):
+        seqs = consensuses.pop(chunk_id)
+        concat_seq = "".join([p[1] for p in sorted(seqs, key=lambda p: p[0])])
+        polished_chunks[contig_name(chunk_id)][chunk_id] = concat_seq
+        polished_lengths[chunk_id] = len(concat_seq)
+
+    def write_contig(f_out, ctg_name):
+        merged = merge_chunks(polished_chunks.pop(ctg_name))
+        fp.write_fasta_record(f_out, ctg_name, merged[ctg_name])
+
+    with open(out_file, "wb") as f_out:
         header = True
-        for line in f:
+        for line in consensus_lines:
             if header:
                 tokens = line.strip().split(" ")
-                ctg_id = tokens[0][1:]
-                ctg_pos = int(tokens[1])
-                coverage[ctg_id].append(int(tokens[2]))
+                chunk_id = tokens[0][1:]
+                chunk_pos = int(tokens[1])
             else:
-                consensuses[ctg_id].append((ctg_pos, line.strip()))
+                #a late consensus of an already written contig
+                if contig_name(chunk_id) in written:
+                    return None
+                consensuses[chunk_id].append((chunk_pos, line.strip()))
+                pending_bubbles[chunk_id] = pending_bubbles.get(chunk_id, 0) - 1
+                if pending_bubbles[chunk_id] == 0:
+                    finish_chunk(chunk_id)
+                    ctg_name = contig_name(chunk_id)
+                    pending_chunks[ctg_name].discard(chunk_id)
+                    if not pending_chunks[ctg_name]:
+                        write_contig(f_out, ctg_name)
+                        written.add(ctg_name)
             header = not header
 
+    #some consensuses are missing (or there are extra ones)
+    if consensuses or polished_chunks:
+        return None
+    return polished_lengths
+
+
+def _compose_sequence_stream(consensus_lines):
+    """
+    Same as above, but consumes the polishing output line by line
+    """
+    consensuses = defaultdict(list)
+    coverage = defaultdict(list)
+    header = True
+    for line in consensus_lines:
+        if header:
+            tokens = line.strip().split(" ")
+            ctg_id = tokens[0][1:]
+            ctg_pos = int(tokens[1])
+            coverage[ctg_id].append(int(tokens[2]))
+        else:
+            consensuses[ctg_id].append((ctg_pos, line.strip()))
+        header = not header
+
     polished_fasta = {}
     polished_stats = {}
     for ctg_id, seqs in iteritems(consensuses):
@@ -5,6 +5,7 @@
 
 from __future__ import absolute_import
 from __future__ import division
+import sys
 import flye.utils.fasta_parser as fp
 from flye.utils.sam_parser import read_paf_grouped
 import logging
@@ -12,6 +13,12 @@ from collections import defaultdict
 from flye.six import iteritems
 from flye.six.moves import range
 
+#reads are streamed as bytes and written without decoding
+if sys.version_info < (3, 0):
+    _BYTES = lambda x: x
+else:
+    _BYTES = str.encode
+
 logger = logging.getLogger()
 
 
@@ -67,9 +74,9 @@ def extract_unmapped_reads(args, reads2contigs_mapping, unmapped_reads_path,
     total_bases = 0
     unmapped_bases = 0
 
-    with open(unmapped_reads_path, "w") as fout:
+    with open(unmapped_reads_path, "wb") as fout:
         for reads_file in args.reads:
-            for hdr, sequence in fp.stream_sequence(reads_file):
+            for hdr, sequence in fp.stream_sequence_bytes(reads_file):
                 total_bases += len(sequence)
 
                 is_unmapped = True
@@ -82,7 +89,8 @@ def extract_unmapped_reads(args, reads2contigs_mapping, unmapped_reads_path,
 
                 if is_unmapped:
                     unmapped_bases += len(sequence)
-                    fout.write(">{0}\n{1}\n".format(hdr, sequence))
+                    fout.write(b"".join([_BYTES(">{0}\n".format(hdr)),
+                                         sequence, b"\n"]))
 
     logger.debug("Unmapped sequence: %d / %d (%f)", unmapped_bases,
                  total_bases, unmapped_bases / total_bases)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+#(c) 2019 by Authors
+#This file is a part of the Flye package.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Micro-benchmark for alignment.shift_gaps on long ONT-like alignments.
+Compares against the original list-based implementation and checks
+that the outputs are identical.
+
+Usage: python bench_shift_gaps.py [aln_length] [num_alignments]
+"""
+
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+from flye.polishing.alignment import shift_gaps
+from flye.six.moves import range
+
+
+def shift_gaps_reference(seq_trg, seq_qry):
+    """
+    Original implementation (character lists with sentinels)
+    """
+    lst_trg, lst_qry = list("$" + seq_trg + "$"), list("$" + seq_qry + "$")
+    is_gap = False
+    gap_start = 0
+    for i in range(len(lst_trg)):
+        if is_gap and lst_qry[i] != "-":
+            is_gap = False
+            swap_left = gap_start - 1
+            swap_right = i - 1
+
+            while (swap_left > 0 and swap_right >= gap_start and
+                   lst_qry[swap_left] == lst_trg[swap_right]):
+                lst_qry[swap_left], lst_qry[swap_right] = \
+                            lst_qry[swap_right], lst_qry[swap_left]
+                swap_left -= 1
+                swap_right -= 1
+
+        if not is_gap and lst_qry[i] == "-":
+            is_gap = True
+            gap_start = i
+
+    return "".join(lst_qry[1 : -1])
+
+
+def simulate_alignment(length, rng):
+    """
+    Gapped (target, query) pair with ONT-like errors: ~10% in total,
+    deletions and insertions are enriched in homopolymers
+    """
+    trg, qry = [], []
+    prev_nucl = None
+    for _ in range(length):
+        if prev_nucl is not None and rng.random() < 0.25:
+            nucl = prev_nucl
+        else:
+            nucl = rng.choice("ACGT")
+        homopolymer = nucl == prev_nucl
+        prev_nucl = nucl
+
+        roll = rng.random()
+        del_rate = 0.06 if homopolymer else 0.03
+        if roll < del_rate:
+            trg.append(nucl)
+            qry.append("-")
+        elif roll < del_rate + 0.03:
+            trg.append(nucl)
+            qry.append(rng.choice([n for n in "ACGT" if n != nucl]))
+        elif roll < del_rate + 0.05:
+            for _ in range(rng.randint(1, 3)):
+                trg.append("-")
+                qry.append(nucl if homopolymer else rng.choice("ACGT"))
+            trg.append(nucl)
+            qry.append(nucl)
+        else:
+            trg.append(nucl)
+            qry.append(nucl)
+    return "".join(trg), "".join(qry)
+
+
+def shift_both(shift_fun, alignments):
+    #same calls as in bubbles / consensus profile computation
+    out = []
+    for trg, qry in alignments:
+        qry_shifted = shift_fun(trg, qry)
+        out.append((shift_fun(qry_shifted, trg), qry_shifted))
+    return out
+
+
+def main():
+    aln_length = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    num_alignments = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    rng = random.Random(42)
+    alignments = [simulate_alignment(aln_length, rng)
+                  for _ in range(num_alignments)]
+
+    if shift_both(shift_gaps, alignments) != \
+            shift_both(shift_gaps_reference, alignments):
+        sys.exit("shift_gaps output differs from the reference!")
+
+    total_columns = sum(len(trg) for trg, _qry in alignments)
+    for name, fun in [("reference", shift_gaps_reference),
+                      ("shift_gaps", shift_gaps)]:
+        elapsed = min(timeit.repeat(lambda: shift_both(fun, alignments),
+                                    number=1, repeat=3))
+        print("{0:>12}: {1:7.3f} s, {2:6.1f} ns / column"
+              .format(name, elapsed, elapsed / total_columns / 2 * 1e9))
+
+
+if __name__ == "__main__":
+    main()
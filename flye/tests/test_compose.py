@@ -0,0 +1,54 @@
+#(c) 2019 by Authors
+#This file is a part of the Flye package.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Tests streaming composition of the polished contigs
+"""
+
+import os
+import shutil
+import tempfile
+
+import flye.utils.fasta_parser as fp
+from flye.polishing.alignment import merge_chunks
+from flye.polishing.polish import _compose_and_write, _compose_sequence_stream
+
+
+CONSENSUS = [">ctg_1$chunk_0 0 10\n", "ACGT\n",
+             ">ctg_1$chunk_0 4 10\n", "TTAA\n",
+             ">ctg_2$chunk_0 0 10\n", "GGGG\n",
+             ">ctg_1$chunk_1 0 10\n", "CCCA\n"]
+CHUNK_BUBBLES = {"ctg_1$chunk_0": 2, "ctg_1$chunk_1": 1, "ctg_2$chunk_0": 1}
+
+
+def _compose(lines, chunk_bubbles):
+    work_dir = tempfile.mkdtemp()
+    try:
+        out_file = os.path.join(work_dir, "polished.fasta")
+        lengths = _compose_and_write(lines, chunk_bubbles, out_file)
+        return lengths, fp.read_sequence_dict(out_file)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_compose_matching_counts():
+    lengths, polished = _compose(CONSENSUS, CHUNK_BUBBLES)
+    expected_fasta, expected_lengths = _compose_sequence_stream(CONSENSUS)
+    assert lengths == expected_lengths
+    assert polished == merge_chunks(expected_fasta)
+
+
+def test_compose_late_consensus():
+    #ctg_2 is complete before its extra consensus arrives
+    lines = CONSENSUS + [">ctg_2$chunk_0 4 10\n", "TTTT\n"]
+    lengths, _polished = _compose(lines, CHUNK_BUBBLES)
+    assert lengths is None
+
+
+def test_compose_missing_consensus():
+    bubbles = dict(CHUNK_BUBBLES)
+    bubbles["ctg_1$chunk_1"] = 2
+    lengths, polished = _compose(CONSENSUS, bubbles)
+    assert lengths is None
+    assert "ctg_1" not in polished
@@ -19,7 +19,7 @@ import signal
 import os.path
 
 from flye.polishing.alignment import shift_gaps
-from flye.utils.sam_parser import SynchronizedSamReader
+from flye.utils.sam_parser import make_alignment_reader
 import flye.utils.fasta_parser as fp
 import flye.config.py_cfg as config
 from flye.six.moves import zip
@@ -63,8 +63,9 @@ def _contig_profile(alignment, platform, genome_len):
         #if aln.err_rate > max_aln_err: continue
         aln_errors.append(aln.err_rate)
 
-        qry_seq = shift_gaps(aln.trg_seq, aln.qry_seq)
-        trg_seq = shift_gaps(qry_seq, aln.trg_seq)
+        aln_trg = aln.trg_seq
+        qry_seq = shift_gaps(aln_trg, aln.qry_seq)
+        trg_seq = shift_gaps(qry_seq, aln_trg)
         #qry_seq = aln.qry_seq
         #trg_seq = aln.trg_seq
 
@@ -172,35 +173,39 @@ def find_divergence(alignment_path, contigs_path, contigs_info,
                           len(ctg_profile), window_len)
         return
 
-    aln_reader = SynchronizedSamReader(alignment_path,
-                                       fp.read_sequence_dict(contigs_path),
-                                       config.vals["max_read_coverage"])
-    manager = multiprocessing.Manager()
-    results_queue = manager.Queue()
-    error_queue = manager.Queue()
-
-    #making sure the main process catches SIGINT
-    orig_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    threads = []
-    for _ in range(num_proc):
-        threads.append(multiprocessing.Process(target=_thread_worker,
-                                               args=(aln_reader, contigs_info,
-                                                     platform, results_queue,
-                                                     error_queue)))
-    signal.signal(signal.SIGINT, orig_sigint)
-
-    for t in threads:
-        t.start()
+    contigs_fasta = fp.IndexedFasta(contigs_path)
     try:
-        for t in threads:
-            t.join()
-    except KeyboardInterrupt:
-        for t in threads:
-            t.terminate()
+        aln_reader = make_alignment_reader(alignment_path, contigs_fasta,
+                                           config.vals["max_read_coverage"])
+        manager = multiprocessing.Manager()
+        results_queue = manager.Queue()
+        error_queue = manager.Queue()
+
+        #making sure the main process catches SIGINT
+        orig_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        threads = []
+        for _ in range(num_proc):
+            threads.append(multiprocessing.Process(target=_thread_worker,
+                                                   args=(aln_reader, contigs_info,
+                                                         platform, results_queue,
+                                                         error_queue)))
+        signal.signal(signal.SIGINT, orig_sigint)
 
-    if not error_queue.empty():
-        raise error_queue.get()
-    aln_reader.close()
+        for t in threads:
+            t.start()
+        try:
+            for t in threads:
+                t.join()
+        except KeyboardInterrupt:
+            for t in threads:
+                t.terminate()
+
+        if not error_queue.empty():
+            raise error_queue.get()
+        aln_reader.log_utilization()
+        aln_reader.close()
+    finally:
+        contigs_fasta.close()
 
     total_aln_errors = []
     while not results_queue.empty():
@@ -577,9 +577,7 @@ def _process_repeats_impl(reads, repeats_dict, work_dir, all_labels,
     (template_name, extended_name, repeat_reads_name,
      pre_partitioning_name) = initial_file_names
 
-    reads_dict = {}
-    for read_file in reads:
-        reads_dict.update(fp.read_sequence_dict(read_file))
+    reads_dict = fp.IndexedFasta(reads)
     #orig_graph = fp.read_sequence_dict(graph_edges)
     #graph_dict = {int(h.split('_')[1]):orig_graph[h] for h in orig_graph}
 
@@ -843,6 +841,8 @@ def _process_repeats_impl(reads, repeats_dict, work_dir, all_labels,
                         "Empty partitioning file {0}".format(
                             partitioning_path.format(side)))
 
+    #on errors, the mapped reads are released with the process
+    reads_dict.close()
     return_queue.put((repeat_list, repeat_edges, all_edge_headers))
 
 
@@ -1042,9 +1042,11 @@ def _find_consensus_endpoint(cutpoint, aligns, side):
         #save tuples of cutpoint distance, cutpoint
         aln_endpoints = []
         for i, aln in enumerate(aligns[0]):
-            if i == 0 or len(aln.trg_seq) >= MIN_SUPP_ALN_LEN:
+            #gapped strings are rebuilt on each access, so kept locally
+            aln_trg = aln.trg_seq
+            if i == 0 or len(aln_trg) >= MIN_SUPP_ALN_LEN:
                 if cutpoint >= aln.trg_start and cutpoint < aln.trg_end:
-                    trg_aln, _ = _index_mapping(aln.trg_seq)
+                    trg_aln, _ = _index_mapping(aln_trg)
                     _, aln_qry = _index_mapping(aln.qry_seq)
                     cutpoint_minus_start = cutpoint - aln.trg_start
                     if cutpoint_minus_start < 0:
@@ -1147,15 +1149,15 @@ def partition_reads(edges, it, side, position_path, cons_align_path,
 
 def _read_alignment(alignment, target_path, min_aln_rate):
     alignments = []
-    aln_reader = SynchronizedSamReader(alignment,
-                                       fp.read_sequence_dict(target_path),
-                                       config.vals["max_read_coverage"])
-    while not aln_reader.is_eof():
-        ctg_id, ctg_aln = aln_reader.get_chunk()
-        if ctg_id is None:
-            break
-        alignments.append(ctg_aln)
-    aln_reader.close()
+    with fp.IndexedFasta(target_path) as target_fasta:
+        aln_reader = SynchronizedSamReader(alignment, target_fasta,
+                                           config.vals["max_read_coverage"])
+        while not aln_reader.is_eof():
+            ctg_id, ctg_aln = aln_reader.get_chunk()
+            if ctg_id is None:
+                break
+            alignments.append(ctg_aln)
+        aln_reader.close()
 
     return alignments
 
@@ -1237,15 +1239,18 @@ def _collapse(aln_one, aln_two):
     if (aln_one.qry_sign == "-" or aln_two.qry_sign == "-" or
             _overlap(aln_one, aln_two) > MAX_SUPP_ALIGN_OVERLAP):
         return out_aln
+    #gapped strings are rebuilt on each access, so kept locally
+    aln_one_qry, aln_one_trg = aln_one.qry_seq, aln_one.trg_seq
+    aln_two_qry, aln_two_trg = aln_two.qry_seq, aln_two.trg_seq
     if (aln_one.qry_start <= aln_two.qry_start and
             aln_one.trg_start <= aln_two.trg_start):
         qry_merge_outs = _merge_alns(aln_one.qry_start, aln_one.qry_end,
-                                     aln_one.qry_seq, aln_two.qry_start,
-                                     aln_two.qry_end, aln_two.qry_seq)
+                                     aln_one_qry, aln_two.qry_start,
+                                     aln_two.qry_end, aln_two_qry)
         one_qry_seq, two_qry_seq, out_qry_end = qry_merge_outs
         trg_merge_outs = _merge_alns(aln_one.trg_start, aln_one.trg_end,
-                                     aln_one.trg_seq, aln_two.trg_start,
-                                     aln_two.trg_end, aln_two.trg_seq)
+                                     aln_one_trg, aln_two.trg_start,
+                                     aln_two.trg_end, aln_two_trg)
         one_trg_seq, two_trg_seq, out_trg_end = trg_merge_outs
         fill_qry = ""
         fill_trg = ""
@@ -1259,9 +1264,9 @@ def _collapse(aln_one, aln_two):
             fill_qry = "-" * diff
         out_qry_seq = "".join([one_qry_seq, fill_qry, two_qry_seq])
         out_trg_seq = "".join([one_trg_seq, fill_trg, two_trg_seq])
-        out_err_rate = ((aln_one.err_rate * len(aln_one.trg_seq) +
-                         aln_two.err_rate * len(aln_two.trg_seq)) /
-                         (len(aln_one.trg_seq) + len(aln_two.trg_seq)))
+        out_err_rate = ((aln_one.err_rate * len(aln_one_trg) +
+                         aln_two.err_rate * len(aln_two_trg)) /
+                         (len(aln_one_trg) + len(aln_two_trg)))
         out_aln = Alignment(aln_one.qry_id, aln_one.trg_id, aln_one.qry_start,
                             out_qry_end, aln_one.qry_sign, aln_one.qry_len,
                             aln_one.trg_start, out_trg_end, aln_one.trg_sign,
@@ -1271,12 +1276,12 @@ def _collapse(aln_one, aln_two):
     elif (aln_two.qry_start <= aln_one.qry_start and
             aln_two.trg_start <= aln_one.trg_start):
         qry_merge_outs = _merge_alns(aln_two.qry_start, aln_two.qry_end,
-                                     aln_two.qry_seq, aln_one.qry_start,
-                                     aln_one.qry_end, aln_one.qry_seq)
+                                     aln_two_qry, aln_one.qry_start,
+                                     aln_one.qry_end, aln_one_qry)
         two_qry_seq, one_qry_seq, out_qry_end = qry_merge_outs
         trg_merge_outs = _merge_alns(aln_two.trg_start, aln_two.trg_end,
-                                     aln_two.trg_seq, aln_one.trg_start,
-                                     aln_one.trg_end, aln_one.trg_seq)
+                                     aln_two_trg, aln_one.trg_start,
+                                     aln_one.trg_end, aln_one_trg)
         two_trg_seq, one_trg_seq, out_trg_end = trg_merge_outs
         fill_qry = ""
         fill_trg = ""
@@ -1290,9 +1295,9 @@ def _collapse(aln_one, aln_two):
             fill_qry = "-" * diff
         out_qry_seq = "".join([two_qry_seq, fill_qry, one_qry_seq])
         out_trg_seq = "".join([two_trg_seq, fill_trg, one_trg_seq])
-        out_err_rate = ((aln_one.err_rate * len(aln_one.trg_seq) +
-                         aln_two.err_rate * len(aln_two.trg_seq)) /
-                         (len(aln_one.trg_seq) + len(aln_two.trg_seq)))
+        out_err_rate = ((aln_one.err_rate * len(aln_one_trg) +
+                         aln_two.err_rate * len(aln_two_trg)) /
+                         (len(aln_one_trg) + len(aln_two_trg)))
         out_aln = Alignment(aln_one.qry_id, aln_one.trg_id, aln_two.qry_start,
                             out_qry_end, aln_one.qry_sign, aln_one.qry_len,
                             aln_two.trg_start, out_trg_end, aln_one.trg_sign,
@@ -1567,12 +1572,13 @@ def _classify_reads(read_aligns, consensus_pos,
             if read_counts[read_header] > 2:
                 continue
             positions = consensus_pos[edge_id]
-            trg_aln, _ = _index_mapping(aln.trg_seq)
+            aln_qry, aln_trg = aln.qry_seq, aln.trg_seq
+            trg_aln, _ = _index_mapping(aln_trg)
             for pos in positions:
                 if pos >= aln.trg_start and pos < aln.trg_end:
                     pos_minus_start = pos - aln.trg_start
                     aln_ind = trg_aln[pos_minus_start]
-                    if aln.qry_seq[aln_ind] == aln.trg_seq[aln_ind]:
+                    if aln_qry[aln_ind] == aln_trg[aln_ind]:
                         read_scores[read_header][edge_id] += 1
     #Iterate through all read_headers so partitioning will be a complete set
     for read_header in headers_to_id:
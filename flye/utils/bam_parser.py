@@ -0,0 +1,418 @@
+#(c) 2019 by Authors
+#This file is a part of Flye program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Provides in-process BAM decoding (BGZF blocks are inflated with zlib),
+so that BAM records could be read without samtools
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import sys
+import struct
+import zlib
+from bisect import bisect_right
+from multiprocessing.pool import ThreadPool
+
+#In Python2, everything is bytes (=str)
+#In Python3, we are doing IO in bytes, but everywhere else strngs = unicode
+if sys.version_info < (3, 0):
+    from string import maketrans
+    _STR = lambda x: x
+    _BYTES = lambda x: x
+else:
+    maketrans = bytes.maketrans
+    _STR = bytes.decode
+    _BYTES = str.encode
+
+from flye.six.moves import range
+
+
+#BGZF blocks inflated at once
+BLOCKS_BATCH = 64
+BAM_MAGIC = b"BAM\1"
+CIGAR_OPS = "MIDNSHP=X"
+SEQ_CODES = bytearray(b"=ACMGRSVTWYHKDBN")
+
+#SEQ is packed with two bases per byte. Two translation tables convert
+#high and low nibbles into letters, which are then interleaved.
+_SEQ_HIGH = bytes(bytearray(SEQ_CODES[i >> 4] for i in range(256)))
+_SEQ_LOW = bytes(bytearray(SEQ_CODES[i & 0xf] for i in range(256)))
+_TAG_SIZES = {b"A": 1, b"c": 1, b"C": 1, b"s": 2, b"S": 2,
+              b"i": 4, b"I": 4, b"f": 4}
+_REC_CORE = struct.Struct("<iiBBHHHiiii")
+_BLOCK_HEADER = struct.Struct("<BBBBIBBH")
+
+
+class BamError(Exception):
+    pass
+
+
+class _CigarStrings(dict):
+    """
+    Memoizes text representation of packed CIGAR operations
+    """
+    def __missing__(self, code):
+        op_str = _BYTES("%d%s" % (code >> 4, CIGAR_OPS[code & 0xf]))
+        self[code] = op_str
+        return op_str
+
+
+_CIGAR_STRINGS = _CigarStrings()
+
+
+class BgzfReader(object):
+    """
+    Reads decompressed BGZF stream. Blocks are inflated in batches
+    by a pool of threads (zlib releases GIL while inflating)
+    """
+    def __init__(self, filename, num_threads=1):
+        self.handle = open(filename, "rb")
+        self.pool = ThreadPool(num_threads) if num_threads > 1 else None
+
+    def close(self):
+        self.handle.close()
+        if self.pool is not None:
+            self.pool.terminate()
+
+    def seek_virtual(self, virtual_offset):
+        """
+        Moves to the virtual offset (as stored in .bai) and returns
+        the number of bytes to skip in the first inflated batch
+        """
+        self.handle.seek(virtual_offset >> 16)
+        return virtual_offset & 0xffff
+
+    def _read_blocks(self):
+        blocks = []
+        offsets = []
+        for _ in range(BLOCKS_BATCH):
+            block_offset = self.handle.tell()
+            header = self.handle.read(_BLOCK_HEADER.size)
+            if not header:
+                break
+            if len(header) < _BLOCK_HEADER.size:
+                raise BamError("Truncated BGZF block")
+            id_1, id_2, _cm, _flg, _mtime, _xfl, _os, xlen = \
+                    _BLOCK_HEADER.unpack(header)
+            if id_1 != 31 or id_2 != 139:
+                raise BamError("Not a BGZF file")
+
+            extra = self.handle.read(xlen)
+            block_size = None
+            pos = 0
+            while pos + 4 <= xlen:
+                subfield, slen = struct.unpack_from("<2sH", extra, pos)
+                if subfield == b"BC":
+                    block_size = struct.unpack_from("<H", extra, pos + 4)[0] + 1
+                pos += 4 + slen
+            if block_size is None:
+                raise BamError("BGZF block without size field")
+
+            data_len = block_size - _BLOCK_HEADER.size - xlen
+            block_data = self.handle.read(data_len)
+            if len(block_data) < data_len:
+                raise BamError("Truncated BGZF block")
+            #last 8 bytes are CRC32 and ISIZE
+            blocks.append(block_data[:-8])
+            offsets.append(block_offset)
+        return blocks, offsets
+
+    def iter_batches(self):
+        """
+        Yields decompressed data in batches of BGZF blocks
+        """
+        for batch, _blocks in self.iter_batches_with_blocks():
+            yield batch
+
+    def iter_batches_with_blocks(self):
+        """
+        Same as iter_batches, but also yields the list of
+        (start in the batch, file offset) for the blocks of each batch
+        """
+        while True:
+            blocks, offsets = self._read_blocks()
+            if not blocks:
+                return
+            if self.pool is not None:
+                inflated = self.pool.map(_inflate, blocks)
+            else:
+                inflated = [_inflate(b) for b in blocks]
+            batch_blocks = []
+            start = 0
+            for block_data, block_offset in zip(inflated, offsets):
+                batch_blocks.append((start, block_offset))
+                start += len(block_data)
+            yield b"".join(inflated), batch_blocks
+
+
+class BamReader(object):
+    """
+    Decodes BAM records and presents them as minimal SAM lines
+    (QNAME, FLAG, RNAME, POS, MAPQ, CIGAR, RNEXT, PNEXT, TLEN, SEQ, QUAL).
+    SEQ is not decoded for records with any of skip_seq_flags set.
+    """
+    def __init__(self, filename, num_threads=1, skip_seq_flags=0):
+        self.filename = filename
+        self.num_threads = num_threads
+        self.skip_seq_flags = skip_seq_flags
+        self.ref_names = []
+        self.header_text = b""
+        self.header_size = 0
+        self._data = b""
+        self._pos = 0
+        self._batches = None
+        self._reader = None
+
+        self._open(None)
+        self._read_header()
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def _open(self, virtual_offset):
+        #the file is opened once and then only repositioned
+        if self._reader is None:
+            self._reader = BgzfReader(self.filename, self.num_threads)
+        skip = 0
+        if virtual_offset is not None:
+            skip = self._reader.seek_virtual(virtual_offset)
+        self._batches = self._reader.iter_batches()
+        self._data = b""
+        self._pos = 0
+        if skip:
+            self._fill(skip)
+            self._pos = skip
+
+    def _fill(self, length):
+        """
+        Makes sure that at least length bytes are available
+        after the current position
+        """
+        while len(self._data) - self._pos < length:
+            batch = next(self._batches, None)
+            if batch is None:
+                return False
+            self._data = self._data[self._pos:] + batch
+            self._pos = 0
+        return True
+
+    def _read(self, length):
+        if not self._fill(length):
+            raise BamError("Truncated BAM file")
+        chunk = self._data[self._pos : self._pos + length]
+        self._pos += length
+        return chunk
+
+    def _read_header(self):
+        if self._read(4) != BAM_MAGIC:
+            raise BamError("Not a BAM file: " + self.filename)
+        l_text = struct.unpack("<i", self._read(4))[0]
+        self.header_text = self._read(l_text)
+        n_ref = struct.unpack("<i", self._read(4))[0]
+        self.header_size = 12 + l_text
+        for _ in range(n_ref):
+            l_name = struct.unpack("<i", self._read(4))[0]
+            self.ref_names.append(self._read(l_name)[:-1])
+            self._read(4)
+            self.header_size += 8 + l_name
+
+    def index_references(self):
+        """
+        Scans the file (without decoding the records) and returns the list
+        of (virtual offset of the first record, number of records) for each
+        reference in the header order. Offset is None for references
+        without records. The file should be sorted by reference
+        """
+        ref_offsets = [None] * len(self.ref_names)
+        ref_counts = [0] * len(self.ref_names)
+        reader = BgzfReader(self.filename, self.num_threads)
+        try:
+            data = b""
+            #data start and file offset of the buffered blocks
+            block_starts = []
+            block_offsets = []
+            pos = self.header_size
+            prev_ref = None
+            for batch, batch_blocks in reader.iter_batches_with_blocks():
+                #dropping the blocks that were scanned through
+                if block_starts:
+                    first_block = bisect_right(block_starts, pos) - 1
+                    cut = block_starts[first_block]
+                    data = data[cut:]
+                    pos -= cut
+                    block_starts = [s - cut for s in block_starts[first_block:]]
+                    block_offsets = block_offsets[first_block:]
+                for start, block_offset in batch_blocks:
+                    block_starts.append(len(data) + start)
+                    block_offsets.append(block_offset)
+                data += batch
+
+                while pos + 8 <= len(data):
+                    block_size, ref_id = struct.unpack_from("<ii", data, pos)
+                    if pos + 4 + block_size > len(data):
+                        break
+                    if ref_id >= 0:
+                        if ref_id != prev_ref and ref_offsets[ref_id] is not None:
+                            raise BamError("BAM file is not sorted")
+                        prev_ref = ref_id
+                        if ref_offsets[ref_id] is None:
+                            block = bisect_right(block_starts, pos) - 1
+                            ref_offsets[ref_id] = (block_offsets[block] << 16 |
+                                                   pos - block_starts[block])
+                        ref_counts[ref_id] += 1
+                    pos += 4 + block_size
+            if pos != len(data):
+                raise BamError("Truncated BAM record")
+        finally:
+            reader.close()
+
+        return list(zip(ref_offsets, ref_counts))
+
+    def sam_lines(self, virtual_offset=None, ref_id=None):
+        """
+        Yields records as SAM lines. If virtual_offset is given,
+        starts from it; if ref_id is given, stops at the first record
+        from another reference.
+        """
+        for start, block_size in self._records(virtual_offset, ref_id):
+            yield self._format_record(self._data, start, block_size)
+
+    def mapped_reads(self):
+        """
+        Yields (read name, reference name) for each mapped record
+        (including secondary ones), the rest of the record is not decoded
+        """
+        for start, _block_size in self._records(None, None):
+            (ref_id, _pos, l_read_name, _mapq, _bin, _n_cigar_op, flag, _l_seq,
+             _next_ref, _next_pos, _tlen) = _REC_CORE.unpack_from(self._data, start)
+            if ref_id < 0 or flag & 0x4:
+                continue
+            offset = start + _REC_CORE.size
+            yield (self._data[offset : offset + l_read_name - 1],
+                   self.ref_names[ref_id])
+
+    def raw_records(self, virtual_offset=None, ref_id=None):
+        """
+        Returns the list of undecoded records (same arguments as for
+        sam_lines), which could be formatted later by format_record
+        """
+        return [self._data[start : start + block_size]
+                for start, block_size in self._records(virtual_offset, ref_id)]
+
+    def format_record(self, record, decode_seq=True):
+        """
+        Formats a record from raw_records as SAM line. If decode_seq
+        is not set, SEQ is "*"
+        """
+        return self._format_record(record, 0, len(record), decode_seq)
+
+    def _records(self, virtual_offset, ref_id):
+        """
+        Yields start and size of each record in the buffer. The record
+        should be used before the next one is requested
+        """
+        if virtual_offset is not None:
+            self._open(virtual_offset)
+
+        while self._fill(4):
+            block_size = struct.unpack_from("<i", self._data, self._pos)[0]
+            if not self._fill(4 + block_size):
+                raise BamError("Truncated BAM record")
+            start = self._pos + 4
+            self._pos = start + block_size
+
+            rec_ref = struct.unpack_from("<i", self._data, start)[0]
+            if ref_id is not None and rec_ref != ref_id:
+                return
+            yield start, block_size
+
+    def _format_record(self, data, start, block_size, decode_seq=True):
+        (ref_id, pos, l_read_name, mapq, _bin, n_cigar_op, flag, l_seq,
+         _next_ref, _next_pos, _tlen) = _REC_CORE.unpack_from(data, start)
+
+        offset = start + _REC_CORE.size
+        read_name = data[offset : offset + l_read_name - 1]
+        offset += l_read_name
+
+        cigar = struct.unpack_from("<%dI" % n_cigar_op, data, offset)
+        offset += 4 * n_cigar_op
+        seq_offset = offset
+        offset += (l_seq + 1) // 2 + l_seq
+
+        #CIGARs with more than 65535 operations are stored in the CG tag,
+        #while the record itself contains kSmN placeholder
+        if (n_cigar_op == 2 and cigar[0] == (l_seq << 4 | 4) and
+                cigar[1] & 0xf == 3):
+            long_cigar = _find_cigar_tag(data, offset, start + block_size)
+            if long_cigar is not None:
+                cigar = long_cigar
+
+        if not cigar:
+            cigar_str = b"*"
+        else:
+            cigar_str = b"".join(map(_CIGAR_STRINGS.__getitem__, cigar))
+
+        if not l_seq or not decode_seq or flag & self.skip_seq_flags:
+            seq_str = b"*"
+        else:
+            seq_str = _decode_seq(data[seq_offset : seq_offset + (l_seq + 1) // 2],
+                                  l_seq)
+
+        rname = self.ref_names[ref_id] if ref_id >= 0 else b"*"
+        fields = _BYTES("\t%d\t" % flag) + rname + _BYTES("\t%d\t%d\t" % (pos + 1, mapq))
+        return b"".join([read_name, fields, cigar_str, b"\t*\t0\t0\t",
+                         seq_str, b"\t*\n"])
+
+
+def is_bgzf(filename):
+    """
+    Checks if the gzip'ed file is BGZF (has block size in the extra field)
+    """
+    with open(filename, "rb") as f:
+        header = f.read(_BLOCK_HEADER.size + 4)
+    return (len(header) == _BLOCK_HEADER.size + 4 and
+            header[:2] == b"\x1f\x8b" and bytearray(header[3:4])[0] & 4 and
+            header[12:14] == b"BC")
+
+
+def _inflate(block_data):
+    return zlib.decompress(block_data, -15)
+
+
+def _decode_seq(packed_seq, l_seq):
+    """
+    Converts 4-bit packed sequence into letters
+    """
+    out_seq = bytearray(len(packed_seq) * 2)
+    out_seq[0::2] = packed_seq.translate(_SEQ_HIGH)
+    out_seq[1::2] = packed_seq.translate(_SEQ_LOW)
+    return bytes(out_seq[:l_seq])
+
+
+def _find_cigar_tag(data, offset, end):
+    """
+    Looks for the CG:B:I tag and returns the CIGAR operations it stores
+    """
+    while offset + 3 <= end:
+        tag = data[offset : offset + 2]
+        val_type = data[offset + 2 : offset + 3]
+        offset += 3
+        if val_type in _TAG_SIZES:
+            offset += _TAG_SIZES[val_type]
+        elif val_type == b"Z" or val_type == b"H":
+            offset = data.index(b"\0", offset, end) + 1
+        elif val_type == b"B":
+            sub_type = data[offset : offset + 1]
+            count = struct.unpack_from("<i", data, offset + 1)[0]
+            offset += 5
+            if tag == b"CG" and sub_type == b"I":
+                return struct.unpack_from("<%dI" % count, data, offset)
+            offset += _TAG_SIZES[sub_type] * count
+        else:
+            raise BamError("Unknown BAM tag type")
+    return None
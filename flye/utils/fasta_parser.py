@@ -11,6 +11,15 @@ import logging
 import gzip
 import io
 import sys
+import os
+import mmap
+import subprocess
+import multiprocessing
+from collections import deque
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 #In Python2, everything is bytes (=str)
 #In Python3, we are doing IO in bytes, but everywhere else strngs = unicode
@@ -24,10 +33,18 @@ else:
     _BYTES = str.encode
 
 from flye.six.moves import range
+from flye.utils.utils import which
+from flye.utils.bam_parser import BgzfReader, is_bgzf
 
 
 logger = logging.getLogger()
 
+PIGZ_BIN = "pigz"
+#approximate size of the record-aligned blocks, parsed by worker processes
+PARSE_BLOCK_SIZE = 16 * 1024 * 1024
+#characters that are stripped from sequence lines
+_WHITESPACE = b" \t\r\n\x0b\x0c"
+
 
 class FastaError(Exception):
     pass
@@ -45,14 +62,148 @@ def read_sequence_dict(filename):
     return seq_dict
 
 
-def read_sequence_lengths(filename):
+def read_sequence_dict_bytes(filename):
+    """
+    Same as read_sequence_dict, but sequences are kept as bytes
+    """
     seq_dict = {}
-    for hdr, seq in stream_sequence(filename):
-        seq_dict[hdr] = len(seq)
+    for hdr, seq in stream_sequence_bytes(filename):
+        seq_dict[hdr] = seq
+    return seq_dict
+
+
+class IndexedFasta(Mapping):
+    """
+    Read-only dictionary of Fasta/q sequences, which are read on demand
+    from memory-mapped files. Uses an up-to-date .fai index if it exists,
+    otherwise the index is built in memory. Gzip'ed files can not be
+    mapped and are loaded into memory. If multiple files are given,
+    records from the latter ones take precedence (like dict.update()).
+    Should be closed after use (or used as a context manager)
+    """
+    def __init__(self, filenames):
+        if not isinstance(filenames, (list, tuple)):
+            filenames = [filenames]
+
+        self.handles = []
+        self.maps = []
+        #name -> (map id, start, end, length). Sequences of
+        #gzip'ed files are stored as (None, sequence, 0, length)
+        self.index = {}
+        for filename in filenames:
+            self._add_file(filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        for mm in self.maps:
+            if mm is not None:
+                mm.close()
+        for handle in self.handles:
+            handle.close()
+        self.maps = []
+        self.handles = []
+
+    def __getitem__(self, name):
+        return _STR(self.get_bytes(name))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def seq_len(self, name):
+        """
+        Returns sequence length without reading the sequence
+        """
+        return self.index[name][3]
+
+    def get_bytes(self, name):
+        map_id, start, end, length = self.index[name]
+        if map_id is None:
+            return _BYTES(start)
+
+        seq = self.maps[map_id][start : end]
+        if len(seq) != length:
+            seq = seq.translate(None, _WHITESPACE)
+        if not _validate_seq(seq):
+            raise FastaError("Invalid char while reading {0}"
+                             .format(self.handles[map_id].name))
+        return _to_acgt_bytes(seq)
+
+    def _add_file(self, filename):
+        try:
+            gzipped, fastq = _is_fastq(filename)
+            if gzipped:
+                for hdr, seq in stream_sequence(filename):
+                    self.index[hdr] = (None, seq, 0, len(seq))
+                return
+
+            handle = open(filename, "rb")
+            if os.path.getsize(filename) == 0:
+                handle.close()
+                return
+            mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            self.handles.append(handle)
+            self.maps.append(mm)
+            map_id = len(self.maps) - 1
+
+            fai_file = filename + ".fai"
+            if (not fastq and os.path.exists(fai_file) and
+                    os.path.getmtime(fai_file) >= os.path.getmtime(filename)):
+                entries = _read_fai(fai_file)
+            elif fastq:
+                entries = _index_fastq(mm, filename)
+            else:
+                entries = _index_fasta(mm)
+
+            for name, start, end, length in entries:
+                self.index[_STR(name)] = (map_id, start, end, length)
+
+        except IOError as e:
+            raise FastaError(e)
+
+
+def read_sequence_lengths(filename, num_proc=1):
+    """
+    Reads lengths of Fasta/q sequences without building the sequence
+    strings. The file is split into record-aligned blocks that are
+    parsed by num_proc processes
+    """
+    seq_dict = {}
+    for hdr, seq_len in _parse_blocks(filename, num_proc, lengths_only=True):
+        seq_dict[hdr] = seq_len
     return seq_dict
 
 
-def stream_sequence(filename):
+def stream_sequence(filename, num_proc=1):
+    """
+    Streams (header, sequence) pairs from Fasta/q file (could be gzip'ed).
+    If num_proc > 1, the input is parsed in blocks by a process pool
+    """
+    for hdr, seq in stream_sequence_bytes(filename, num_proc):
+        yield hdr, _STR(seq)
+
+
+def stream_sequence_bytes(filename, num_proc=1):
+    """
+    Same as stream_sequence, but sequences are yielded as bytes
+    (headers are still unicode strings)
+    """
+    if num_proc > 1:
+        for rec in _parse_blocks(filename, num_proc, lengths_only=False):
+            yield rec
+        return
+
     try:
         gzipped, fastq = _is_fastq(filename)
 
@@ -68,13 +219,13 @@ def stream_sequence(filename):
                 if not _validate_seq(seq):
                     raise FastaError("Invalid char while reading {0}"
                                      .format(filename))
-                yield _STR(hdr), _STR(_to_acgt_bytes(seq))
+                yield _STR(hdr), _to_acgt_bytes(seq)
         else:
             for hdr, seq in _read_fasta(handle):
                 if not _validate_seq(seq):
                     raise FastaError("Invalid char while reading {0}"
                                      .format(filename))
-                yield _STR(hdr), _STR(_to_acgt_bytes(seq))
+                yield _STR(hdr), _to_acgt_bytes(seq)
 
     except IOError as e:
         raise FastaError(e)
@@ -84,30 +235,434 @@ def write_fasta_dict(fasta_dict, filename):
     """
     Writes dictionary with fasta to file
     """
-    with open(filename, "w") as f:
+    with open(filename, "wb") as f:
         for header in sorted(fasta_dict):
-            f.write(">{0}\n".format(header))
+            write_fasta_record(f, header, fasta_dict[header])
 
-            for i in range(0, len(fasta_dict[header]), 60):
-                f.write(fasta_dict[header][i:i + 60] + "\n")
+
+def write_fasta_record(handle, header, seq):
+    """
+    Writes a single sequence into binary file handle,
+    wrapping it into 60-character lines
+    """
+    if not isinstance(seq, bytes):
+        seq = _BYTES(seq)
+    lines = [_BYTES(">{0}".format(header))]
+    lines.extend([seq[i:i + 60] for i in range(0, len(seq), 60)])
+    lines.append(b"")
+    handle.write(b"\n".join(lines))
 
 
 def reverse_complement(unicode_str):
-    return _STR(reverse_complement_bytes(_BYTES(unicode_str)))
+    return unicode_str.translate(reverse_complement.COMPL)[::-1]
 
 
 def reverse_complement_bytes(bytes_str):
     return bytes_str.translate(reverse_complement_bytes.COMPL)[::-1]
 reverse_complement_bytes.COMPL = maketrans(b"ATGCURYKMSWBVDHNXatgcurykmswbvdhnx",
                                            b"TACGAYRMKSWVBHDNXtacgayrmkswvbhdnx")
+#str.translate has a fast path for ASCII-only tables, so unicode
+#strings are complemented without converting them to bytes
+if sys.version_info < (3, 0):
+    reverse_complement.COMPL = reverse_complement_bytes.COMPL
+else:
+    reverse_complement.COMPL = str.maketrans("ATGCURYKMSWBVDHNXatgcurykmswbvdhnx",
+                                             "TACGAYRMKSWVBHDNXtacgayrmkswvbhdnx")
 
 
 def to_acgt(unicode_str):
     return _STR(_to_acgt_bytes(_BYTES(unicode_str)))
 
 
+def to_acgt_bytes(bytes_str):
+    return _to_acgt_bytes(bytes_str)
+
+
 #Internal functions: use bytes for faster operations
 
+def _index_fasta(mm):
+    """
+    Returns the list of (name, start, end, length) for the
+    sequences of memory-mapped fasta file
+    """
+    entries = []
+    if mm[0 : 1] == b">":
+        hdr_start = 0
+    else:
+        hdr_start = mm.find(b"\n>") + 1
+        if hdr_start == 0:
+            return entries
+
+    while True:
+        hdr_end = mm.find(b"\n", hdr_start)
+        if hdr_end < 0:
+            hdr_end = len(mm)
+        name = mm[hdr_start + 1 : hdr_end].split()[0]
+        next_hdr = mm.find(b"\n>", hdr_end)
+        seq_start = min(hdr_end + 1, len(mm))
+        seq_end = next_hdr + 1 if next_hdr >= 0 else len(mm)
+        seq = mm[seq_start : seq_end]
+        if b">" in seq:
+            #headers with leading whitespace
+            return _index_fasta_lines(mm)
+        length = len(seq.translate(None, _WHITESPACE))
+        entries.append((name, seq_start, seq_end, length))
+        if next_hdr < 0:
+            break
+        hdr_start = next_hdr + 1
+
+    #_read_fasta skips the last record if it does not have a sequence
+    if entries[-1][3] == 0:
+        entries.pop()
+    return entries
+
+
+def _index_fasta_lines(mm):
+    """
+    Slower version of _index_fasta that strips every line
+    """
+    entries = []
+    name = None
+    seq_start = None
+    length = 0
+    mm.seek(0)
+    while True:
+        line_start = mm.tell()
+        line = mm.readline()
+        if not line:
+            break
+        stripped = line.strip()
+        if not stripped:
+            continue
+
+        if stripped.startswith(b">"):
+            if name is not None:
+                entries.append((name, seq_start, line_start, length))
+            name = stripped[1:].split()[0]
+            seq_start = mm.tell()
+            length = 0
+        else:
+            length += len(stripped)
+
+    if name is not None and length:
+        entries.append((name, seq_start, len(mm), length))
+    return entries
+
+
+def _index_fastq(mm, filename):
+    """
+    Returns the list of (name, start, end, length) for the
+    sequences of memory-mapped fastq file. Only single-line records
+    are supported (as in _read_fastq)
+    """
+    entries = []
+    name = None
+    seq_start = None
+    seq_end = None
+    state_counter = 0
+    no = -1
+    mm.seek(0)
+    while True:
+        no += 1
+        line_start = mm.tell()
+        line = mm.readline()
+        if not line:
+            break
+        stripped = line.strip()
+        if not stripped:
+            continue
+
+        if state_counter == 0:
+            if stripped[0 : 1] != b"@":
+                raise FastaError("Fastq format error: {0} at line {1}"
+                                 .format(filename, no))
+            name = stripped[1:].split()[0]
+
+        if state_counter == 1:
+            seq_start = line_start + len(line) - len(line.lstrip())
+            seq_end = seq_start + len(stripped)
+
+        if state_counter == 2:
+            if stripped[0 : 1] != b"+":
+                raise FastaError("Fastq format error (multi-line records "
+                                 "are not supported): {0} at line {1}"
+                                 .format(filename, no))
+
+        #otherwise, a multi-line quality would be taken for the next record
+        if state_counter == 3:
+            if len(stripped) != seq_end - seq_start:
+                raise FastaError("Fastq format error (quality length does not "
+                                 "match sequence length): {0} at line {1}"
+                                 .format(filename, no))
+            entries.append((name, seq_start, seq_end, seq_end - seq_start))
+
+        state_counter = (state_counter + 1) % 4
+    return entries
+
+
+def _read_fai(fai_file):
+    """
+    Reads samtools faidx index
+    """
+    entries = []
+    with open(fai_file, "rb") as f:
+        for line in f:
+            fields = line.split(b"\t")
+            if len(fields) < 5:
+                continue
+            name = fields[0]
+            length, offset, line_bases, line_width = map(int, fields[1:5])
+            end = offset
+            if line_bases > 0:
+                end += (length // line_bases) * line_width + length % line_bases
+            entries.append((name, offset, end, length))
+    return entries
+
+
+def _parse_blocks(filename, num_proc, lengths_only):
+    """
+    Splits the file into blocks of whole records and parses them
+    in parallel, preserving the file order. Yields (header, length)
+    or (header, bytes sequence) pairs
+    """
+    try:
+        gzipped, fastq = _is_fastq(filename)
+        pool = multiprocessing.Pool(num_proc) if num_proc > 1 else None
+        try:
+            chunks = _decompressed_chunks(filename, gzipped, num_proc)
+            tasks = ((filename, fastq, lengths_only, block, first_line, last)
+                     for block, first_line, last in _record_blocks(chunks, fastq))
+
+            #only a few blocks are kept in flight to limit memory usage
+            pending = deque()
+            for task in tasks:
+                if pool is None:
+                    pending.append(_parse_block(task))
+                else:
+                    pending.append(pool.apply_async(_parse_block, (task,)))
+                if len(pending) > 2 * num_proc:
+                    for rec in _block_result(pending.popleft()):
+                        yield rec
+            while pending:
+                for rec in _block_result(pending.popleft()):
+                    yield rec
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    except IOError as e:
+        raise FastaError(e)
+
+
+def _block_result(result):
+    if not isinstance(result, tuple):
+        result = result.get()
+    records, non_acgt = result
+    if non_acgt:
+        _warn_non_acgt()
+    return records
+
+
+def _decompressed_chunks(filename, gzipped, num_proc):
+    """
+    Yields decompressed file contents in large chunks. For multiple
+    processes, gzip'ed input is inflated in parallel if it is
+    BGZF-compressed, or by pigz if it is available
+    """
+    if gzipped and num_proc > 1 and is_bgzf(filename):
+        reader = BgzfReader(filename, num_proc)
+        try:
+            for chunk in reader.iter_batches():
+                yield chunk
+        finally:
+            reader.close()
+        return
+
+    if gzipped and num_proc > 1 and which(PIGZ_BIN):
+        proc = subprocess.Popen([PIGZ_BIN, "-dc", "-p", str(num_proc), filename],
+                                stdout=subprocess.PIPE)
+        finished = False
+        try:
+            while True:
+                chunk = proc.stdout.read(PARSE_BLOCK_SIZE)
+                if not chunk:
+                    finished = True
+                    break
+                yield chunk
+        finally:
+            proc.stdout.close()
+            if not finished:
+                proc.kill()
+            if proc.wait() != 0 and finished:
+                raise FastaError("Error decompressing " + filename)
+        return
+
+    if not gzipped:
+        handle = open(filename, "rb")
+    else:
+        handle = io.BufferedReader(gzip.open(filename, "rb"))
+    with handle:
+        while True:
+            chunk = handle.read(PARSE_BLOCK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _record_blocks(chunks, fastq):
+    """
+    Regroups decompressed chunks into blocks, each containing
+    whole records only. Yields (block, first line number, is last block)
+    """
+    tail = b""
+    prev_block = None
+    first_line = 0
+    for chunk in chunks:
+        data = tail + chunk
+        if len(data) < PARSE_BLOCK_SIZE:
+            tail = data
+            continue
+
+        if fastq:
+            cut = _fastq_block_end(data)
+        else:
+            cut = data.rfind(b"\n>") + 1
+        if cut <= 0:
+            tail = data
+            continue
+
+        if prev_block is not None:
+            yield prev_block, first_line, False
+            first_line += prev_block.count(b"\n")
+        prev_block = data[:cut]
+        tail = data[cut:]
+
+    if prev_block is not None:
+        if not tail:
+            yield prev_block, first_line, True
+            return
+        yield prev_block, first_line, False
+        first_line += prev_block.count(b"\n")
+    if tail:
+        yield tail, first_line, True
+
+
+def _fastq_block_end(data):
+    """
+    Returns the start of the last complete fastq record (so that the block
+    ends with whole records), or 0 if there is no such position
+    """
+    end = data.rfind(b"\n") + 1
+    if end == 0:
+        return 0
+
+    #if lines are regular, the last complete record starts 4 lines
+    #before the last multiple of 4
+    cut = end
+    for _ in range(data.count(b"\n", 0, end) % 4 + 4):
+        if cut <= 1:
+            return 0
+        cut = data.rfind(b"\n", 0, cut - 1) + 1
+    plus_line = data.find(b"\n", data.find(b"\n", cut) + 1) + 1
+    if data[cut : cut + 1] == b"@" and data[plus_line : plus_line + 1] == b"+":
+        return cut
+
+    #otherwise, there are blank or whitespace-only lines - count
+    #non-empty lines one by one
+    cut = 0
+    num_lines = 0
+    line_start = 0
+    while line_start < end:
+        line_end = data.index(b"\n", line_start) + 1
+        if data[line_start : line_end].strip():
+            num_lines += 1
+            if num_lines % 4 == 0:
+                cut = line_end
+        line_start = line_end
+    return cut
+
+
+def _parse_block(task):
+    """
+    Parses a block of whole fasta/q records. Returns the list of
+    (header, length) or (header, bytes sequence) pairs and a flag if
+    non-ACGT characters were converted
+    """
+    filename, fastq, lengths_only, block, first_line, last_block = task
+    def parse(block):
+        if fastq:
+            return _parse_fastq_block(filename, block, first_line)
+        return _parse_fasta_block(filename, block, last_block)
+
+    try:
+        records = parse(block)
+    except FastaError:
+        #lines with leading / trailing whitespace (such as CR) always
+        #fail validation. Strip them, as line parsers do, and try again
+        records = parse(b"\n".join([line.strip() for line in block.split(b"\n")]))
+
+    out_records = []
+    non_acgt = False
+    for hdr, seq in records:
+        if lengths_only:
+            out_records.append((_STR(hdr), len(seq)))
+        else:
+            acgt_seq = _translate_acgt(seq)
+            non_acgt |= acgt_seq is not seq
+            out_records.append((_STR(hdr), acgt_seq))
+    return out_records, non_acgt
+
+
+def _parse_fasta_block(filename, block, last_block):
+    """
+    Block version of _read_fasta
+    """
+    prefix = b""
+    if not block.startswith(b">"):
+        header_pos = block.find(b"\n>")
+        if header_pos < 0:
+            return []
+        #like _read_fasta, lines before the first header go to the first sequence
+        prefix = block[:header_pos + 1]
+        block = block[header_pos + 1:]
+
+    records = []
+    for record in block[1:].split(b"\n>"):
+        header_line, _, seq = record.partition(b"\n")
+        seq = (prefix + seq).replace(b"\n", b"")
+        prefix = b""
+        if not _validate_seq(seq):
+            raise FastaError("Invalid char while reading {0}".format(filename))
+        records.append((header_line.split()[0], seq))
+
+    #_read_fasta skips the last record if it does not have a sequence
+    if last_block and records and not records[-1][1]:
+        records.pop()
+    return records
+
+
+def _parse_fastq_block(filename, block, first_line):
+    """
+    Block version of _read_fastq
+    """
+    lines = block.split(b"\n")
+    if b"" in lines:
+        lines = [line for line in lines if line]
+
+    for i in range(0, len(lines), 4):
+        if lines[i][0 : 1] != b"@":
+            raise FastaError("Fastq format error: {0} at line {1}"
+                             .format(filename, first_line + i))
+        if i + 2 < len(lines) and lines[i + 2][0 : 1] != b"+":
+            raise FastaError("Fastq format error: {0} at line {1}"
+                             .format(filename, first_line + i + 2))
+
+    num_lines = len(lines) - len(lines) % 4
+    if not _validate_seq(b"".join(lines[1 : num_lines : 4])):
+        raise FastaError("Invalid char while reading {0}".format(filename))
+    return [(lines[i][1:].split()[0], lines[i + 1]) for i in range(0, num_lines, 4)]
+
+
 def _is_fastq(filename):
     suffix = filename.rsplit(".")[-1]
     without_gz = filename
@@ -203,17 +758,31 @@ def _to_acgt_bytes(dna_str):
     assumes tha all characters are valid.
     dna_str : bytes
     """
-    if len(dna_str.translate(None, _to_acgt_bytes.ACGT_CHARS)) == 0:
+    acgt_str = _translate_acgt(dna_str)
+    if acgt_str is not dna_str:
+        _warn_non_acgt()
+    return acgt_str
+
+
+def _translate_acgt(dna_str):
+    """
+    Same as _to_acgt_bytes, but without the warning.
+    Returns the same object if there is nothing to convert
+    """
+    if len(dna_str.translate(None, _translate_acgt.ACGT_CHARS)) == 0:
         return dna_str
     #if len(dna_str.strip(_to_acgt_bytes.ACGT_CHARS)) == 0:
     #    return dna_str
     else:
-        if not _to_acgt_bytes.ACGT_WARN:
-            _to_acgt_bytes.ACGT_WARN = True
-            logger.warning("Input contain non-ACGT characters - "
-                           "they will be converted to arbitrary ACGTs")
-        return dna_str.translate(_to_acgt_bytes.TO_ACGT)
-_to_acgt_bytes.ACGT_WARN = False
-_to_acgt_bytes.ACGT_CHARS = b"ACGTacgt"
-_to_acgt_bytes.TO_ACGT = maketrans(b"URYKMSWBVDHNXurykmswbvdhnx",
-                                   b"ACGTACGTACGTAacgtacgtacgta")
+        return dna_str.translate(_translate_acgt.TO_ACGT)
+_translate_acgt.ACGT_CHARS = b"ACGTacgt"
+_translate_acgt.TO_ACGT = maketrans(b"URYKMSWBVDHNXurykmswbvdhnx",
+                                    b"ACGTACGTACGTAacgtacgtacgta")
+
+
+def _warn_non_acgt():
+    if not _warn_non_acgt.ACGT_WARN:
+        _warn_non_acgt.ACGT_WARN = True
+        logger.warning("Input contain non-ACGT characters - "
+                       "they will be converted to arbitrary ACGTs")
+_warn_non_acgt.ACGT_WARN = False
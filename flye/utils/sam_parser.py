@@ -12,7 +12,7 @@ from __future__ import division
 import os
 import re
 import sys
-from collections import namedtuple, defaultdict
+from collections import defaultdict, deque
 import subprocess
 import logging
 import multiprocessing
@@ -21,6 +21,11 @@ import time
 import gzip
 import io
 import random
+import mmap
+import tempfile
+import operator
+import atexit
+import shutil
 
 #In Python2, everything is bytes (=str)
 #In Python3, we are doing IO in bytes, but everywhere else strngs = unicode
@@ -34,30 +39,147 @@ else:
     _BYTES = str.encode
 
 from flye.six.moves import range
+from flye.six.moves import queue
 from flye.six import iteritems
 
 import flye.utils.fasta_parser as fp
+from flye.utils.bam_parser import BamReader, BamError
 
 logger = logging.getLogger()
 
 SAMTOOLS_BIN = "flye-samtools"
-Alignment = namedtuple("Alignment", ["qry_id", "trg_id", "qry_start", "qry_end",
-                                     "qry_sign", "qry_len", "trg_start",
-                                     "trg_end", "trg_sign", "trg_len",
-                                     "qry_seq", "trg_seq", "err_rate",
-                                     "is_secondary"])
+#size limits of the shared memory buffer used to pass chunks from
+#the IO process. Within the limits, it is sized by the alignment file
+SHARED_BUFFER_SIZE = 1024 * 1024 * 1024
+MIN_SHARED_BUFFER_SIZE = 16 * 1024 * 1024
+#expected ratio of SAM text to the compressed (gzip / BAM) file size
+COMPRESSION_RATIO = 4
+#maximum number of chunks that reside in the shared buffer simultaneously
+BUFFER_SLOTS = 64
+#threads used to inflate BAM blocks in the IO process
+BAM_IO_THREADS = 4
+_CIGAR_RE = re.compile(b"([0-9]+)([MIDNSHP=X])")
 
 
 class AlignmentException(Exception):
     pass
 
 
+class Alignment(object):
+    """
+    Stores a read alignment. Alignments parsed from SAM do not keep
+    the gapped query / target strings: only the read sequence, a reference
+    to the contig sequence and the CIGAR string are stored, and the gapped
+    strings are rebuilt each time qry_seq / trg_seq are accessed.
+    Alignments could also be created directly from the gapped strings.
+    """
+    __slots__ = ("qry_id", "trg_id", "qry_start", "qry_end", "qry_sign",
+                 "qry_len", "trg_start", "trg_end", "trg_sign", "trg_len",
+                 "err_rate", "is_secondary", "_qry_seq", "_trg_seq",
+                 "_read_str", "_ctg_str", "_cigar_str")
+
+    def __init__(self, qry_id, trg_id, qry_start, qry_end, qry_sign, qry_len,
+                 trg_start, trg_end, trg_sign, trg_len, qry_seq, trg_seq,
+                 err_rate, is_secondary):
+        self.qry_id = qry_id
+        self.trg_id = trg_id
+        self.qry_start = qry_start
+        self.qry_end = qry_end
+        self.qry_sign = qry_sign
+        self.qry_len = qry_len
+        self.trg_start = trg_start
+        self.trg_end = trg_end
+        self.trg_sign = trg_sign
+        self.trg_len = trg_len
+        self.err_rate = err_rate
+        self.is_secondary = is_secondary
+        self._qry_seq = qry_seq
+        self._trg_seq = trg_seq
+        self._read_str = None
+        self._ctg_str = None
+        self._cigar_str = None
+
+    @classmethod
+    def from_cigar(cls, qry_id, trg_id, qry_start, qry_end, qry_sign, qry_len,
+                   trg_start, trg_end, trg_sign, trg_len, read_str, ctg_str,
+                   cigar_str, err_rate, is_secondary):
+        """
+        Creates alignment backed by the (uppercase) read bytes,
+        contig bytes and the CIGAR string
+        """
+        aln = cls(qry_id, trg_id, qry_start, qry_end, qry_sign, qry_len,
+                  trg_start, trg_end, trg_sign, trg_len, None, None,
+                  err_rate, is_secondary)
+        aln._read_str = read_str
+        aln._ctg_str = ctg_str
+        aln._cigar_str = cigar_str
+        return aln
+
+    @property
+    def qry_seq(self):
+        if self._qry_seq is not None:
+            return self._qry_seq
+        return _STR(self._gapped_seq(True))
+
+    @property
+    def trg_seq(self):
+        if self._trg_seq is not None:
+            return self._trg_seq
+        return _STR(self._gapped_seq(False))
+
+    def _gapped_seq(self, query):
+        """
+        Replays CIGAR and builds gapped query (or target) sequence.
+        The string is not cached - callers that access it repeatedly
+        should keep a local copy.
+        """
+        read_str = self._read_str
+        ctg_str = self._ctg_str
+        qry_pos = 0
+        trg_pos = self.trg_start
+        out_seq = []
+        for size, op in _cigar_runs(_CIGAR_RE, self._cigar_str):
+            if op == b"M":
+                if query:
+                    out_seq.append(read_str[qry_pos : qry_pos + size])
+                else:
+                    out_seq.append(ctg_str[trg_pos : trg_pos + size])
+                qry_pos += size
+                trg_pos += size
+            elif op == b"I":
+                if query:
+                    out_seq.append(read_str[qry_pos : qry_pos + size])
+                else:
+                    out_seq.append(b"-" * size)
+                qry_pos += size
+            elif op == b"D":
+                if query:
+                    out_seq.append(b"-" * size)
+                else:
+                    out_seq.append(ctg_str[trg_pos : trg_pos + size])
+                trg_pos += size
+            elif op == b"S":
+                qry_pos += size
+        return b"".join(out_seq)
+
+    def __repr__(self):
+        return ("Alignment(qry_id={0!r}, trg_id={1!r}, qry_start={2}, "
+                "qry_end={3}, qry_sign={4!r}, qry_len={5}, trg_start={6}, "
+                "trg_end={7}, trg_sign={8!r}, trg_len={9}, err_rate={10}, "
+                "is_secondary={11})"
+                .format(self.qry_id, self.trg_id, self.qry_start, self.qry_end,
+                        self.qry_sign, self.qry_len, self.trg_start,
+                        self.trg_end, self.trg_sign, self.trg_len,
+                        self.err_rate, self.is_secondary))
+
+
 class PafHit(object):
     """
     Stores paf alignment
     """
     __slots__ = ("query", "query_length", "query_start", "query_end",
-                 "target", "target_length", "target_start", "target_end")
+                 "strand", "target", "target_length", "target_start",
+                 "target_end", "matches", "block_length", "mapq")
     def __init__(self, raw_hit):
         hit = raw_hit.split()
 
@@ -65,12 +187,17 @@ class PafHit(object):
         self.query_length = int(hit[1])
         self.query_start = int(hit[2])
         self.query_end = int(hit[3])
+        self.strand = hit[4]
 
         self.target = hit[5]
         self.target_length = int(hit[6])
         self.target_start = int(hit[7])
         self.target_end = int(hit[8])
 
+        self.matches = int(hit[9])
+        self.block_length = int(hit[10])
+        self.mapq = int(hit[11])
+
     def query_mapping_length(self):
         return self.query_end - self.query_start + 1
 
@@ -99,6 +226,23 @@ def read_paf(filename):
             yield PafHit(_STR(raw_hit))
 
 
+def read_mapped_reads(bam_alignment):
+    """
+    Streams out (read name, reference name) for each mapped record
+    of the BAM alignment, including secondary ones
+    """
+    try:
+        bam_reader = BamReader(bam_alignment, BAM_IO_THREADS)
+        try:
+            for read_name, ref_name in bam_reader.mapped_reads():
+                yield _STR(read_name), _STR(ref_name)
+        finally:
+            bam_reader.close()
+    except BamError as e:
+        raise AlignmentException("Error reading {0}: {1}"
+                                 .format(bam_alignment, e))
+
+
 def read_paf_grouped(filename):
     """
     Outputs chunks of alignments for each (query, target)pair.
@@ -120,30 +264,296 @@ def read_paf_grouped(filename):
             yield target_hits[trg]
 
 
-class SynchronizedSamReader(object):
+class AlignmentChunkParser(object):
+    """
+    Converts SAM records of a single contig chunk into alignments.
+    Common part of the SAM readers below.
+    """
+    def __init__(self, reference_fasta, max_coverage, use_secondary):
+        #will not be changed during exceution, each process has its own copy.
+        #Reference could be a dict or fp.IndexedFasta, contig sequences
+        #are fetched (and converted to bytes) once per chunk
+        self.ref_fasta = reference_fasta
+        if isinstance(reference_fasta, fp.IndexedFasta):
+            self.ref_lengths = {_BYTES(h) : reference_fasta.seq_len(h)
+                                for h in reference_fasta}
+        else:
+            self.ref_lengths = {_BYTES(h) : len(s)
+                                for (h, s) in iteritems(reference_fasta)}
+        self.change_strand = True
+        self.max_coverage = max_coverage
+        self.use_secondary = use_secondary
+        self.cigar_parser = _CIGAR_RE
+        #SEQ is not decoded for BAM records that are going to be skipped
+        self.skip_seq_flags = 0x4 if use_secondary else 0x4 | 0x100
+
+        #worker utilization: each process reports its active time
+        #(from the first request to the end of input) and the amount of work
+        self.shared_stats_queue = multiprocessing.Queue()
+        self.shared_num_workers = multiprocessing.Value(ctypes.c_int, 0)
+        self.worker_start = None
+        self.worker_chunks = 0
+        self.worker_records = 0
+        self.worker_reported = False
+
+    def _worker_active(self):
+        if self.worker_start is None:
+            self.worker_start = time.time()
+            with self.shared_num_workers.get_lock():
+                self.shared_num_workers.value += 1
+
+    def _worker_finished(self):
+        if self.worker_start is not None and not self.worker_reported:
+            self.worker_reported = True
+            self.shared_stats_queue.put((time.time() - self.worker_start,
+                                         self.worker_chunks,
+                                         self.worker_records))
+
+    def log_utilization(self):
+        """
+        Logs how evenly the work was distributed between the worker
+        processes. Utilization is the active time of a worker relative
+        to the longest one. Should be called after the workers are joined.
+        """
+        worker_stats = []
+        for _ in range(self.shared_num_workers.value):
+            try:
+                worker_stats.append(self.shared_stats_queue.get(timeout=1))
+            except queue.Empty:
+                break
+        if not worker_stats:
+            return
+
+        max_time = max(w[0] for w in worker_stats) or 1
+        utilization = [100 * w[0] / max_time for w in worker_stats]
+        logger.debug("Worker utilization: mean %.0f%%, min %.0f%% "
+                     "(%d workers, %d chunks)",
+                     sum(utilization) / len(utilization), min(utilization),
+                     len(worker_stats), sum(w[1] for w in worker_stats))
+        logger.debug("Worker time (s) / chunks / records: %s",
+                     ", ".join("{0:.1f}/{1}/{2}".format(*w)
+                               for w in sorted(worker_stats, reverse=True)))
+
+    def _get_contig_seq(self, ctg_name):
+        if isinstance(self.ref_fasta, fp.IndexedFasta):
+            return self.ref_fasta.get_bytes(_STR(ctg_name)).upper()
+        ctg_seq = self.ref_fasta[_STR(ctg_name)]
+        if not isinstance(ctg_seq, bytes):
+            ctg_seq = _BYTES(ctg_seq)
+        return ctg_seq.upper()
+
+    def _parse_cigar(self, cigar_str, read_str, ctg_str, ctg_pos):
+        trg_start = ctg_pos - 1
+        trg_pos = ctg_pos - 1
+        qry_start = 0
+        qry_pos = 0
+        matches = 0
+        aln_len = 0
+
+        left_hard = True
+        left_soft = True
+        hard_clipped_left = 0
+        hard_clipped_right = 0
+        soft_clipped_left = 0
+        soft_clipped_right = 0
+        for size, op in _cigar_runs(self.cigar_parser, cigar_str):
+            if op == b"H":
+                if left_hard:
+                    qry_start += size
+                    hard_clipped_left += size
+                else:
+                    hard_clipped_right += size
+            elif op == b"S":
+                qry_pos += size
+                if left_soft:
+                    soft_clipped_left += size
+                else:
+                    soft_clipped_right += size
+            elif op == b"M":
+                qry_block = read_str[qry_pos : qry_pos + size]
+                trg_block = ctg_str[trg_pos : trg_pos + size]
+                #only M blocks could contain matches
+                matches += sum(map(operator.eq, qry_block, trg_block))
+                aln_len += size
+                qry_pos += size
+                trg_pos += size
+            elif op == b"I":
+                aln_len += size
+                qry_pos += size
+            elif op == b"D":
+                aln_len += size
+                trg_pos += size
+            else:
+                raise AlignmentException("Unsupported CIGAR operation: " + str(op))
+            left_hard = False
+            if op != b"H":
+                left_soft = False
+
+        err_rate = 1 - matches / aln_len
+
+        trg_end = trg_pos
+        qry_end = qry_pos + hard_clipped_left
+        qry_len = qry_end + hard_clipped_right
+        qry_start += soft_clipped_left
+        qry_end -= soft_clipped_right
+
+        return (trg_start, trg_end, len(ctg_str),
+                qry_start, qry_end, qry_len, err_rate)
+
+    def _sample_chunk(self, parsed_contig, chunk_buffer):
+        """
+        Shuffles the chunk in the same way as _parse_chunk does and
+        keeps only the records that would be parsed before the coverage
+        limit is reached, so the surplus is never transferred to workers.
+        The records are returned in the shuffled order and must be parsed
+        with sampled=True.
+        """
+        #only the last line of the file might be missing newline
+        if chunk_buffer and not chunk_buffer[-1].endswith(b"\n"):
+            chunk_buffer[-1] += b"\n"
+        return [chunk_buffer[i]
+                for i in self._sampled_order(parsed_contig, chunk_buffer)]
+
+    def _sampled_order(self, parsed_contig, chunk_buffer):
+        """
+        Returns the indices of the records kept by _sample_chunk,
+        in the shuffled order. Records only need the fields before SEQ
+        """
+        #shuffling indices gives the same permutation as shuffling lines
+        order = list(range(len(chunk_buffer)))
+        random.Random(42).shuffle(order)
+        if self.max_coverage is None or parsed_contig not in self.ref_lengths:
+            return order
+
+        contig_length = self.ref_lengths[parsed_contig]
+        sequence_length = 0
+        sampled_order = []
+        for i in order:
+            tokens = chunk_buffer[i].split(None, 11)
+            if len(tokens) < 11:
+                continue
+
+            flags = int(tokens[1])
+            if flags & 0x4: continue
+            if flags & 0x100 and not self.use_secondary: continue
+
+            sampled_order.append(i)
+
+            #aligned query length, same as qry_end - qry_start after parsing
+            for size, op in _cigar_runs(self.cigar_parser, tokens[5]):
+                if op == b"M" or op == b"I":
+                    sequence_length += size
+            if sequence_length // contig_length > self.max_coverage:
+                break
+
+        return sampled_order
+
+    def _parse_chunk(self, parsed_contig, chunk_buffer, sampled=False):
+        """
+        Parses raw SAM lines that belong to the given contig
+        """
+        #shuffle alignments so that they uniformly distributed. Use same seed for determinism
+        if not sampled:
+            random.Random(42).shuffle(chunk_buffer)
+
+        sequence_length = 0
+        alignments = []
+        contig_seqs = {}
+        for line in chunk_buffer:
+            tokens = line.strip().split()
+            if len(tokens) < 11:
+                #raise AlignmentException("Error reading SAM file")
+                continue
+
+            flags = int(tokens[1])
+            is_unmapped = flags & 0x4
+            is_secondary = flags & 0x100
+            #is_supplementary = flags & 0x800    #allow supplementary
+            #if is_unmapped or is_secondary: continue
+            if is_unmapped: continue
+            if is_secondary and not self.use_secondary: continue
+
+            read_id = tokens[0]
+            read_contig = tokens[2]
+            cigar_str = tokens[5]
+            read_str = tokens[9]
+            ctg_pos = int(tokens[3])
+            is_reversed = flags & 0x16
+            is_secondary = flags & 0x100
+
+            if read_str == b"*":
+                raise Exception("Error parsing SAM: record without read sequence")
+
+            if read_contig not in contig_seqs:
+                contig_seqs[read_contig] = self._get_contig_seq(read_contig)
+            ctg_str = contig_seqs[read_contig]
+
+            read_str = read_str.upper()
+            (trg_start, trg_end, trg_len,
+            qry_start, qry_end, qry_len, err_rate) = \
+                    self._parse_cigar(cigar_str, read_str, ctg_str, ctg_pos)
+
+            #OVERHANG = cfg.vals["read_aln_overhang"]
+            #if (float(qry_end - qry_start) / qry_len > self.min_aln_rate or
+            #        trg_start < OVERHANG or trg_len - trg_end < OVERHANG):
+            aln = Alignment.from_cigar(_STR(read_id), _STR(read_contig),
+                                       qry_start, qry_end, "-" if is_reversed else "+",
+                                       qry_len, trg_start, trg_end, "+", trg_len,
+                                       read_str, ctg_str,
+                                       cigar_str, err_rate, is_secondary)
+            alignments.append(aln)
+
+            sequence_length += qry_end - qry_start
+            contig_length = self.ref_lengths[parsed_contig]
+            if sequence_length // contig_length > self.max_coverage:
+                break
+
+        #then, alignments by read and by score
+        alignments.sort(key=lambda a: (a.qry_id, -(a.qry_end - a.qry_start)))
+
+        if parsed_contig is None:
+            return None, []
+        return _STR(parsed_contig), alignments
+
+
+class SynchronizedSamReader(AlignmentChunkParser):
     """
     Parses SAM file in multiple threads.
+    A separate IO process reads the file and places each contig chunk
+    into a shared memory ring buffer. Only the chunk descriptors
+    (contig, slot, offset, length) are passed through the queue.
+    If buffer_size is not given, it is estimated from the file size.
     """
     def __init__(self, sam_alignment, reference_fasta,
-                 max_coverage=None, use_secondary=False):
+                 max_coverage=None, use_secondary=False,
+                 buffer_size=None):
         #check that alignment exists
         if not os.path.exists(sam_alignment):
             raise AlignmentException("Can't open {0}".format(sam_alignment))
 
+        super(SynchronizedSamReader, self).__init__(reference_fasta, max_coverage,
+                                                    use_secondary)
+
         #will not be changed during exceution, each process has its own copy
         self.aln_path = sam_alignment
-        self.ref_fasta = {_BYTES(h) : _BYTES(s)
-                          for (h, s) in iteritems(reference_fasta)}
-        self.change_strand = True
-        self.max_coverage = max_coverage
-        self.use_secondary = use_secondary
-        self.cigar_parser = re.compile(b"[0-9]+[MIDNSHP=X]")
-
-        #will be shared between processes
-        self.shared_manager = multiprocessing.Manager()
-        self.shared_reader_queue = self.shared_manager.Queue()
+        if buffer_size is None:
+            buffer_size = _estimate_buffer_size(sam_alignment)
+        self.buffer_size = buffer_size
+        #chunks that do not fit into the buffer are spilled into this
+        #directory. It is removed on close, or at exit if a worker
+        #has died before fetching its chunk
+        aln_dir = os.path.dirname(os.path.abspath(sam_alignment))
+        self.spill_dir = tempfile.mkdtemp(prefix="sam_spill_", dir=aln_dir)
+        atexit.register(shutil.rmtree, self.spill_dir, True)
+
+        #will be shared between processes. The anonymous mapping
+        #is inherited by the forked IO and worker processes
+        self.shared_buffer = mmap.mmap(-1, buffer_size)
+        self.shared_released = multiprocessing.Array(ctypes.c_bool, BUFFER_SLOTS,
+                                                     lock=False)
+        self.shared_reader_queue = multiprocessing.Queue()
         self.shared_num_jobs = multiprocessing.Value(ctypes.c_int, 0)
-        self.shared_lock = self.shared_manager.Lock()
+        self.shared_lock = multiprocessing.Lock()
         self.shared_eof = multiprocessing.Value(ctypes.c_bool, False)
 
         #specific to IO thread
@@ -152,6 +562,9 @@ class SynchronizedSamReader(object):
         self.processed_contigs = set()
         self.chunk_buffer = []
         self.current_contig = None
+        self.ring_pending = deque()
+        self.ring_head = 0
+        self.next_slot = 0
 
         #start IO thread
         self.io_thread = \
@@ -163,6 +576,8 @@ class SynchronizedSamReader(object):
     def close(self):
         self.terminate_flag = True
         self.io_thread.join()
+        self.shared_buffer.close()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
         #print("Close IO thread")
 
     def _read_file_chunk(self, aln_file):
@@ -178,14 +593,11 @@ class SynchronizedSamReader(object):
 
             if _is_sam_header(line): continue
 
-            tab_1 = line.find(b"\t")
-            tab_2 = line.find(b"\t", tab_1 + 1)
-            tab_3 = line.find(b"\t", tab_2 + 1)
-            if tab_2 == -1 or tab_3 == -1:
+            read_contig = _get_sam_contig(line)
+            if read_contig is None:
                 #raise AlignmentException("Error reading SAM file")
                 continue
 
-            read_contig = line[tab_2 + 1 : tab_3]
             if read_contig in self.processed_contigs:
                 raise AlignmentException("Alignment file is not sorted")
 
@@ -212,6 +624,87 @@ class SynchronizedSamReader(object):
 
         return parsed_contig, chunk_to_return
 
+    def _allocate_buffer(self, length):
+        """
+        Finds a free region of the ring buffer for a new chunk.
+        Only called from the IO thread. Returns None if there is
+        not enough space until workers release older chunks.
+        """
+        pending = self.ring_pending
+        while pending and self.shared_released[pending[0][0]]:
+            pending.popleft()
+        if len(pending) >= BUFFER_SLOTS:
+            return None
+
+        if not pending:
+            self.ring_head = 0
+            offset = 0
+        else:
+            tail = pending[0][1]
+            if self.ring_head >= tail:
+                if self.ring_head + length <= self.buffer_size:
+                    offset = self.ring_head
+                elif length < tail:
+                    offset = 0
+                else:
+                    return None
+            else:
+                if self.ring_head + length < tail:
+                    offset = self.ring_head
+                else:
+                    return None
+
+        self.ring_head = offset + length
+        return offset
+
+    def _put_chunk(self, ctg_id, chunk_data):
+        """
+        Places the chunk into the shared buffer and publishes its descriptor.
+        Chunks that do not fit into the buffer are spilled to a temporary file.
+        Returns False if the chunk could not be placed yet.
+        """
+        if len(chunk_data) >= self.buffer_size:
+            fd, spill_path = tempfile.mkstemp(prefix="sam_chunk_",
+                                              dir=self.spill_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(chunk_data)
+            descriptor = (ctg_id, None, spill_path, len(chunk_data))
+
+        else:
+            offset = self._allocate_buffer(len(chunk_data))
+            if offset is None:
+                return False
+
+            slot = self.next_slot
+            self.next_slot = (self.next_slot + 1) % BUFFER_SLOTS
+            self.shared_released[slot] = False
+            self.shared_buffer[offset : offset + len(chunk_data)] = chunk_data
+            self.ring_pending.append((slot, offset))
+            descriptor = (ctg_id, slot, offset, len(chunk_data))
+
+        with self.shared_lock:
+            self.shared_reader_queue.put(descriptor)
+            self.shared_num_jobs.value += 1
+        return True
+
+    def _fetch_chunk(self, slot, offset, length):
+        """
+        Copies the chunk out of the shared buffer (or a spill file)
+        and releases the occupied space
+        """
+        if slot is None:
+            with open(offset, "rb") as f:
+                chunk_data = f.read()
+            os.remove(offset)
+        else:
+            chunk_data = self.shared_buffer[offset : offset + length]
+            self.shared_released[slot] = True
+
+        chunk_lines = chunk_data.split(b"\n")
+        if chunk_lines and not chunk_lines[-1]:
+            chunk_lines.pop()
+        return chunk_lines
+
     def _io_thread_worker(self):
         """
         This function reads the SAM file in a separate thread as needed.
@@ -223,185 +716,245 @@ class SynchronizedSamReader(object):
             gz = gzip.open(self.aln_path, "rb")
             aln_file = io.BufferedReader(gz)
         elif self.aln_path.endswith(".bam"):
-            aln_file = subprocess.Popen(SAMTOOLS_BIN + " view -@4 " + self.aln_path,
-                                        shell=True, stdout=subprocess.PIPE).stdout
+            aln_file = BamReader(self.aln_path, BAM_IO_THREADS,
+                                 self.skip_seq_flags).sam_lines()
         else:
             aln_file = open(self.aln_path, "rb")
 
+        ctg_id = None
+        chunk_data = None
         while True:
             if self.terminate_flag:
                 return
 
             #reached EOF and everything was read from the queue
-            if sam_eof and self.shared_num_jobs.value == 0:
+            if sam_eof and chunk_data is None and self.shared_num_jobs.value == 0:
                 self.shared_eof.value = True
                 #print("IO thread: finished")
                 return
 
-            if not sam_eof and self.shared_num_jobs.value < PRE_READ:
-                #with self.shared_ctx.lock:
-                #print("IO thread: Q size: ", self.shared_ctx.reader_queue.qsize())
+            if (chunk_data is None and not sam_eof and
+                    self.shared_num_jobs.value < PRE_READ):
                 ctg_id, chunk = self._read_file_chunk(aln_file)
                 if ctg_id is not None:
-                    with self.shared_lock:
-                        self.shared_reader_queue.put(ctg_id)
-                        for line in chunk:
-                            self.shared_reader_queue.put(line)
-                        self.shared_reader_queue.put(None)
-                        self.shared_num_jobs.value += 1
+                    chunk = self._sample_chunk(ctg_id, chunk)
+                    chunk_data = b"".join(chunk)
                 else:
                     sam_eof = True
 
+            if chunk_data is not None and self._put_chunk(ctg_id, chunk_data):
+                chunk_data = None
+                continue
+
             time.sleep(0.01)
 
     def is_eof(self):
+        self._worker_active()
+        if self.shared_eof.value:
+            self._worker_finished()
         return self.shared_eof.value
 
-    def _parse_cigar(self, cigar_str, read_str, ctg_name, ctg_pos):
-        ctg_str = self.ref_fasta[ctg_name]
-        trg_seq = []
-        qry_seq = []
-        trg_start = ctg_pos - 1
-        trg_pos = ctg_pos - 1
-        qry_start = 0
-        qry_pos = 0
-
-        left_hard = True
-        left_soft = True
-        hard_clipped_left = 0
-        hard_clipped_right = 0
-        soft_clipped_left = 0
-        soft_clipped_right = 0
-        for token in self.cigar_parser.findall(cigar_str):
-            size, op = int(token[:-1]), token[-1:]
-            if op == b"H":
-                if left_hard:
-                    qry_start += size
-                    hard_clipped_left += size
-                else:
-                    hard_clipped_right += size
-            elif op == b"S":
-                qry_pos += size
-                if left_soft:
-                    soft_clipped_left += size
-                else:
-                    soft_clipped_right += size
-            elif op == b"M":
-                qry_seq.append(read_str[qry_pos : qry_pos + size].upper())
-                trg_seq.append(ctg_str[trg_pos : trg_pos + size].upper())
-                qry_pos += size
-                trg_pos += size
-            elif op == b"I":
-                qry_seq.append(read_str[qry_pos : qry_pos + size].upper())
-                trg_seq.append(b"-" * size)
-                qry_pos += size
-            elif op == b"D":
-                qry_seq.append(b"-" * size)
-                trg_seq.append(ctg_str[trg_pos : trg_pos + size].upper())
-                trg_pos += size
-            else:
-                raise AlignmentException("Unsupported CIGAR operation: " + str(op))
-            left_hard = False
-            if op != b"H":
-                left_soft = False
-
-        trg_seq = b"".join(trg_seq)
-        qry_seq = b"".join(qry_seq)
-        matches = 0
-        for i in range(len(trg_seq)):
-            if trg_seq[i] == qry_seq[i]:
-                matches += 1
-        err_rate = 1 - matches / len(trg_seq)
-
-        trg_end = trg_pos
-        qry_end = qry_pos + hard_clipped_left
-        qry_len = qry_end + hard_clipped_right
-        qry_start += soft_clipped_left
-        qry_end -= soft_clipped_right
-
-        return (trg_start, trg_end, len(ctg_str), trg_seq,
-                qry_start, qry_end, qry_len, qry_seq, err_rate)
-
     def get_chunk(self):
         """
         Gets a chunk - safe to use from multiple processes in parallel
         """
-        #fetching data from the IO thread
-        parsed_contig = None
-        chunk_buffer = None
+        self._worker_active()
+        #fetching chunk descriptor from the IO thread
+        descriptor = None
         while True:
             with self.shared_lock:
                 if self.shared_eof.value:
+                    self._worker_finished()
                     return None, []
                 if self.shared_num_jobs.value > 0:
-                    parsed_contig = self.shared_reader_queue.get()
-                    chunk_buffer = []
-                    while True:
-                        line = self.shared_reader_queue.get()
-                        if line is not None:
-                            chunk_buffer.append(line)
-                        else:
-                            break
+                    descriptor = self.shared_reader_queue.get()
                     self.shared_num_jobs.value -= 1
                     break
             time.sleep(0.01)
-        ###
 
-        #shuffle alignments so that they uniformly distributed. Use same seed for determinism
-        random.Random(42).shuffle(chunk_buffer)
+        parsed_contig, slot, offset, length = descriptor
+        chunk_buffer = self._fetch_chunk(slot, offset, length)
+        self.worker_chunks += 1
+        self.worker_records += len(chunk_buffer)
+        return self._parse_chunk(parsed_contig, chunk_buffer, sampled=True)
 
-        sequence_length = 0
-        alignments = []
-        for line in chunk_buffer:
-            tokens = line.strip().split()
-            if len(tokens) < 11:
-                #raise AlignmentException("Error reading SAM file")
-                continue
 
-            flags = int(tokens[1])
-            is_unmapped = flags & 0x4
-            is_secondary = flags & 0x100
-            #is_supplementary = flags & 0x800    #allow supplementary
-            #if is_unmapped or is_secondary: continue
-            if is_unmapped: continue
-            if is_secondary and not self.use_secondary: continue
+class IndexedSamReader(AlignmentChunkParser):
+    """
+    Parses sorted SAM/BAM file in multiple threads without a dedicated
+    IO process. Each worker takes the next contig from the alignment index
+    and reads its records directly from the file. Contigs are given out
+    largest first, so that a large one does not end up being processed
+    while the other workers are idle.
+    """
+    def __init__(self, sam_alignment, reference_fasta,
+                 max_coverage=None, use_secondary=False):
+        #check that alignment exists
+        if not os.path.exists(sam_alignment):
+            raise AlignmentException("Can't open {0}".format(sam_alignment))
 
-            read_id = tokens[0]
-            read_contig = tokens[2]
-            cigar_str = tokens[5]
-            read_str = tokens[9]
-            ctg_pos = int(tokens[3])
-            is_reversed = flags & 0x16
-            is_secondary = flags & 0x100
+        super(IndexedSamReader, self).__init__(reference_fasta, max_coverage,
+                                               use_secondary)
+        self.aln_path = sam_alignment
+        self.aln_index = build_alignment_index(sam_alignment)
+        #BAM records refer to contigs by their order in the header
+        self.bam_ref_ids = {rec[0] : i for i, rec in enumerate(self.aln_index)}
+        self.aln_index = [rec for rec in self.aln_index if rec[2] > 0]
+        record_bytes = _estimate_record_bytes(self.aln_index, sam_alignment)
+        self.aln_index.sort(key=lambda rec: (record_bytes[rec[0]], rec[2]),
+                            reverse=True)
 
-            if read_str == b"*":
-                raise Exception("Error parsing SAM: record without read sequence")
+        #will be shared between processes
+        self.shared_next_contig = multiprocessing.Value(ctypes.c_int, 0)
+        self.shared_eof = multiprocessing.Value(ctypes.c_bool, False)
 
-            (trg_start, trg_end, trg_len, trg_seq,
-            qry_start, qry_end, qry_len, qry_seq, err_rate) = \
-                    self._parse_cigar(cigar_str, read_str, read_contig, ctg_pos)
+        #each worker process opens the BAM (and parses its header) once
+        self.bam_reader = None
+        self.bam_reader_pid = None
 
-            #OVERHANG = cfg.vals["read_aln_overhang"]
-            #if (float(qry_end - qry_start) / qry_len > self.min_aln_rate or
-            #        trg_start < OVERHANG or trg_len - trg_end < OVERHANG):
-            aln = Alignment(_STR(read_id), _STR(read_contig),
-                            qry_start, qry_end, "-" if is_reversed else "+", qry_len,
-                            trg_start, trg_end, "+", trg_len,
-                            _STR(qry_seq), _STR(trg_seq),
-                            err_rate, is_secondary)
-            alignments.append(aln)
+    def close(self):
+        if self.bam_reader is not None:
+            self.bam_reader.close()
+            self.bam_reader = None
 
-            sequence_length += qry_end - qry_start
-            contig_length = len(self.ref_fasta[parsed_contig])
-            if sequence_length // contig_length > self.max_coverage:
-                break
+    def is_eof(self):
+        self._worker_active()
+        if self.shared_eof.value:
+            self._worker_finished()
+        return self.shared_eof.value
 
-        #then, alignments by read and by score
-        alignments.sort(key=lambda a: (a.qry_id, -(a.qry_end - a.qry_start)))
+    def _read_contig(self, ctg_id, offset):
+        """
+        Reads the records of the given contig, which are sampled
+        (see _sample_chunk) and should be parsed with sampled=True.
+        For BAM, SEQ is only decoded for the sampled records
+        """
+        if self.aln_path.endswith(".bam"):
+            try:
+                if self.bam_reader_pid != os.getpid():
+                    self.bam_reader = BamReader(self.aln_path,
+                                                skip_seq_flags=self.skip_seq_flags)
+                    self.bam_reader_pid = os.getpid()
+                records = self.bam_reader.raw_records(offset,
+                                                      self.bam_ref_ids[ctg_id])
+                no_seq_lines = [self.bam_reader.format_record(rec, decode_seq=False)
+                                for rec in records]
+                return [self.bam_reader.format_record(records[i])
+                        for i in self._sampled_order(ctg_id, no_seq_lines)]
+            except BamError as e:
+                raise AlignmentException("Error reading {0}: {1}"
+                                         .format(self.aln_path, e))
+
+        chunk_buffer = []
+        with open(self.aln_path, "rb") as aln_file:
+            aln_file.seek(offset)
+            for line in aln_file:
+                read_contig = _get_sam_contig(line)
+                if read_contig is None:
+                    continue
+                if read_contig != ctg_id:
+                    break
+                chunk_buffer.append(line)
+        return self._sample_chunk(ctg_id, chunk_buffer)
+
+    def get_chunk(self):
+        """
+        Gets a chunk - safe to use from multiple processes in parallel
+        """
+        self._worker_active()
+        with self.shared_next_contig.get_lock():
+            next_contig = self.shared_next_contig.value
+            if next_contig >= len(self.aln_index):
+                self.shared_eof.value = True
+                self._worker_finished()
+                return None, []
+            self.shared_next_contig.value += 1
+
+        ctg_id, offset, _num_records = self.aln_index[next_contig]
+        chunk_buffer = self._read_contig(ctg_id, offset)
+        self.worker_chunks += 1
+        self.worker_records += len(chunk_buffer)
+        return self._parse_chunk(ctg_id, chunk_buffer, sampled=True)
+
+
+def _estimate_buffer_size(sam_alignment):
+    """
+    Shared buffer large enough to hold the whole (uncompressed)
+    alignment, within the size limits
+    """
+    file_size = os.path.getsize(sam_alignment)
+    if sam_alignment.endswith((".gz", ".bam")):
+        file_size *= COMPRESSION_RATIO
+    return min(SHARED_BUFFER_SIZE, max(MIN_SHARED_BUFFER_SIZE, file_size))
+
+
+def make_alignment_reader(sam_alignment, reference_fasta,
+                          max_coverage=None, use_secondary=False):
+    """
+    Alignments that support random access are read by the worker
+    processes directly, gzipped SAM is streamed through the IO process
+    """
+    if sam_alignment.endswith(".gz"):
+        return SynchronizedSamReader(sam_alignment, reference_fasta,
+                                     max_coverage, use_secondary)
+    return IndexedSamReader(sam_alignment, reference_fasta,
+                            max_coverage, use_secondary)
+
+
+def build_alignment_index(sam_alignment):
+    """
+    Returns the list of (contig, offset, number of records) in the file order.
+    Offset is a byte offset of the first record for SAM, and
+    BGZF virtual offset for BAM
+    """
+    if sam_alignment.endswith(".bam"):
+        #records are scanned in process, so there is no separate
+        #indexing step (and no dependency on the samtools index format)
+        try:
+            bam_reader = BamReader(sam_alignment, BAM_IO_THREADS)
+            bam_reader.close()
+            ref_offsets = bam_reader.index_references()
+        except BamError as e:
+            raise AlignmentException("Error reading {0}: {1}".format(sam_alignment, e))
+        return [(name, offset, count) for name, (offset, count)
+                in zip(bam_reader.ref_names, ref_offsets)]
+
+    index = []
+    indexed_contigs = set()
+    offset = 0
+    with open(sam_alignment, "rb") as aln_file:
+        for line in aln_file:
+            line_offset = offset
+            offset += len(line)
+            if _is_sam_header(line):
+                continue
+            read_contig = _get_sam_contig(line)
+            if read_contig is None:
+                continue
+
+            if index and index[-1][0] == read_contig:
+                index[-1][2] += 1
+            else:
+                if read_contig in indexed_contigs:
+                    raise AlignmentException("Alignment file is not sorted")
+                indexed_contigs.add(read_contig)
+                index.append([read_contig, line_offset, 1])
+
+    return [tuple(rec) for rec in index]
+
+
+def _estimate_record_bytes(aln_index, aln_path):
+    """
+    Estimates the size of each contig's records as the distance to the
+    records of the next contig in the file (compressed distance for BAM,
+    so small contigs within the same block get the same estimate)
+    """
+    is_bam = aln_path.endswith(".bam")
+    file_pos = {rec[0] : rec[1] >> 16 if is_bam else rec[1] for rec in aln_index}
+    starts = sorted(set(file_pos.values()))
+    next_start = dict(zip(starts, starts[1:] + [os.path.getsize(aln_path)]))
+    return {ctg : next_start[pos] - pos for ctg, pos in iteritems(file_pos)}
 
-        if parsed_contig is None:
-            return None, []
-        return _STR(parsed_contig), alignments
 
 """
 def preprocess_sam(sam_file, work_dir):
@@ -494,3 +1047,22 @@ def preprocess_sam(sam_file, work_dir):
 
 def _is_sam_header(line):
     return line[:3] in [b"@PG", b"@HD", b"@SQ", b"@RG", b"@CO"]
+
+
+def _cigar_runs(cigar_parser, cigar_str):
+    """
+    Splits CIGAR string into (length, operation) runs
+    """
+    return [(int(size), op) for size, op in cigar_parser.findall(cigar_str)]
+
+
+def _get_sam_contig(line):
+    """
+    Extracts reference name (RNAME) from the SAM record
+    """
+    tab_1 = line.find(b"\t")
+    tab_2 = line.find(b"\t", tab_1 + 1)
+    tab_3 = line.find(b"\t", tab_2 + 1)
+    if tab_2 == -1 or tab_3 == -1:
+        return None
+    return line[tab_2 + 1 : tab_3]
@@ -0,0 +1,140 @@
+#(c) 2019 by Authors
+#This file is a part of Flye program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Resource usage telemetry: per-stage wall / CPU time and the maximum
+memory usage so far, written as JSON lines
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import resource
+import threading
+
+
+#ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def max_rss_so_far():
+    """
+    Maximum resident set size (in bytes) of the current process and
+    the largest one among its terminated children, over the whole
+    lifetime of the process (not only over the current stage)
+    """
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (self_usage.ru_maxrss * _MAXRSS_UNIT,
+            children_usage.ru_maxrss * _MAXRSS_UNIT)
+
+
+def cpu_times():
+    """
+    User + system CPU time of the current process and
+    of its terminated children
+    """
+    times = os.times()
+    return times[0] + times[1], times[2] + times[3]
+
+
+def files_size(filenames):
+    return sum(os.path.getsize(f) for f in filenames if os.path.isfile(f))
+
+
+class Telemetry(object):
+    """
+    Writes records into a JSON lines file. Could be shared between threads.
+    If filename is None, the records are discarded. Could be used as
+    a context manager, so the file is closed on errors too
+    """
+    def __init__(self, filename, fields=None, handle=None, lock=None):
+        self.filename = filename
+        self.fields = fields or {}
+        self.lock = lock or threading.Lock()
+        self.handle = handle
+        if self.handle is None and filename is not None:
+            self.handle = open(filename, "a")
+
+    def with_fields(self, **fields):
+        """
+        Returns telemetry writing into the same file, which adds
+        the given fields (e.g. iteration number) to each record
+        """
+        new_fields = dict(self.fields)
+        new_fields.update(fields)
+        return Telemetry(self.filename, new_fields, self.handle, self.lock)
+
+    def write(self, stage_name, record):
+        if self.handle is None:
+            return
+        full_record = dict(self.fields)
+        full_record.update(record)
+        full_record["stage"] = stage_name
+        line = json.dumps(full_record, sort_keys=True)
+        with self.lock:
+            self.handle.write(line + "\n")
+            self.handle.flush()
+
+    def stage(self, stage_name, **fields):
+        return _Stage(self, stage_name, fields)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+
+class _Stage(object):
+    """
+    Measures a block of code. More values could be added to the record
+    while the stage is running. CPU time of children is only counted
+    after they exit and includes all children of the process
+    (e.g. of concurrent stages). Memory usage is the lifetime maximum
+    at the end of the stage, so it is only attributable to the stage
+    if it has grown since the previous one
+    """
+    def __init__(self, telemetry, stage_name, fields):
+        self.telemetry = telemetry
+        self.stage_name = stage_name
+        self.record = dict(fields)
+        self.start_wall = None
+        self.start_cpu = None
+
+    def __enter__(self):
+        self.start_wall = time.time()
+        self.start_cpu = cpu_times()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self_cpu, children_cpu = cpu_times()
+        self_rss, children_rss = max_rss_so_far()
+        self.record["start_time"] = round(self.start_wall, 3)
+        self.record["wall_time"] = round(time.time() - self.start_wall, 3)
+        self.record["cpu_time"] = round(self_cpu - self.start_cpu[0], 3)
+        self.record["children_cpu_time"] = \
+            round(children_cpu - self.start_cpu[1], 3)
+        self.record["max_rss_so_far"] = self_rss
+        self.record["children_max_rss_so_far"] = children_rss
+        self.record["status"] = "ok" if exc_type is None else "failed"
+        self.telemetry.write(self.stage_name, self.record)
+        return False
+
+    def write_substage(self, stage_name, record):
+        """
+        Writes a record (e.g. for a contig chunk), which was measured
+        elsewhere, with the same additional fields as this stage
+        """
+        self.telemetry.write(stage_name, record)
@@ -4,6 +4,15 @@
 
 from __future__ import absolute_import
 import os
+import subprocess
+import threading
+
+
+#Processes could be started from several threads (e.g. when contig groups
+#are polished concurrently). A process forked by one thread while another
+#thread is inside Popen inherits Popen's internal pipe, and Popen then
+#waits until that process exits, so process creation is serialized
+PROCESS_START_LOCK = threading.Lock()
 
 def which(program):
     """
@@ -24,3 +33,20 @@ def which(program):
                 return exe_file
 
     return None
+
+
+def check_call(cmdline, **kwargs):
+    """
+    Same as subprocess.check_call, but the process
+    is started under PROCESS_START_LOCK
+    """
+    with PROCESS_START_LOCK:
+        process = subprocess.Popen(cmdline, **kwargs)
+    try:
+        returncode = process.wait()
+    except (KeyboardInterrupt, Exception):
+        process.kill()
+        process.wait()
+        raise
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmdline)
@@ -4,7 +4,10 @@
 
 #include <chrono>
 #include <thread>
+#include <cstdint>
+#include <algorithm>
 #include <sys/stat.h>
+#include <zlib.h>
 
 #include "bubble_processor.h"
 
@@ -16,6 +19,31 @@ namespace
 		if (stat(filename.c_str(), &st) != 0) return 0;
 		return st.st_size;
 	}
+
+	//Binary bubbles (written by bubbles.py) are a sequence of frames.
+	//Frame header: magic, flags, stored payload size, raw payload size.
+	//Payload: name length, position, number of branches, consensus length,
+	//name, consensus, then (length, sequence) for each branch.
+	//All integers are 32-bit little-endian
+	const char BUBBLES_MAGIC[] = "FBUB";
+	const size_t MAGIC_SIZE = 4;
+	const size_t FRAME_HEADER_SIZE = 13;
+	const uint8_t FRAME_ZLIB = 1;
+
+	//"-" stands for standard input / output (polishing in streaming mode)
+	const std::string STDIO_PATH = "-";
+
+	std::string systemPath(const std::string& path, const char* stdPath)
+	{
+		return path == STDIO_PATH ? stdPath : path;
+	}
+
+	uint32_t readUint32(const char* data)
+	{
+		const unsigned char* bytes = reinterpret_cast<const unsigned char*>(data);
+		return (uint32_t)bytes[0] | ((uint32_t)bytes[1] << 8) |
+			   ((uint32_t)bytes[2] << 16) | ((uint32_t)bytes[3] << 24);
+	}
 }
 
 BubbleProcessor::BubbleProcessor(const std::string& subsMatPath,
@@ -26,33 +54,56 @@ BubbleProcessor::BubbleProcessor(const std::string& subsMatPath,
 	_generalPolisher(_subsMatrix),
 	_homoPolisher(_subsMatrix, _hopoMatrix),
 	_dinucFixer(_subsMatrix),
+	_nextFile(0),
+	_binaryInput(false),
+	_currentFileSize(0),
+	_processedBytes(0),
+	_framePos(0),
 	_verbose(false),
 	_showProgress(showProgress)
 {
 }
 
 
-void BubbleProcessor::polishAll(const std::string& inBubbles, 
+void BubbleProcessor::polishAll(const std::vector<std::string>& inBubbles, 
 								const std::string& outConsensus,
 			   					int numThreads)
 {
 	_cachedBubbles.clear();
 	_cachedBubbles.reserve(BUBBLES_CACHE);
 
-	size_t fileLength = fileSize(inBubbles);
-	if (!fileLength)
+	//bubbles could be split into multiple files (text or binary),
+	//which are processed one after another
+	size_t totalLength = 0;
+	bool streamInput = false;
+	for (auto& path : inBubbles)
 	{
-		throw std::runtime_error("Empty bubbles file!");
+		if (path == STDIO_PATH)
+		{
+			streamInput = true;
+			continue;
+		}
+		std::ifstream testFile(path);
+		if (!testFile.is_open())
+		{
+			throw std::runtime_error("Error opening bubbles file");
+		}
+		totalLength += fileSize(path);
 	}
-	_bubblesFile.open(inBubbles);
-	if (!_bubblesFile.is_open())
+	if (!totalLength && !streamInput)
 	{
-		throw std::runtime_error("Error opening bubbles file");
+		throw std::runtime_error("Empty bubbles file!");
 	}
+	//total size of the streamed input is not known in advance
+	if (streamInput) _showProgress = false;
+	_bubblesPaths = inBubbles;
+	_nextFile = 0;
+	_currentFileSize = 0;
+	_processedBytes = 0;
 
-	_progress.setFinalCount(fileLength);
+	_progress.setFinalCount(totalLength);
 
-	_consensusFile.open(outConsensus);
+	_consensusFile.open(systemPath(outConsensus, "/dev/stdout"));
 	if (!_consensusFile.is_open())
 	{
 		throw std::runtime_error("Error opening consensus file");
@@ -150,6 +201,57 @@ void BubbleProcessor::writeLog(const std::vector<Bubble>& bubbles)
 
 
 void BubbleProcessor::cacheBubbles(int maxRead)
+{
+	//nothing could be read from the current file - moving to the next one
+	int readBubbles = 0;
+	while (readBubbles == 0)
+	{
+		if (!_bubblesFile.is_open() && !this->openNextFile()) return;
+
+		readBubbles = _binaryInput ? this->cacheBinaryBubbles(maxRead) :
+									 this->cacheTextBubbles(maxRead);
+		if (readBubbles == 0)
+		{
+			_bubblesFile.close();
+			_processedBytes += _currentFileSize;
+		}
+	}
+
+	int64_t filePos = _bubblesFile.tellg();
+	if (_showProgress && filePos > 0)
+	{
+		_progress.setValue(_processedBytes + filePos);
+	}
+}
+
+
+bool BubbleProcessor::openNextFile()
+{
+	while (_nextFile < _bubblesPaths.size())
+	{
+		const std::string& path = _bubblesPaths[_nextFile++];
+		_currentFileSize = fileSize(path);
+		if (!_currentFileSize && path != STDIO_PATH) continue;
+
+		_bubblesFile.clear();
+		_bubblesFile.open(systemPath(path, "/dev/stdin"), std::ios::binary);
+		_framePayload.clear();
+		_framePos = 0;
+		if (!_bubblesFile.is_open())
+		{
+			throw std::runtime_error("Error opening bubbles file");
+		}
+
+		//binary files start with the frame magic (text ones with '>').
+		//Only peeking, since the input might be a pipe
+		_binaryInput = _bubblesFile.peek() == BUBBLES_MAGIC[0];
+		return true;
+	}
+	return false;
+}
+
+
+int BubbleProcessor::cacheTextBubbles(int maxRead)
 {
 	std::string buffer;
 	std::string candidate;
@@ -196,9 +298,101 @@ void BubbleProcessor::cacheBubbles(int maxRead)
 		++readBubbles;
 	}
 
-	int64_t filePos = _bubblesFile.tellg();
-	if (_showProgress && filePos > 0)
+	return readBubbles;
+}
+
+
+bool BubbleProcessor::readBinaryFrame()
+{
+	auto parseError = []()
+	{
+		throw std::runtime_error("Error parsing bubbles file");
+	};
+
+	char header[FRAME_HEADER_SIZE];
+	_bubblesFile.read(header, FRAME_HEADER_SIZE);
+	if (_bubblesFile.gcount() == 0) return false;
+	if ((size_t)_bubblesFile.gcount() != FRAME_HEADER_SIZE ||
+		!std::equal(header, header + MAGIC_SIZE, BUBBLES_MAGIC))
+	{
+		parseError();
+	}
+	uint8_t flags = header[MAGIC_SIZE];
+	uint32_t storedSize = readUint32(header + MAGIC_SIZE + 1);
+	uint32_t rawSize = readUint32(header + MAGIC_SIZE + 5);
+
+	_framePayload.assign(storedSize, '\0');
+	_framePos = 0;
+	_bubblesFile.read(&_framePayload[0], storedSize);
+	if ((uint32_t)_bubblesFile.gcount() != storedSize) parseError();
+
+	if (flags & FRAME_ZLIB)
+	{
+		std::string rawPayload(rawSize, '\0');
+		uLongf rawLength = rawSize;
+		int result = uncompress(reinterpret_cast<Bytef*>(&rawPayload[0]),
+								&rawLength, 
+								reinterpret_cast<const Bytef*>(_framePayload.data()),
+								storedSize);
+		if (result != Z_OK || rawLength != rawSize) parseError();
+		_framePayload.swap(rawPayload);
+	}
+	else if (rawSize != storedSize)
 	{
-		_progress.setValue(filePos);
+		parseError();
+	}
+	return true;
+}
+
+
+int BubbleProcessor::cacheBinaryBubbles(int maxRead)
+{
+	auto parseError = []()
+	{
+		throw std::runtime_error("Error parsing bubbles file");
+	};
+	auto readInt = [this, &parseError]()
+	{
+		if (_framePos + 4 > _framePayload.size()) parseError();
+		uint32_t value = readUint32(_framePayload.data() + _framePos);
+		_framePos += 4;
+		return value;
+	};
+	auto readSeq = [this, &parseError](size_t length)
+	{
+		if (_framePos + length > _framePayload.size()) parseError();
+		std::string seq = _framePayload.substr(_framePos, length);
+		_framePos += length;
+		return seq;
+	};
+
+	int readBubbles = 0;
+	while (readBubbles < maxRead)
+	{
+		if (_framePos >= _framePayload.size() && !this->readBinaryFrame()) break;
+
+		while (_framePos < _framePayload.size() && readBubbles < maxRead)
+		{
+			Bubble bubble;
+			uint32_t nameLength = readInt();
+			bubble.position = (int32_t)readInt();
+			uint32_t numOfReads = readInt();
+			uint32_t candidateLength = readInt();
+			bubble.header = readSeq(nameLength);
+			bubble.candidate = readSeq(candidateLength);
+			std::transform(bubble.candidate.begin(), bubble.candidate.end(), 
+						   bubble.candidate.begin(), ::toupper);
+			for (uint32_t i = 0; i < numOfReads; ++i)
+			{
+				std::string branch = readSeq(readInt());
+				std::transform(branch.begin(), branch.end(), 
+							   branch.begin(), ::toupper);
+				bubble.branches.push_back(std::move(branch));
+			}
+
+			_cachedBubbles.push_back(std::move(bubble));
+			++readBubbles;
+		}
 	}
+	return readBubbles;
 }
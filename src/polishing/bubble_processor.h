@@ -25,13 +25,17 @@ public:
 	BubbleProcessor(const std::string& subsMatPath,
 					const std::string& hopoMatrixPath,
 					bool  showProgress);
-	void polishAll(const std::string& inBubbles, const std::string& outConsensus,
-				   int numThreads);
+	void polishAll(const std::vector<std::string>& inBubbles,
+				   const std::string& outConsensus, int numThreads);
 	void enableVerboseOutput(const std::string& filename);
 
 private:
 	void parallelWorker();
 	void cacheBubbles(int numBubbles);
+	bool openNextFile();
+	int  cacheTextBubbles(int numBubbles);
+	bool readBinaryFrame();
+	int  cacheBinaryBubbles(int numBubbles);
 	void writeBubbles(const std::vector<Bubble>& bubbles);
 	void writeLog(const std::vector<Bubble>& bubbles);
 
@@ -47,6 +51,13 @@ private:
 	std::mutex				  _stateMutex;
 	std::vector<Bubble>		  _cachedBubbles;
 
+	std::vector<std::string>  _bubblesPaths;
+	size_t					  _nextFile;
+	bool					  _binaryInput;
+	size_t					  _currentFileSize;
+	size_t					  _processedBytes;
+	std::string				  _framePayload;
+	size_t					  _framePos;
 	std::ifstream			  _bubblesFile;
 	std::ofstream			  _consensusFile;
 	std::ofstream			  _logFile;
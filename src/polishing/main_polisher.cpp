@@ -10,7 +10,7 @@
 #include "../polishing/bubble_processor.h"
 
 
-bool parseArgs(int argc, char** argv, std::string& bubblesFile, 
+bool parseArgs(int argc, char** argv, std::vector<std::string>& bubblesFiles, 
 			   std::string& scoringMatrix, std::string& hopoMatrix,
 			   std::string& outConsensus, std::string& outVerbose,
 			   int& numThreads, bool& quiet)
@@ -21,10 +21,11 @@ bool parseArgs(int argc, char** argv, std::string& bubblesFile,
 				  << " --bubbles path --subs-mat path --hopo-mat size --out path\n"
 				  << "\t\t[--treads num] [--quiet] [--debug] [-h]\n\n"
 				  << "Required arguments:\n"
-				  << "  --bubbles path\tpath to bubbles file\n"
+				  << "  --bubbles path\tpath to bubbles file (text or binary), "
+				  << "could be repeated, '-' for stdin\n"
 				  << "  --subs-mat path\tpath to substitution matrix\n"
 				  << "  --hopo-mat size\tpath to homopolymer matrix\n"
-				  << "  --out path\tpath to output file\n\n"
+				  << "  --out path\tpath to output file, '-' for stdout\n\n"
 				  << "Optional arguments:\n"
 				  << "  --quiet \t\tno terminal output "
 				  << "[default = false] \n"
@@ -60,7 +61,7 @@ bool parseArgs(int argc, char** argv, std::string& bubblesFile,
 			else if (!strcmp(longOptions[optionIndex].name, "quiet"))
 				quiet = true;
 			else if (!strcmp(longOptions[optionIndex].name, "bubbles"))
-				bubblesFile = optarg;
+				bubblesFiles.push_back(optarg);
 			else if (!strcmp(longOptions[optionIndex].name, "subs-mat"))
 				scoringMatrix = optarg;
 			else if (!strcmp(longOptions[optionIndex].name, "hopo-mat"))
@@ -74,7 +75,7 @@ bool parseArgs(int argc, char** argv, std::string& bubblesFile,
 			exit(0);
 		}
 	}
-	if (bubblesFile.empty() || scoringMatrix.empty() || 
+	if (bubblesFiles.empty() || scoringMatrix.empty() || 
 		hopoMatrix.empty() || outConsensus.empty())
 	{
 		printUsage();
@@ -86,14 +87,14 @@ bool parseArgs(int argc, char** argv, std::string& bubblesFile,
 
 int polisher_main(int argc, char* argv[]) 
 {
-	std::string bubblesFile;
+	std::vector<std::string> bubblesFiles;
 	std::string scoringMatrix;
 	std::string hopoMatrix;
 	std::string outConsensus;
 	std::string outVerbose;
 	int  numThreads = 1;
 	bool quiet = false;
-	if (!parseArgs(argc, argv, bubblesFile, scoringMatrix, 
+	if (!parseArgs(argc, argv, bubblesFiles, scoringMatrix, 
 				   hopoMatrix, outConsensus, outVerbose, numThreads,
 				   quiet))
 		return 1;
@@ -101,7 +102,7 @@ int polisher_main(int argc, char* argv[])
 	BubbleProcessor bp(scoringMatrix, hopoMatrix, !quiet);
 	if (!outVerbose.empty())
 		bp.enableVerboseOutput(outVerbose);
-	bp.polishAll(bubblesFile, outConsensus, numThreads); 
+	bp.polishAll(bubblesFiles, outConsensus, numThreads); 
 
 	return 0;
 }